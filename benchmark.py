@@ -0,0 +1,303 @@
+'''
+This software is Copyright (c) 2024 Theodore Jones Information Technology Consulting
+(a DBA of Blueprint Cyber Solutions LLC)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to elsewhere, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# Times the migration tools against a corpus from synthetic_takeout.py and compares the
+# results with a saved baseline. Each stage runs in its own process so its peak memory and
+# I/O are measured alone; the contacts import talks to a local fake_people_api and the GYB
+# driver runs a stub gyb that only reads the mbox files, so no network or accounts are needed.
+
+import argparse
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import zipfile
+
+import synthetic_takeout
+
+STAGES = ('unroll', 'scan', 'extract', 'contacts', 'gyb')
+STUB_GYB = '''#!/bin/sh
+# Stand-in for gyb --action restore-mbox: reads every mbox of the --local-folder (argument 7)
+cat "$7"/*.mbox > /dev/null
+'''
+
+def read_proc(name):
+    """
+    Returns the 'key: value' lines of /proc/self/<name> as a dict of ints, or {} where /proc is unavailable.
+    """
+    values = {}
+    try:
+        with open(f'/proc/self/{name}') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                value = value.split()
+                if value and value[0].isdigit():
+                    values[key.strip()] = int(value[0])
+    except OSError:
+        pass
+    return values
+
+def usage_snapshot():
+    """
+    Wall clock, CPU seconds and I/O counters of this process plus its finished children.
+    Reaped children's I/O is included in /proc/self/io by the kernel.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = read_proc('io')
+    if not io:
+        blocks = own.ru_inblock + children.ru_inblock, own.ru_oublock + children.ru_oublock
+        io = {'read_bytes': blocks[0] * 512, 'write_bytes': blocks[1] * 512}
+    return {'wall': time.monotonic(),
+            'cpu': own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+            'io': io}
+
+def peak_rss_mb():
+    """
+    Returns (peak RSS of this process, largest peak RSS of any finished child) in MB.
+    """
+    own = read_proc('status').get('VmHWM')
+    if own is None:
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1024 if sys.platform != 'darwin' else 1048576
+    return own / scale, children / scale
+
+def measure(before, after, items, size):
+    wall = after['wall'] - before['wall']
+    own_rss, child_rss = peak_rss_mb()
+    io = {key: after['io'].get(key, 0) - before['io'].get(key, 0)
+          for key in ('read_bytes', 'write_bytes', 'rchar', 'wchar') if key in after['io']}
+    return {'seconds': wall, 'cpu_seconds': after['cpu'] - before['cpu'], 'items': items, 'bytes': size,
+            'items_per_s': items / max(wall, 1e-6), 'mb_per_s': size / 1048576 / max(wall, 1e-6),
+            'peak_rss_mb': max(own_rss, child_rss), 'own_rss_mb': own_rss, 'child_rss_mb': child_rss,
+            'io': io}
+
+def load_corpus(corpus):
+    with open(os.path.join(corpus, 'corpus.json')) as f:
+        return json.load(f)
+
+def loose_mbox_totals(corpus, description):
+    paths = [os.path.join(corpus, entry['path']) for entry in description['loose_mboxes']]
+    return paths, sum(entry['messages'] for entry in description['loose_mboxes']), sum(os.path.getsize(path) for path in paths)
+
+def stage_unroll(corpus, description, work, workers):
+    import takeout_unroll
+    folder = os.path.join(work, 'unroll')
+    os.makedirs(folder)
+    members = 0
+    size = 0
+    for user in description['users']:
+        for name in user['zips']:
+            shutil.copy(os.path.join(corpus, 'takeout', name), folder)
+            with zipfile.ZipFile(os.path.join(folder, name)) as archive:
+                members += len(archive.infolist())
+                size += sum(info.file_size for info in archive.infolist())
+    before = usage_snapshot()
+    takeout_unroll.process_archives(folder, workers=workers)
+    return before, members, size
+
+def stage_scan(corpus, description, work, workers):
+    import mbox_extract
+    paths, messages, size = loose_mbox_totals(corpus, description)
+    before = usage_snapshot()
+    for number, path in enumerate(paths):
+        mbox_extract.scan_emails(path, os.path.join(work, f'scan{number}.mbox'),
+                                 re.compile(synthetic_takeout.user_address(0)), workers=workers)
+    return before, messages, size
+
+def stage_extract(corpus, description, work, workers):
+    import mbox_extract
+    paths, messages, size = loose_mbox_totals(corpus, description)
+    before = usage_snapshot()
+    for number, path in enumerate(paths):
+        mbox_extract.extract_emails(path, os.path.join(work, f'extract{number}.mbox'), re.compile(synthetic_takeout.user_address(0)))
+    return before, messages, size
+
+def stage_contacts(corpus, description, work, workers):
+    from google.auth.credentials import AnonymousCredentials
+    import fake_people_api
+    import takeout_contacts_to_google_workspace as contacts
+    server = fake_people_api.start_server()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}/"
+    before = usage_snapshot()
+    try:
+        for user in description['users']:
+            # The fake server never throttles, so start at its full rate
+            contacts.main_pipelined(None, user['email'], os.path.join(corpus, user['contacts_folder']), rate=1000.0,
+                                    max_rate=1000.0, api_endpoint=endpoint, credentials=AnonymousCredentials(),
+                                    parse_workers=workers if workers > 1 else 0)
+    finally:
+        server.shutdown()
+    cards = sum(user['cards'] for user in description['users'])
+    size = sum(os.path.getsize(os.path.join(root, name))
+               for user in description['users']
+               for root, dirs, files in os.walk(os.path.join(corpus, user['contacts_folder'])) for name in files)
+    return before, cards, size
+
+def stage_gyb(corpus, description, work, workers):
+    import upload_all_mboxes_with_service_account as restore
+    base = os.path.join(work, 'gyb')
+    for user in description['users']:
+        mbox_folder = os.path.join(base, user['email'], 'mbox')
+        os.makedirs(mbox_folder)
+        for name in user['zips']:
+            with zipfile.ZipFile(os.path.join(corpus, 'takeout', name)) as archive:
+                if synthetic_takeout.MAIL_MEMBER in archive.namelist():
+                    with archive.open(synthetic_takeout.MAIL_MEMBER) as src, \
+                            open(os.path.join(mbox_folder, 'All mail Including Spam and Trash.mbox'), 'wb') as dest:
+                        shutil.copyfileobj(src, dest, 1024 * 1024)
+    gyb = os.path.join(work, 'gyb-stub')
+    with open(gyb, 'w') as f:
+        f.write(STUB_GYB)
+    os.chmod(gyb, 0o755)
+    before = usage_snapshot()
+    jobs = restore.find_restore_jobs(base, 'example.com')
+    restore.run_restores(jobs, gyb=gyb, concurrency=max(workers, 1), retries=0,
+                         log_dir=os.path.join(work, 'gyb_logs'), poll_interval=0.05)
+    failed = [job['dest_email'] for job in jobs if job['status'] != 'done']
+    if failed:
+        raise RuntimeError(f"stub restores failed for {', '.join(failed)}")
+    return before, sum(user['messages'] for user in description['users']), sum(job['size'] for job in jobs)
+
+def run_stage(stage, corpus, work, workers, result_path):
+    """
+    Runs one stage in this process and writes its measurements to result_path.
+    """
+    description = load_corpus(corpus)
+    before, items, size = globals()[f'stage_{stage}'](corpus, description, work, workers)
+    result = measure(before, usage_snapshot(), items, size)
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+def benchmark_stage(stage, corpus, work_root, workers):
+    """
+    Runs a stage in a fresh child process with a fresh work folder and returns its
+    measurements, or None if it failed. The stage's own output goes to <stage>.log.
+    """
+    work = os.path.join(work_root, stage)
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(work)
+    result_path = os.path.join(work_root, f'{stage}.json')
+    log_path = os.path.join(work_root, f'{stage}.log')
+    with open(log_path, 'w') as log:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), corpus, '--run-stage', stage,
+                                  '--work-dir', work, '--workers', str(workers), '--result', result_path],
+                                 stdout=log, stderr=subprocess.STDOUT)
+    shutil.rmtree(work, ignore_errors=True)
+    if process.returncode != 0:
+        print(f"Stage {stage} failed (exit {process.returncode}), see {log_path}")
+        return None
+    with open(result_path) as f:
+        return json.load(f)
+
+def compare(results, baseline, threshold):
+    """
+    Returns {stage: (throughput change, peak RSS change)} against baseline and the list of
+    stages that regressed: throughput down or peak RSS up by more than threshold.
+    """
+    changes = {}
+    regressions = []
+    for stage, result in results.items():
+        old = baseline.get('stages', {}).get(stage)
+        if not result or not old:
+            continue
+        speed = result['items_per_s'] / old['items_per_s'] - 1 if old['items_per_s'] else 0.0
+        memory = result['peak_rss_mb'] / old['peak_rss_mb'] - 1 if old['peak_rss_mb'] else 0.0
+        changes[stage] = (speed, memory)
+        if speed < -threshold or memory > threshold:
+            regressions.append(stage)
+    return changes, regressions
+
+def print_report(results, changes):
+    print(f"{'stage':<10} {'items':>8} {'seconds':>8} {'cpu s':>7} {'items/s':>10} {'MB/s':>8} "
+          f"{'peak MB':>8} {'read MB':>8} {'write MB':>8}  vs baseline")
+    for stage, result in results.items():
+        if result is None:
+            print(f"{stage:<10} failed")
+            continue
+        io = result['io']
+        line = (f"{stage:<10} {result['items']:>8} {result['seconds']:>8.2f} {result['cpu_seconds']:>7.2f} "
+                f"{result['items_per_s']:>10.0f} {result['mb_per_s']:>8.1f} {result['peak_rss_mb']:>8.1f} "
+                f"{io.get('rchar', io.get('read_bytes', 0)) / 1048576:>8.1f} "
+                f"{io.get('wchar', io.get('write_bytes', 0)) / 1048576:>8.1f}")
+        if stage in changes:
+            speed, memory = changes[stage]
+            line += f"  {speed:+.1%} items/s, {memory:+.1%} peak RSS"
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the migration tools on a synthetic Takeout corpus.")
+    parser.add_argument('corpus', help="corpus folder from synthetic_takeout.py (generated with defaults if missing)")
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"comma-separated stages to run ({', '.join(STAGES)})")
+    parser.add_argument('--workers', type=int, default=1, help="workers passed to each tool")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per stage; the fastest is reported")
+    parser.add_argument('--work-dir', help="scratch folder (default: <corpus>/bench)")
+    parser.add_argument('--baseline', help="baseline JSON to compare with")
+    parser.add_argument('--save-baseline', help="write this run's results as a baseline JSON")
+    parser.add_argument('--threshold', type=float, default=0.1, help="relative change counted as a regression")
+    parser.add_argument('--fail-on-regression', action='store_true', help="exit 1 if any stage regressed or failed")
+    parser.add_argument('--run-stage', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage(args.run_stage, args.corpus, args.work_dir, args.workers, args.result)
+        sys.exit(0)
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+    corpus = os.path.abspath(args.corpus)
+    if not os.path.exists(os.path.join(corpus, 'corpus.json')):
+        synthetic_takeout.generate_corpus(corpus)
+    work_root = os.path.abspath(args.work_dir or os.path.join(corpus, 'bench'))
+    os.makedirs(work_root, exist_ok=True)
+
+    results = {}
+    for stage in stages:
+        runs = []
+        for run in range(args.repeat):
+            print(f"Running {stage} ({run + 1}/{args.repeat})")
+            runs.append(benchmark_stage(stage, corpus, work_root, args.workers))
+        runs = [result for result in runs if result]
+        results[stage] = max(runs, key=lambda result: result['items_per_s']) if runs else None
+
+    changes, regressions = {}, []
+    options = load_corpus(corpus)['options']
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('corpus') != options or baseline.get('workers') != args.workers:
+            print("Warning: the baseline was recorded with a different corpus or worker count")
+        changes, regressions = compare(results, baseline, args.threshold)
+    print_report(results, changes)
+    if regressions:
+        print(f"Regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'corpus': options, 'workers': args.workers, 'python': sys.version.split()[0],
+                       'stages': {stage: result for stage, result in results.items() if result}}, f, indent=1)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.fail_on_regression and (regressions or None in results.values()):
+        sys.exit(1)
@@ -0,0 +1,228 @@
+'''
+This software is Copyright (c) 2024 Theodore Jones Information Technology Consulting
+(a DBA of Blueprint Cyber Solutions LLC)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to elsewhere, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# Local stand-in for the parts of an IMAP server the IMAP uploader uses, for testing and
+# benchmarking without a mail server. Any login is accepted; mailboxes are per login.
+
+import argparse
+import base64
+import re
+import socket
+import socketserver
+import threading
+
+ATOM = re.compile(rb'[^\s()"{]+')
+LITERAL = re.compile(rb'\{(\d+)(\+?)\}$')
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """
+    In-memory IMAP server. literal_plus and multiappend choose which extensions it
+    advertises, so each of the uploader's append strategies can be exercised.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, literal_plus=True, multiappend=True):
+        super().__init__(address, FakeImapHandler)
+        self.literal_plus = literal_plus
+        self.multiappend = multiappend
+        self.lock = threading.Lock()
+        self.mailboxes = {}
+        self.commands = {}
+
+    def capabilities(self):
+        capabilities = ['IMAP4rev1', 'AUTH=PLAIN', 'SASL-IR']
+        if self.literal_plus:
+            capabilities.append('LITERAL+')
+        if self.multiappend:
+            capabilities.append('MULTIAPPEND')
+        return ' '.join(capabilities)
+
+    def count(self, name):
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+
+    def messages(self, user, mailbox):
+        with self.lock:
+            return list(self.mailboxes.get(user, {}).get(mailbox, []))
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def read_line(self):
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError
+        return line.rstrip(b'\r\n')
+
+    def read_string(self, rest):
+        """
+        Reads an astring (atom, quoted string or literal) from the start of rest.
+        Returns (value, remaining line).
+        """
+        rest = rest.lstrip(b' ')
+        if rest.startswith(b'"'):
+            value = bytearray()
+            i = 1
+            while rest[i:i + 1] != b'"':
+                if rest[i:i + 1] == b'\\':
+                    i += 1
+                value += rest[i:i + 1]
+                i += 1
+            return bytes(value), rest[i + 1:]
+        if rest.startswith(b'{'):
+            end = rest.index(b'}') + 1
+            value, rest = self.read_literal(rest[:end])
+            return value, rest
+        match = ATOM.match(rest)
+        return match.group(), rest[match.end():]
+
+    def read_literal(self, header):
+        """
+        Reads the literal announced by header ('{n}' or '{n+}'), then the rest of its line.
+        """
+        match = LITERAL.search(header)
+        if not match.group(2):
+            self.wfile.write(b'+ Ready for literal data\r\n')
+            self.wfile.flush()
+        elif not self.server.literal_plus:
+            raise ValueError("non-synchronizing literal without LITERAL+")
+        value = self.rfile.read(int(match.group(1)))
+        return value, self.read_line()
+
+    def handle(self):
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.user = None
+        self.send(f'* OK [CAPABILITY {self.server.capabilities()}] Fake IMAP ready')
+        try:
+            while True:
+                line = self.read_line()
+                tag, _, rest = line.partition(b' ')
+                command, _, rest = rest.partition(b' ')
+                command = command.upper().decode()
+                tag = tag.decode()
+                self.server.count(command)
+                try:
+                    if not self.dispatch(tag, command, rest):
+                        return
+                except (ValueError, IndexError, AttributeError) as e:
+                    self.send(f'{tag} BAD {e}')
+        except (EOFError, ConnectionError):
+            return
+
+    def dispatch(self, tag, command, rest):
+        server = self.server
+        if command == 'CAPABILITY':
+            self.send(f'* CAPABILITY {server.capabilities()}')
+        elif command == 'LOGIN':
+            user, rest = self.read_string(rest)
+            self.read_string(rest)
+            self.login(user.decode())
+        elif command == 'AUTHENTICATE':
+            mechanism, _, initial = rest.partition(b' ')
+            if not initial:
+                self.wfile.write(b'+ \r\n')
+                self.wfile.flush()
+                initial = self.read_line()
+            authzid, authcid, password = base64.b64decode(initial).split(b'\0')
+            self.login((authzid or authcid).decode())
+        elif command == 'LOGOUT':
+            self.send('* BYE Logging out')
+            self.send(f'{tag} OK LOGOUT completed')
+            return False
+        elif self.user is None:
+            self.send(f'{tag} NO Not authenticated')
+            return True
+        elif command == 'NOOP':
+            pass
+        elif command == 'LIST':
+            with server.lock:
+                names = sorted(server.mailboxes[self.user])
+            for name in names:
+                self.send(f'* LIST () "/" "{name}"')
+        elif command == 'CREATE':
+            name, rest = self.read_string(rest)
+            with server.lock:
+                mailboxes = server.mailboxes[self.user]
+                exists = name.decode() in mailboxes
+                mailboxes.setdefault(name.decode(), [])
+            if exists:
+                self.send(f'{tag} NO [ALREADYEXISTS] Mailbox exists')
+                return True
+        elif command == 'APPEND':
+            self.append(tag, rest)
+            return True
+        else:
+            self.send(f'{tag} BAD Unknown command {command}')
+            return True
+        self.send(f'{tag} OK {command} completed')
+        return True
+
+    def login(self, user):
+        self.user = user
+        with self.server.lock:
+            self.server.mailboxes.setdefault(user, {'INBOX': []})
+
+    def append(self, tag, rest):
+        name, rest = self.read_string(rest)
+        name = name.decode()
+        messages = []
+        while rest.strip():
+            rest = rest.lstrip(b' ')
+            flags = ()
+            date = None
+            if rest.startswith(b'('):
+                end = rest.index(b')')
+                flags = tuple(rest[1:end].decode().split())
+                rest = rest[end + 1:].lstrip(b' ')
+            if rest.startswith(b'"'):
+                date, rest = self.read_string(rest)
+                date = date.decode()
+                rest = rest.lstrip(b' ')
+            if len(messages) and not self.server.multiappend:
+                raise ValueError("MULTIAPPEND is not enabled")
+            end = rest.index(b'}') + 1
+            body, rest = self.read_literal(rest[:end])
+            messages.append((flags, date, body))
+        with self.server.lock:
+            mailboxes = self.server.mailboxes[self.user]
+            if name not in mailboxes:
+                self.send(f'{tag} NO [TRYCREATE] Mailbox does not exist')
+                return
+            mailboxes[name].extend(messages)
+        self.send(f'{tag} OK APPEND completed')
+
+def start_server(port=0, **options):
+    """
+    Starts a FakeImapServer on a background thread and returns it; server.server_address has the port.
+    """
+    server = FakeImapServer(('127.0.0.1', port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a local in-memory stand-in for an IMAP server.")
+    parser.add_argument('--port', type=int, default=1143)
+    parser.add_argument('--no-literal-plus', action='store_true', help="do not advertise LITERAL+")
+    parser.add_argument('--no-multiappend', action='store_true', help="do not advertise MULTIAPPEND")
+    args = parser.parse_args()
+
+    server = FakeImapServer(('127.0.0.1', args.port), literal_plus=not args.no_literal_plus,
+                            multiappend=not args.no_multiappend)
+    print(f"Fake IMAP server listening on 127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,150 @@
+'''
+This software is Copyright (c) 2024 Theodore Jones Information Technology Consulting 
+(a DBA of Blueprint Cyber Solutions LLC)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to elsewhere, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# Local stand-in for the parts of the People API the contacts importer uses, for testing
+# and benchmarking without a Workspace tenant. Point the importer at it with
+# --api-endpoint http://127.0.0.1:<port> --anonymous.
+
+import argparse
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakePeopleApi(ThreadingHTTPServer):
+    """
+    In-memory People API. Every throttle_every-th batchCreateContacts call is answered
+    with 429 and a Retry-After header, and every call waits latency seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, throttle_every=0, retry_after=1, latency=0.0):
+        super().__init__(address, FakePeopleApiHandler)
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.people = []
+        self.groups = {}
+        self.requests = {}
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            return self.requests[name]
+
+class FakePeopleApiHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def page(self, items, key, query, default_size):
+        size = int(query.get('pageSize', [default_size])[0])
+        start = int(query.get('pageToken', ['0'])[0] or 0)
+        payload = {key: items[start:start + size], 'totalItems': len(items)}
+        if start + size < len(items):
+            payload['nextPageToken'] = str(start + size)
+        return payload
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        time.sleep(server.latency)
+        if url.path == '/v1/contactGroups':
+            server.count('contactGroups.list')
+            with server.lock:
+                groups = list(server.groups.values())
+            self.send_json(200, self.page(groups, 'contactGroups', query, 30))
+        elif url.path == '/v1/people/me/connections':
+            server.count('people.connections.list')
+            with server.lock:
+                people = list(server.people)
+            self.send_json(200, self.page(people, 'connections', query, 100))
+        else:
+            self.send_json(404, {'error': {'code': 404, 'message': f'Unknown path {url.path}'}})
+
+    def do_POST(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        body = self.read_json()
+        time.sleep(server.latency)
+        if path == '/v1/people:batchCreateContacts':
+            calls = server.count('people.batchCreateContacts')
+            if server.throttle_every and calls % server.throttle_every == 0:
+                self.send_json(429, {'error': {'code': 429, 'message': 'Quota exceeded', 'status': 'RESOURCE_EXHAUSTED'}},
+                               {'Retry-After': str(server.retry_after)})
+                return
+            created = []
+            with server.lock:
+                for contact in body.get('contacts', []):
+                    person = dict(contact['contactPerson'])
+                    person['resourceName'] = f'people/c{len(server.people) + 1}'
+                    server.people.append(person)
+                    created.append({'httpStatusCode': 200, 'person': person})
+            self.send_json(200, {'createdPeople': created})
+        elif path == '/v1/contactGroups':
+            server.count('contactGroups.create')
+            name = body['contactGroup']['name']
+            with server.lock:
+                if any(group['name'] == name for group in server.groups.values()):
+                    self.send_json(409, {'error': {'code': 409, 'message': 'Contact group name already exists', 'status': 'ALREADY_EXISTS'}})
+                    return
+                resource_name = f'contactGroups/g{len(server.groups) + 1}'
+                group = {'resourceName': resource_name, 'name': name, 'groupType': 'USER_CONTACT_GROUP'}
+                server.groups[resource_name] = group
+            self.send_json(200, group)
+        else:
+            self.send_json(404, {'error': {'code': 404, 'message': f'Unknown path {path}'}})
+
+def start_server(port=0, **options):
+    """
+    Starts a FakePeopleApi on a background thread and returns it; server.server_address has the port.
+    """
+    server = FakePeopleApi(('127.0.0.1', port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a local in-memory stand-in for the People API.")
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--throttle-every', type=int, default=0, help="answer every Nth batch create with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with 429 responses")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each request takes")
+    args = parser.parse_args()
+    server = FakePeopleApi(('127.0.0.1', args.port), throttle_every=args.throttle_every,
+                           retry_after=args.retry_after, latency=args.latency)
+    print(f"Fake People API listening on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
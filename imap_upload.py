@@ -0,0 +1,540 @@
+'''
+This software is Copyright (c) 2024 Theodore Jones Information Technology Consulting
+(a DBA of Blueprint Cyber Solutions LLC)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to elsewhere, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# Uploads a user's Takeout mbox files, as unrolled by takeout_unroll.py, into an IMAP
+# server. Gmail labels become folders, and messages are appended over a pool of
+# connections, several per APPEND with MULTIAPPEND and without waiting for the server
+# with LITERAL+.
+
+import argparse
+import base64
+import concurrent.futures
+import csv
+import datetime
+import email.utils
+import mmap
+import os
+import queue
+import re
+import socket
+import ssl
+import sys
+import threading
+import time
+
+import mbox_extract
+
+# Gmail system labels that map to standard folders; anything else becomes a folder of its own
+SYSTEM_FOLDERS = {'inbox': 'INBOX', 'sent': 'Sent', 'drafts': 'Drafts', 'spam': 'Junk', 'trash': 'Trash'}
+# Labels that only carry state
+FLAG_LABELS = {'starred': '\\Flagged', 'drafts': '\\Draft'}
+IGNORED_LABELS = {'important', 'archived', 'opened', 'unread', 'starred'}
+DEFAULT_FOLDER = 'Archive'
+LABEL = re.compile(r'\s*("(?:[^"\\]|\\.)*"|[^,]*)\s*(?:,|$)')
+FROM_LINE_DATE = re.compile(rb'^From \S+ +(\w{3} \w{3} +\d+ \d\d:\d\d:\d\d(?: [+-]\d{4})? \d{4})')
+LINE_END = re.compile(rb'\r?\n')
+# A body line the mbox quoted so it does not start a message: '>From ', '>>From ', ...
+QUOTED_FROM = re.compile(rb'^>(>*From )', re.MULTILINE)
+RESPONSE_LITERAL = re.compile(rb'\{(\d+)\}$')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+LITERAL_MINUS_LIMIT = 4096
+WRITE_BUFFER_SIZE = 256 * 1024
+
+class ImapError(Exception):
+    pass
+
+def quote(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def encode_mailbox(name):
+    """
+    Encodes a mailbox name in IMAP's modified UTF-7.
+    """
+    encoded = []
+    pending = []
+
+    def flush():
+        if pending:
+            raw = base64.b64encode(''.join(pending).encode('utf-16-be')).decode('ascii')
+            encoded.append('&' + raw.rstrip('=').replace('/', ',') + '-')
+            pending.clear()
+
+    for char in name:
+        if 0x20 <= ord(char) <= 0x7e:
+            flush()
+            encoded.append('&-' if char == '&' else char)
+        else:
+            pending.append(char)
+    flush()
+    return ''.join(encoded)
+
+def imap_date(value):
+    return f"{value.day:02d}-{MONTHS[value.month - 1]}-{value.year} {value:%H:%M:%S %z}"
+
+def message_datetime(from_line, date_header):
+    """
+    Returns when a message was received: the date of its mbox 'From ' line, else its
+    Date header, else None.
+    """
+    match = FROM_LINE_DATE.match(from_line)
+    if match:
+        text = ' '.join(match.group(1).decode('ascii').split())
+        for layout in ('%a %b %d %H:%M:%S %z %Y', '%a %b %d %H:%M:%S %Y'):
+            try:
+                value = datetime.datetime.strptime(text, layout)
+                return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+            except ValueError:
+                pass
+    if date_header:
+        try:
+            value = email.utils.parsedate_to_datetime(date_header)
+            return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+        except (TypeError, ValueError, IndexError):
+            pass
+    return None
+
+def message_date(from_line, date_header):
+    """
+    Returns the message's INTERNALDATE for APPEND, or None.
+    """
+    value = message_datetime(from_line, date_header)
+    return imap_date(value) if value else None
+
+def split_labels(value):
+    labels = []
+    for match in LABEL.finditer(value or ''):
+        label = match.group(1).strip()
+        if label.startswith('"'):
+            label = re.sub(r'\\(.)', r'\1', label[1:-1])
+        if label:
+            labels.append(label)
+        if match.end() == len(value):
+            break
+    return labels
+
+def label_folders(labels, delimiter='/', default_folder=DEFAULT_FOLDER, skip_labels=()):
+    """
+    Maps a message's Gmail labels to (folders, flags). Returns no folders when one of
+    its labels is in skip_labels.
+    """
+    folders = []
+    flags = ['\\Seen']
+    for label in labels:
+        key = label.lower()
+        if key in skip_labels:
+            return [], []
+        if key == 'unread':
+            flags.remove('\\Seen')
+        if key in FLAG_LABELS:
+            flags.append(FLAG_LABELS[key])
+        if key in IGNORED_LABELS or key.startswith('category '):
+            continue
+        folder = SYSTEM_FOLDERS.get(key) or label.replace('/', delimiter)
+        if folder not in folders:
+            folders.append(folder)
+    return folders or [default_folder], flags
+
+def find_mbox_files(source):
+    """
+    Returns the mbox files of a source: a file, a user folder as unrolled by
+    takeout_unroll.py (its mbox/ folder), or any folder of .mbox files.
+    """
+    if os.path.isfile(source):
+        return [source]
+    if os.path.isdir(os.path.join(source, 'mbox')):
+        source = os.path.join(source, 'mbox')
+    paths = []
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        paths.extend(os.path.join(root, file) for file in sorted(files) if file.endswith('.mbox'))
+    return paths
+
+def iter_mbox_messages(path, start=0, end=None, crlf=True, header_names=('x-gmail-labels', 'date')):
+    """
+    Yields (from_line, headers, body) for every message that begins in path[start:end],
+    with '>From ' lines unquoted (mboxrd) and the body in CRLF line endings ready for APPEND
+    unless crlf is False, and headers holding header_names.
+    """
+    data = mbox_extract.open_mbox_map(path)
+    if data is None:
+        return
+    released = start - start % mmap.PAGESIZE
+    try:
+        for start, end in mbox_extract.iter_message_spans(data, start, end):
+            line_end = data.find(b'\n', start, end)
+            if line_end < 0:
+                continue
+            header_end = mbox_extract.find_header_end(data, line_end + 1, end)
+            headers = mbox_extract.parse_raw_headers(data[line_end + 1:header_end], header_names)
+            body = data[line_end + 1:end]
+            # Drop the blank line the mbox format puts before the next 'From ' line
+            if body.endswith(b'\n\n') or body.endswith(b'\r\n\r\n'):
+                body = body[:-2] if body.endswith(b'\r\n') else body[:-1]
+            if b'>From ' in body:
+                body = QUOTED_FROM.sub(rb'\1', body)
+            yield data[start:line_end], headers, LINE_END.sub(b'\r\n', body) if crlf else body
+            released = mbox_extract.release_scanned(data, released, end)
+    finally:
+        data.close()
+
+class ImapConnection:
+    """
+    A minimal IMAP client that can pipeline commands, which imaplib cannot. Tagged
+    responses are collected as they arrive, so several commands can be in flight.
+    """
+    def __init__(self, host, port=143, ssl_context=None, timeout=60):
+        sock = socket.create_connection((host, port), timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if ssl_context is not None:
+            sock = ssl_context.wrap_socket(sock, server_hostname=host)
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.writer = sock.makefile('wb', buffering=WRITE_BUFFER_SIZE)
+        self.tag_number = 0
+        self.completed = {}
+        self.untagged = []
+        self.capabilities = set()
+        greeting = self.read_line()
+        if not greeting.startswith(b'* OK') and not greeting.startswith(b'* PREAUTH'):
+            raise ImapError(f"Unexpected greeting: {greeting!r}")
+        self.update_capabilities(greeting)
+        if not self.capabilities:
+            self.command('CAPABILITY')
+
+    def next_tag(self):
+        self.tag_number += 1
+        return f'A{self.tag_number:05d}'
+
+    def write(self, data):
+        self.writer.write(data.encode() if isinstance(data, str) else data)
+
+    def read_line(self):
+        line = self.reader.readline()
+        if not line:
+            raise ImapError("Connection closed by server")
+        line = line.rstrip(b'\r\n')
+        # Skip over literals in untagged responses, e.g. mailbox names in LIST
+        while RESPONSE_LITERAL.search(line):
+            size = int(RESPONSE_LITERAL.search(line).group(1))
+            line += b' ' + self.reader.read(size) + self.reader.readline().rstrip(b'\r\n')
+        return line
+
+    def update_capabilities(self, line):
+        # A [CAPABILITY ...] response code, or an untagged CAPABILITY response
+        match = re.search(rb'\[CAPABILITY ([^\]]*)\]|^\* CAPABILITY (.*)', line, re.IGNORECASE)
+        if match:
+            names = match.group(1) or match.group(2)
+            self.capabilities = set(names.decode('ascii', errors='replace').upper().split())
+
+    def handle_line(self, line):
+        if line.startswith(b'* '):
+            self.update_capabilities(line)
+            self.untagged.append(line)
+        elif not line.startswith(b'+'):
+            tag, _, rest = line.partition(b' ')
+            status, _, text = rest.partition(b' ')
+            self.completed[tag.decode()] = (status.upper().decode(), text.decode('utf-8', errors='replace'))
+            self.update_capabilities(text)
+
+    def wait(self, tag):
+        """
+        Waits for a command's tagged response and returns its text; raises ImapError unless it is OK.
+        """
+        self.writer.flush()
+        while tag not in self.completed:
+            self.handle_line(self.read_line())
+        status, text = self.completed.pop(tag)
+        if status != 'OK':
+            raise ImapError(f"{status} {text}")
+        return text
+
+    def wait_continuation(self, tag):
+        """
+        Waits for the server to ask for a synchronizing literal of command tag.
+        """
+        self.writer.flush()
+        while True:
+            line = self.read_line()
+            if line.startswith(b'+'):
+                return
+            self.handle_line(line)
+            if tag in self.completed:
+                self.wait(tag)
+                raise ImapError("Command completed before its literal was sent")
+
+    def command(self, *parts):
+        tag = self.next_tag()
+        self.write(f"{tag} {' '.join(parts)}\r\n")
+        return self.wait(tag)
+
+    def login(self, user, password, master_user=None):
+        """
+        Logs in as user; with master_user, authenticates as that administrator and acts as user
+        (SASL PLAIN authorization identity, e.g. Dovecot master users).
+        """
+        if master_user:
+            token = base64.b64encode(f'{user}\0{master_user}\0{password}'.encode()).decode('ascii')
+            if 'SASL-IR' in self.capabilities:
+                self.command('AUTHENTICATE', 'PLAIN', token)
+            else:
+                tag = self.next_tag()
+                self.write(f"{tag} AUTHENTICATE PLAIN\r\n")
+                self.wait_continuation(tag)
+                self.write(token + '\r\n')
+                self.wait(tag)
+        else:
+            self.command('LOGIN', quote(user), quote(password))
+        # Servers may advertise more once logged in
+        self.command('CAPABILITY')
+
+    def hierarchy_delimiter(self):
+        self.untagged.clear()
+        self.command('LIST', '""', '""')
+        for line in self.untagged:
+            match = re.match(rb'\* LIST \([^)]*\) (?:"((?:[^"\\]|\\.)*)"|NIL)', line, re.IGNORECASE)
+            if match and match.group(1):
+                return match.group(1).replace(b'\\', b'').decode()
+        return '/'
+
+    def create(self, mailbox):
+        try:
+            self.command('CREATE', quote(encode_mailbox(mailbox)))
+        except ImapError:
+            # Most often it already exists; an APPEND to a missing folder reports the real problem
+            pass
+
+    def literal(self, size):
+        """
+        Returns the literal prefix for size bytes and whether the server must be waited for.
+        """
+        if 'LITERAL+' in self.capabilities or ('LITERAL-' in self.capabilities and size <= LITERAL_MINUS_LIMIT):
+            return f'{{{size}+}}\r\n', False
+        return f'{{{size}}}\r\n', True
+
+    def append(self, mailbox, messages):
+        """
+        Appends (flags, date, body) messages to a mailbox. With MULTIAPPEND they go in one
+        command; otherwise each is its own APPEND, sent without waiting for the previous
+        one to complete. Returns the errors of messages that were not appended.
+        """
+        target = quote(encode_mailbox(mailbox))
+        if 'MULTIAPPEND' in self.capabilities:
+            tag = self.next_tag()
+            self.write(f"{tag} APPEND {target}")
+            try:
+                for flags, date, body in messages:
+                    self.write_message(tag, flags, date, body)
+                self.write(b'\r\n')
+                self.wait(tag)
+            except ImapError as e:
+                return [str(e)] * len(messages)
+            return []
+
+        tags = []
+        errors = []
+        for flags, date, body in messages:
+            tag = self.next_tag()
+            self.write(f"{tag} APPEND {target}")
+            try:
+                self.write_message(tag, flags, date, body)
+            except ImapError as e:
+                errors.append(str(e))
+                continue
+            self.write(b'\r\n')
+            tags.append(tag)
+        for tag in tags:
+            try:
+                self.wait(tag)
+            except ImapError as e:
+                errors.append(str(e))
+        return errors
+
+    def write_message(self, tag, flags, date, body):
+        prefix = ' '
+        if flags:
+            prefix += '(' + ' '.join(flags) + ') '
+        if date:
+            prefix += quote(date) + ' '
+        header, synchronizing = self.literal(len(body))
+        self.write(prefix + header)
+        if synchronizing:
+            self.wait_continuation(tag)
+        self.write(body)
+
+    def logout(self):
+        try:
+            self.command('LOGOUT')
+        except (ImapError, OSError):
+            pass
+        self.sock.close()
+
+class UploadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, name, count=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def get(self, name):
+        return self.counts.get(name, 0)
+
+def connect(host, port, user, password, ssl_context=None, master_user=None, timeout=60):
+    connection = ImapConnection(host, port, ssl_context, timeout)
+    connection.login(user, password, master_user)
+    return connection
+
+def append_worker(batches, stats, open_connection):
+    connection = None
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        folder, messages = batch
+        try:
+            if connection is None:
+                connection = open_connection()
+            errors = connection.append(folder, messages)
+        except (ImapError, OSError) as e:
+            # The connection is unusable; the next batch gets a fresh one
+            errors = [str(e)] * len(messages)
+            connection = None
+        stats.add('appended', len(messages) - len(errors))
+        stats.add('bytes', sum(len(body) for flags, date, body in messages))
+        if errors:
+            stats.add('failed', len(errors))
+            print(f"Error appending {len(errors)} messages to {folder}: {errors[0]}")
+    if connection is not None:
+        connection.logout()
+
+def upload_mailbox(source, host, user, password, port=143, ssl_context=None, master_user=None, connections=4,
+                   batch_messages=50, batch_bytes=8 * 1024 * 1024, default_folder=DEFAULT_FOLDER, skip_labels=()):
+    """
+    Uploads every message of source's mbox files to user's IMAP account over `connections`
+    connections and returns the UploadStats. Messages are grouped per folder into batches
+    of up to batch_messages messages or batch_bytes bytes.
+    """
+    open_connection = lambda: connect(host, port, user, password, ssl_context, master_user)
+    skip_labels = {label.lower() for label in skip_labels}
+    stats = UploadStats()
+    control = open_connection()
+    delimiter = control.hierarchy_delimiter()
+    created = set()
+    pending = {}
+    batches = queue.Queue(maxsize=connections * 4)
+    threads = [threading.Thread(target=append_worker, args=(batches, stats, open_connection))
+               for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+
+    started = time.monotonic()
+    try:
+        for path in find_mbox_files(source):
+            print(f"Uploading {path} to {user}")
+            for from_line, headers, body in iter_mbox_messages(path):
+                folders, flags = label_folders(split_labels(headers.get('x-gmail-labels')), delimiter,
+                                               default_folder, skip_labels)
+                if not folders:
+                    stats.add('skipped')
+                    continue
+                date = message_date(from_line, headers.get('date'))
+                for folder in folders:
+                    if folder not in created:
+                        if folder != 'INBOX':
+                            control.create(folder)
+                        created.add(folder)
+                    messages, size = pending.get(folder, ([], 0))
+                    messages.append((flags, date, body))
+                    size += len(body)
+                    if len(messages) >= batch_messages or size >= batch_bytes:
+                        batches.put((folder, messages))
+                        messages, size = [], 0
+                    pending[folder] = (messages, size)
+        for folder, (messages, size) in pending.items():
+            if messages:
+                batches.put((folder, messages))
+    finally:
+        for _ in threads:
+            batches.put(None)
+        for thread in threads:
+            thread.join()
+        control.logout()
+    elapsed = time.monotonic() - started
+    print(f"Appended {stats.get('appended')} messages ({stats.get('bytes') / 1048576:.1f} MB) to {user} "
+          f"in {len(created)} folders in {elapsed:.1f}s ({stats.get('appended') / max(elapsed, 0.001):.0f}/s); "
+          f"{stats.get('failed')} failed, {stats.get('skipped')} skipped")
+    return stats
+
+def read_accounts(csv_path):
+    """
+    Reads (source, login, password) rows from a CSV file; a header row and lines starting with '#' are skipped.
+    """
+    accounts = []
+    with open(csv_path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 3 or row[0].startswith('#') or row[0].strip().lower() == 'source':
+                continue
+            accounts.append((row[0].strip(), row[1].strip(), row[2]))
+    return accounts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Upload Takeout mbox files into an IMAP server, one folder per Gmail label.")
+    parser.add_argument('source', nargs='?', help="mbox file, or a user folder as unrolled by takeout_unroll.py")
+    parser.add_argument('--host', required=True, help="IMAP server")
+    parser.add_argument('--port', type=int, help="IMAP port (default 143, or 993 with --ssl)")
+    parser.add_argument('--ssl', action='store_true', help="connect with implicit TLS")
+    parser.add_argument('--insecure', action='store_true', help="do not verify the server's TLS certificate")
+    parser.add_argument('--user', help="IMAP login of the account to fill")
+    parser.add_argument('--password', help="password (default: IMAP_PASSWORD environment variable)")
+    parser.add_argument('--master-user', help="log in as this administrator on behalf of --user (SASL PLAIN)")
+    parser.add_argument('--accounts', metavar='CSV', help="upload many accounts from a CSV of source,login,password rows")
+    parser.add_argument('--parallel-users', type=int, default=1, help="accounts uploaded at the same time with --accounts")
+    parser.add_argument('--connections', type=int, default=4, help="IMAP connections per account")
+    parser.add_argument('--batch-messages', type=int, default=50, help="messages per APPEND batch")
+    parser.add_argument('--default-folder', default=DEFAULT_FOLDER, help="folder for messages with no folder label")
+    parser.add_argument('--skip-label', action='append', default=[], help="do not upload messages with this label (repeatable)")
+    args = parser.parse_args()
+
+    ssl_context = None
+    if args.ssl:
+        ssl_context = ssl.create_default_context()
+        if args.insecure:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+    port = args.port or (993 if args.ssl else 143)
+    password = args.password or os.environ.get('IMAP_PASSWORD', '')
+    if args.accounts:
+        accounts = read_accounts(args.accounts)
+    elif args.source and args.user:
+        accounts = [(args.source, args.user, password)]
+    else:
+        parser.error("source and --user are required unless --accounts is given")
+
+    options = dict(port=port, ssl_context=ssl_context, master_user=args.master_user, connections=args.connections,
+                   batch_messages=args.batch_messages, default_folder=args.default_folder, skip_labels=args.skip_label)
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel_users) as executor:
+        futures = {executor.submit(upload_mailbox, source, args.host, login, account_password or password, **options): login
+                   for source, login, account_password in accounts}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                failed += future.result().get('failed')
+            except (ImapError, OSError) as e:
+                print(f"Error uploading to {futures[future]}: {e}")
+                failed += 1
+    sys.exit(1 if failed else 0)
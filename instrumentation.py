@@ -0,0 +1,365 @@
+'''
+This software is Copyright (c) 2024 Theodore Jones Information Technology Consulting
+(a DBA of Blueprint Cyber Solutions LLC)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to elsewhere, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# Stage timing and progress metrics shared by the migration tools. A tool marks each unit of
+# work (an archive, a mailbox, a user's import) as a stage; every stage's wall and CPU time,
+# messages, bytes and errors can be written as JSON-lines progress events and as a file for
+# the Prometheus node_exporter textfile collector. Nothing is written unless configure() is
+# called, and the optional sampling profiler only runs when asked for.
+
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROGRESS_INTERVAL = 10.0
+PROFILE_INTERVAL = 0.005
+METRIC_PREFIX = 'groupware_migration_stage'
+# Prometheus counters: (name, help text, key of the stage totals)
+COUNTERS = (
+    ('runs_total', 'Stages finished.', 'runs'),
+    ('seconds_total', 'Wall-clock seconds spent in the stage.', 'seconds'),
+    ('cpu_seconds_total', 'CPU seconds of the stage, including child processes it waited for.', 'cpu_seconds'),
+    ('messages_total', 'Messages processed.', 'messages'),
+    ('bytes_total', 'Bytes processed.', 'bytes'),
+    ('errors_total', 'Errors recorded.', 'errors'),
+)
+
+def cpu_seconds():
+    """
+    CPU time of the calling thread plus all reaped child processes.
+    """
+    if resource is None:
+        return time.thread_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.thread_time() + children.ru_utime + children.ru_stime
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Stage:
+    """
+    One running unit of work. add() and update() record progress, error() counts
+    failures; finish() (or leaving the with block) records the totals. With
+    total_bytes or total_messages, progress events also carry a percentage and ETA.
+    """
+    def __init__(self, metrics, name, labels, total_bytes=None, total_messages=None):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.total_bytes = total_bytes
+        self.total_messages = total_messages
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+        self.counts = {}
+        self.started = self.last_report = time.monotonic()
+        self.cpu_started = cpu_seconds()
+        self.cpu = None
+        self.status = None
+
+    def add(self, messages=0, bytes=0, **counts):
+        with self.lock:
+            self.messages += messages
+            self.bytes += bytes
+            for name, count in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + count
+        self.progress()
+
+    def update(self, messages=None, bytes=None):
+        """
+        Sets the messages and bytes processed so far, for loops that keep their own totals.
+        """
+        with self.lock:
+            if messages is not None:
+                self.messages = messages
+            if bytes is not None:
+                self.bytes = bytes
+        self.progress()
+
+    def error(self, message=None, count=1):
+        with self.lock:
+            self.errors += count
+        self.metrics.report(self, 'error', error=message, count=count)
+
+    def progress(self):
+        now = time.monotonic()
+        if now - self.last_report >= self.metrics.progress_interval:
+            self.last_report = now
+            self.metrics.report(self, 'progress')
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            values = {'elapsed': round(elapsed, 3), 'messages': self.messages, 'bytes': self.bytes, 'errors': self.errors}
+            if self.messages:
+                values['messages_per_s'] = round(self.messages / max(elapsed, 1e-6), 1)
+            if self.bytes:
+                values['bytes_per_s'] = round(self.bytes / max(elapsed, 1e-6))
+            values.update(self.counts)
+            done, total = (self.bytes, self.total_bytes) if self.total_bytes else (self.messages, self.total_messages)
+        if self.cpu is not None:
+            values['cpu_seconds'] = round(self.cpu, 3)
+        if total:
+            values['percent'] = round(100 * done / total, 1)
+            if 0 < done < total:
+                values['eta_seconds'] = round(elapsed * (total - done) / done)
+        return values
+
+    def finish(self, status='completed', cpu=None):
+        """
+        Records the stage as done. cpu overrides the measured CPU seconds, for work done by
+        a child process that was not waited for by this thread.
+        """
+        if self.status is not None:
+            return
+        self.cpu = cpu if cpu is not None else max(cpu_seconds() - self.cpu_started, 0.0)
+        self.status = status
+        self.metrics.finish_stage(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        elif issubclass(exc_type, Exception):
+            self.error(f"{exc_type.__name__}: {exc}")
+            self.finish('failed')
+        else:
+            self.finish('interrupted')
+        return False
+
+class Metrics:
+    """
+    Collects the stages of one tool run and writes them out: an event per stage start,
+    end, error and (every progress_interval seconds) progress to events_path, and running
+    totals per stage name to prometheus_path.
+    """
+    def __init__(self, tool=None, events_path=None, prometheus_path=None, progress_interval=PROGRESS_INTERVAL):
+        self.tool = tool
+        self.events = open(events_path, 'a', buffering=1) if events_path else None
+        self.prometheus_path = prometheus_path
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.active = set()
+        self.last_write = 0.0
+
+    def stage(self, name, total_bytes=None, total_messages=None, **labels):
+        stage = Stage(self, name, labels, total_bytes, total_messages)
+        with self.lock:
+            self.active.add(stage)
+        self.report(stage, 'stage_start')
+        return stage
+
+    def report(self, stage, kind, **fields):
+        if self.events is not None:
+            event = {'time': round(time.time(), 3), 'tool': self.tool, 'event': kind, 'stage': stage.name}
+            event.update(stage.labels)
+            event.update(stage.snapshot())
+            event.update((key, value) for key, value in fields.items() if value is not None)
+            if stage.status is not None:
+                event['status'] = stage.status
+            line = json.dumps(event, default=str) + '\n'
+            with self.lock:
+                self.events.write(line)
+        if kind == 'progress':
+            self.write_prometheus()
+
+    def finish_stage(self, stage):
+        with self.lock:
+            self.active.discard(stage)
+            totals = self.totals.setdefault(stage.name, {'runs': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'messages': 0,
+                                                         'bytes': 0, 'errors': 0, 'counts': {}})
+            totals['runs'] += 1
+            totals['seconds'] += time.monotonic() - stage.started
+            totals['cpu_seconds'] += stage.cpu
+            totals['messages'] += stage.messages
+            totals['bytes'] += stage.bytes
+            totals['errors'] += stage.errors
+            for name, count in stage.counts.items():
+                totals['counts'][name] = totals['counts'].get(name, 0) + count
+        self.report(stage, 'stage_end')
+        self.write_prometheus()
+
+    def write_prometheus(self, force=False):
+        """
+        Rewrites the textfile, at most once per progress_interval unless forced. Counters
+        include the progress of stages still running, so they grow during long stages.
+        """
+        now = time.monotonic()
+        if not self.prometheus_path or (not force and now - self.last_write < self.progress_interval):
+            return
+        self.last_write = now
+        with self.lock:
+            totals = {name: dict(values, counts=dict(values['counts'])) for name, values in self.totals.items()}
+            active = list(self.active)
+        running = {}
+        for stage in active:
+            values = totals.setdefault(stage.name, {'runs': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'messages': 0,
+                                                    'bytes': 0, 'errors': 0, 'counts': {}})
+            running[stage.name] = running.get(stage.name, 0) + 1
+            with stage.lock:
+                values['seconds'] += now - stage.started
+                values['messages'] += stage.messages
+                values['bytes'] += stage.bytes
+                values['errors'] += stage.errors
+                for name, count in stage.counts.items():
+                    values['counts'][name] = values['counts'].get(name, 0) + count
+
+        tool = escape_label(self.tool or os.path.basename(sys.argv[0]))
+        lines = []
+        for suffix, help_text, key in COUNTERS:
+            lines.append(f"# HELP {METRIC_PREFIX}_{suffix} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{suffix} counter")
+            for name, values in sorted(totals.items()):
+                lines.append(f'{METRIC_PREFIX}_{suffix}{{tool="{tool}",stage="{escape_label(name)}"}} {values[key]}')
+        lines.append(f"# HELP {METRIC_PREFIX}_items_total Other items counted by the stage, by kind.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_items_total counter")
+        for name, values in sorted(totals.items()):
+            for kind, count in sorted(values['counts'].items()):
+                lines.append(f'{METRIC_PREFIX}_items_total{{tool="{tool}",stage="{escape_label(name)}",'
+                             f'kind="{escape_label(kind)}"}} {count}')
+        lines.append(f"# HELP {METRIC_PREFIX}_running Stages currently running.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_running gauge")
+        for name in sorted(totals):
+            lines.append(f'{METRIC_PREFIX}_running{{tool="{tool}",stage="{escape_label(name)}"}} {running.get(name, 0)}')
+        lines.append(f"# HELP {METRIC_PREFIX}_last_update_seconds Unix time these metrics were written.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_last_update_seconds gauge")
+        lines.append(f'{METRIC_PREFIX}_last_update_seconds{{tool="{tool}"}} {time.time():.3f}')
+
+        # The collector may read at any moment, so the file is replaced in one step
+        temp_path = f"{self.prometheus_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.prometheus_path)
+
+    def close(self):
+        with self.lock:
+            active = list(self.active)
+        for stage in active:
+            stage.finish('interrupted')
+        self.write_prometheus(force=True)
+        if self.events is not None:
+            with self.lock:
+                self.events.close()
+                self.events = None
+
+class SamplingProfiler:
+    """
+    Samples the stack of every other thread each interval seconds and writes the counts
+    as folded stacks ('thread;outer;...;inner count' per line), which flamegraph.pl and
+    speedscope read. Only threads of this process are sampled, not pool worker processes.
+    """
+    def __init__(self, path, interval=PROFILE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.samples = {}
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        with open(self.path, 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+        print(f"Wrote {sum(self.samples.values())} profile samples to {self.path}")
+
+_metrics = Metrics()
+_profiler = None
+
+def configure(tool, events_path=None, prometheus_path=None, progress_interval=PROGRESS_INTERVAL,
+              profile_path=None, profile_interval=PROFILE_INTERVAL):
+    """
+    Starts writing this process's stages to events_path and prometheus_path, and
+    profiling to profile_path; everything is flushed when the process exits.
+    """
+    global _metrics, _profiler
+    _metrics = Metrics(tool, events_path, prometheus_path, progress_interval)
+    if profile_path:
+        _profiler = SamplingProfiler(profile_path, profile_interval)
+        _profiler.start()
+    atexit.register(close)
+
+def stage(name, total_bytes=None, total_messages=None, **labels):
+    """
+    Starts a stage of the configured tool; use it as a context manager or call finish().
+    """
+    return _metrics.stage(name, total_bytes, total_messages, **labels)
+
+def timed(name):
+    """
+    Decorator that runs every call of a function as a stage named name.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _metrics.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def close():
+    global _profiler
+    if _profiler is not None:
+        _profiler.stop()
+        _profiler = None
+    _metrics.close()
+
+def add_arguments(parser):
+    group = parser.add_argument_group('instrumentation')
+    group.add_argument('--events', metavar='FILE', help="append JSON-lines progress events to this file")
+    group.add_argument('--metrics-textfile', metavar='FILE',
+                       help="keep per-stage metrics in this file for the Prometheus textfile collector (*.prom)")
+    group.add_argument('--metrics-interval', type=float, default=PROGRESS_INTERVAL,
+                       help="seconds between progress events and metrics file updates")
+    group.add_argument('--profile', metavar='FILE', help="sample stacks while running and write folded stacks to this file")
+    group.add_argument('--profile-interval', type=float, default=PROFILE_INTERVAL, help="seconds between profile samples")
+
+def configure_from_args(tool, args):
+    if args.events or args.metrics_textfile or args.profile:
+        configure(tool, args.events, args.metrics_textfile, args.metrics_interval, args.profile, args.profile_interval)
@@ -1,11 +1,29 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
 import mailbox
+import mmap
+import os
 import re
+import sqlite3
+
+import instrumentation
 
 # Configure your search pattern and file paths here
 pattern = re.compile(r'hello@aspirelosangeles.com', re.IGNORECASE)
 input_mbox_path = '/root/letty.mbox'  # Update this to your mbox file path
 output_mbox_path = '/root/output.mbox'  # The path where you want to save matching emails
 
+# A message starts at every line beginning with 'From ' (body lines are quoted as '>From ')
+FROM_SEPARATOR = b'\nFrom '
+# Matches one (possibly folded) header field at the start of a line
+HEADER_FIELD = re.compile(rb'^([!-9;-~]+):[ \t]*(.*(?:\r?\n[ \t].*)*)', re.MULTILINE)
+# Scanned pages are handed back to the kernel every this many bytes
+RELEASE_INTERVAL = 64 * 1024 * 1024
+# Single-process loops report their progress every this many messages
+PROGRESS_MESSAGES = 10000
+
 def extract_emails(input_path, output_path, search_pattern):
     # Open the existing mbox file
     print("Opening the Mbox")
@@ -17,19 +35,693 @@ def extract_emails(input_path, output_path, search_pattern):
     # Iterate through messages in the mbox
     print("Starting to Iterate Through the Messages")
     first_msg = 0
+    stage = instrumentation.stage('extract_legacy', input=input_path)
     for message in mbox:
         if first_msg == 0:
-           print("First Message") 
-           first_msg = 1
-	try:
-           # Convert message to string and search for the pattern
-           if search_pattern.search(message.as_string()):
-            # If the pattern is found, add the message to the output mbox
-            output_mbox.add(message)
+            print("First Message")
+            first_msg = 1
+        try:
+            # Convert message to string and search for the pattern
+            if search_pattern.search(message.as_string()):
+                # If the pattern is found, add the message to the output mbox
+                output_mbox.add(message)
+                stage.add(matched=1)
+        except Exception as e:
+            stage.error(str(e))
+            print(f"Error processing message: {e}")
+        stage.add(messages=1)
 
     # Close and flush the output mbox to save it
     output_mbox.flush()
     output_mbox.close()
+    mbox.close()
+    stage.finish()
+
+def to_bytes_pattern(search_pattern):
+    """
+    Returns a bytes version of a compiled pattern so it can run against raw message bytes.
+    """
+    if isinstance(search_pattern.pattern, bytes):
+        return search_pattern
+    return re.compile(search_pattern.pattern.encode('utf-8'), search_pattern.flags & ~re.UNICODE)
+
+def open_mbox_map(path):
+    """
+    Memory-maps an mbox file read-only. Returns None for an empty file, which cannot be mapped.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        data.madvise(mmap.MADV_SEQUENTIAL)
+    return data
+
+def release_scanned(data, released, position):
+    """
+    Drops pages below position from the mapping once enough have been scanned,
+    so resident memory stays flat however large the mbox is. Returns the new release mark.
+    """
+    if position - released < RELEASE_INTERVAL or not hasattr(mmap, 'MADV_DONTNEED'):
+        return released
+    upto = position - position % mmap.PAGESIZE
+    data.madvise(mmap.MADV_DONTNEED, released, upto - released)
+    return upto
+
+def iter_message_spans(data, start=0, end=None):
+    """
+    Yields (start, end) byte offsets of every message that begins in data[start:end].
+    A message runs up to the next 'From ' separator line, which may lie past end.
+    Anything before the first separator is skipped, as mailbox.mbox does.
+    """
+    size = len(data)
+    if end is None:
+        end = size
+    if start == 0 and data[0:5] == b'From ':
+        msg_start = 0
+    else:
+        idx = data.find(FROM_SEPARATOR, max(start - 1, 0))
+        if idx < 0:
+            return
+        msg_start = idx + 1
+    while msg_start < end:
+        idx = data.find(FROM_SEPARATOR, msg_start)
+        msg_end = size if idx < 0 else idx + 1
+        yield msg_start, msg_end
+        msg_start = msg_end
+
+def find_header_end(data, start, end):
+    """
+    Returns the offset just past the blank line that ends a message's headers,
+    or end if the message has no body.
+    """
+    candidates = [idx for idx in (data.find(b'\n\n', start, end), data.find(b'\n\r\n', start, end)) if idx >= 0]
+    if not candidates:
+        return end
+    return min(candidates) + 1
+
+def parse_raw_headers(header_bytes, names):
+    """
+    Returns the unfolded values of the wanted header fields (lower-case names) of a raw header block.
+    Only the first occurrence of each field is kept.
+    """
+    values = {}
+    for match in HEADER_FIELD.finditer(header_bytes):
+        name = match.group(1).decode('ascii').lower()
+        if name in names and name not in values:
+            value = re.sub(rb'\r?\n[ \t]+', b' ', match.group(2)).strip()
+            values[name] = value.decode('utf-8', errors='replace')
+    return values
+
+def write_message(output, data, start, end):
+    """
+    Copies one message's bytes unchanged to an open output mbox.
+    """
+    with memoryview(data) as view:
+        output.write(view[start:end])
+    # The last message of a file may lack its trailing newline; keep the next separator on its own line
+    if data[end - 1:end] != b'\n':
+        output.write(b'\n')
+
+def iter_stream_messages(f, chunk_size=1024 * 1024):
+    """
+    Yields the raw bytes of each message read from a sequential mbox stream, such as a
+    file that cannot be memory-mapped or mail streamed out of Takeout zips.
+    Only the message being read is held in memory.
+    """
+    buffer = bytearray()
+    msg_start = None
+    search_from = 0
+    eof = False
+    while not eof:
+        chunk = f.read(chunk_size)
+        if chunk:
+            buffer += chunk
+        else:
+            eof = True
+        if msg_start is None:
+            if buffer[0:5] == b'From ':
+                msg_start = 0
+            else:
+                idx = buffer.find(FROM_SEPARATOR)
+                if idx < 0:
+                    # Nothing but text before the first message so far
+                    del buffer[:max(0, len(buffer) - len(FROM_SEPARATOR))]
+                    continue
+                msg_start = idx + 1
+            search_from = msg_start
+        while True:
+            idx = buffer.find(FROM_SEPARATOR, search_from)
+            if idx < 0:
+                break
+            yield bytes(buffer[msg_start:idx + 1])
+            msg_start = search_from = idx + 1
+        if eof:
+            if msg_start < len(buffer):
+                yield bytes(buffer[msg_start:])
+            return
+        del buffer[:msg_start]
+        msg_start = 0
+        search_from = max(0, len(buffer) - len(FROM_SEPARATOR) + 1)
+
+def scan_stream(f, output_path, search_pattern, headers_only=False):
+    """
+    Like scan_emails, for an mbox read sequentially from a file object.
+    """
+    raw_pattern = to_bytes_pattern(search_pattern)
+    total = 0
+    matched = 0
+    size = 0
+    with open(output_path, 'ab') as output, instrumentation.stage('scan') as stage:
+        for message in iter_stream_messages(f):
+            total += 1
+            size += len(message)
+            limit = find_header_end(message, 0, len(message)) if headers_only else len(message)
+            if raw_pattern.search(message, 0, limit):
+                write_message(output, message, 0, len(message))
+                matched += 1
+            if not total % PROGRESS_MESSAGES:
+                stage.update(messages=total, bytes=size)
+        stage.update(messages=total, bytes=size)
+        stage.add(matched=matched)
+    print(f"Scanned {total} messages, {matched} matched")
+    return matched
+
+def shard_ranges(data, shards):
+    """
+    Splits an mbox buffer into up to `shards` byte ranges of similar size,
+    each starting on a 'From ' separator line.
+    """
+    size = len(data)
+    bounds = [0]
+    for i in range(1, shards):
+        idx = data.find(FROM_SEPARATOR, max(size * i // shards - 1, bounds[-1]))
+        if idx < 0:
+            break
+        if idx + 1 > bounds[-1]:
+            bounds.append(idx + 1)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def iter_matching_spans(data, raw_pattern, headers_only=False, start=0, end=None):
+    """
+    Yields (start, end, matched) for every message beginning in data[start:end].
+    """
+    released = start - start % mmap.PAGESIZE
+    for msg_start, msg_end in iter_message_spans(data, start, end):
+        limit = find_header_end(data, msg_start, msg_end) if headers_only else msg_end
+        yield msg_start, msg_end, raw_pattern.search(data, msg_start, limit) is not None
+        released = release_scanned(data, released, msg_start)
+
+def scan_shard(input_path, start, end, raw_pattern, headers_only):
+    """
+    Process pool worker: scans one shard and returns its message count and matching spans.
+    """
+    data = open_mbox_map(input_path)
+    total = 0
+    matches = []
+    try:
+        for msg_start, msg_end, matched in iter_matching_spans(data, raw_pattern, headers_only, start, end):
+            total += 1
+            if matched:
+                matches.append((msg_start, msg_end))
+    finally:
+        data.close()
+    return total, matches
+
+def scan_emails(input_path, output_path, search_pattern, headers_only=False, workers=1):
+    """
+    Scans the raw bytes of an mbox without parsing it and appends every message
+    matching search_pattern, byte for byte, to output_path.
+    With workers > 1 the file is split into shards scanned by a process pool;
+    matches are still written in their original order.
+    """
+    raw_pattern = to_bytes_pattern(search_pattern)
+    print(f"Scanning {input_path}")
+    data = open_mbox_map(input_path)
+    total = 0
+    matched = 0
+    with open(output_path, 'ab') as output, \
+            instrumentation.stage('scan', total_bytes=len(data) if data is not None else 0, input=input_path) as stage:
+        if data is not None:
+            try:
+                if workers > 1:
+                    # A few shards per worker keeps the pool busy when match density is uneven
+                    ranges = shard_ranges(data, workers * 4)
+                    print(f"Scanning {len(ranges)} shards with {workers} workers")
+                    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                        futures = [executor.submit(scan_shard, input_path, start, end, raw_pattern, headers_only)
+                                   for start, end in ranges]
+                        for future, (shard_start, shard_end) in zip(futures, ranges):
+                            shard_total, spans = future.result()
+                            total += shard_total
+                            for start, end in spans:
+                                write_message(output, data, start, end)
+                            matched += len(spans)
+                            stage.add(messages=shard_total, bytes=shard_end - shard_start, matched=len(spans))
+                else:
+                    for start, end, is_match in iter_matching_spans(data, raw_pattern, headers_only):
+                        total += 1
+                        if is_match:
+                            write_message(output, data, start, end)
+                            matched += 1
+                        if not total % PROGRESS_MESSAGES:
+                            stage.update(messages=total, bytes=end)
+                    stage.update(messages=total, bytes=len(data))
+                    stage.add(matched=matched)
+            finally:
+                data.close()
+    print(f"Scanned {total} messages, {matched} matched")
+    return matched
+
+# Sidecar index of message offsets and common headers, stored next to the mbox
+INDEX_SUFFIX = '.index.sqlite'
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS source (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    head_digest TEXT NOT NULL,
+    tail_digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    offset INTEGER PRIMARY KEY,
+    length INTEGER NOT NULL,
+    message_id TEXT,
+    from_header TEXT,
+    to_header TEXT,
+    cc_header TEXT,
+    date TEXT,
+    subject TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_message_id ON messages (message_id);
+CREATE TABLE IF NOT EXISTS addresses (
+    address TEXT NOT NULL,
+    field TEXT NOT NULL,
+    offset INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS addresses_address ON addresses (address, field);
+'''
+# Bumped whenever INDEX_SCHEMA changes; older index files are rebuilt
+INDEX_VERSION = 2
+INDEX_HEADERS = ('message-id', 'from', 'to', 'cc', 'date', 'subject')
+# Query field name -> index columns searched
+INDEX_FIELDS = {
+    'address': ('from_header', 'to_header', 'cc_header'),
+    'message-id': ('message_id',),
+    'from': ('from_header',),
+    'to': ('to_header',),
+    'cc': ('cc_header',),
+    'date': ('date',),
+    'subject': ('subject',),
+}
+# Header fields whose addresses go into the addresses table, by their position in an index row
+ADDRESS_COLUMNS = {'from': 3, 'to': 4, 'cc': 5}
+ADDRESS_TEXT = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+# A --pattern without regex syntax is looked up exactly instead of searched
+MESSAGE_ID_LITERAL = re.compile(r'^<?[^\s<>()\[\]{}*?|^$\\]+>?$')
+INDEX_DIGEST_BYTES = 64 * 1024
+INDEX_COMMIT_ROWS = 50000
+
+def region_digest(data, start, end):
+    start = max(start, 0)
+    if data is None or start >= end:
+        return ''
+    return hashlib.sha1(data[start:end]).hexdigest()
+
+def index_rows(data, start):
+    for msg_start, msg_end in iter_message_spans(data, start):
+        headers = parse_raw_headers(data[msg_start:find_header_end(data, msg_start, msg_end)], INDEX_HEADERS)
+        yield (msg_start, msg_end - msg_start) + tuple(headers.get(name) for name in INDEX_HEADERS)
+
+def address_rows(values):
+    """
+    Returns the (address, field, offset) rows of one index row's From, To and Cc addresses.
+    """
+    rows = set()
+    for field, column in ADDRESS_COLUMNS.items():
+        if values[column]:
+            rows.update((address.lower(), field, values[0]) for address in ADDRESS_TEXT.findall(values[column]))
+    return rows
+
+def update_index(mbox_path, index_path=None):
+    """
+    Creates or refreshes the sidecar header index of an mbox and returns an open connection to it.
+    If the file only grew since the last run, just the new messages are indexed;
+    any other change in size or mtime rebuilds the index from scratch.
+    """
+    conn = sqlite3.connect(index_path or mbox_path + INDEX_SUFFIX)
+    if conn.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+        conn.executescript('DROP TABLE IF EXISTS source; DROP TABLE IF EXISTS messages; DROP TABLE IF EXISTS addresses;')
+        conn.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+    conn.executescript(INDEX_SCHEMA)
+    stat = os.stat(mbox_path)
+    row = conn.execute('SELECT size, mtime_ns, head_digest, tail_digest FROM source').fetchone()
+    if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+        return conn
+
+    data = open_mbox_map(mbox_path)
+    try:
+        resume = 0
+        if row is not None and data is not None and stat.st_size > row[0]:
+            old_size, _, head, tail = row
+            if (region_digest(data, 0, min(old_size, INDEX_DIGEST_BYTES)) == head
+                    and region_digest(data, old_size - INDEX_DIGEST_BYTES, old_size) == tail):
+                # Appended to: re-index from the last known message, which may have grown
+                last = conn.execute('SELECT MAX(offset) FROM messages').fetchone()[0]
+                resume = last or 0
+        if resume:
+            print(f"Updating index of {mbox_path} from offset {resume}")
+        else:
+            print(f"Building index of {mbox_path}")
+        conn.execute('DELETE FROM messages WHERE offset >= ?', (resume,))
+        conn.execute('DELETE FROM addresses WHERE offset >= ?', (resume,))
+        count = 0
+        stage = instrumentation.stage('index', input=mbox_path)
+        if data is not None:
+            insert = 'INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+            insert_address = 'INSERT INTO addresses VALUES (?, ?, ?)'
+            released = resume - resume % mmap.PAGESIZE
+            batch = []
+            addresses = []
+            for values in index_rows(data, resume):
+                batch.append(values)
+                addresses.extend(address_rows(values))
+                if len(batch) == INDEX_COMMIT_ROWS:
+                    conn.executemany(insert, batch)
+                    conn.executemany(insert_address, addresses)
+                    conn.commit()
+                    count += len(batch)
+                    batch = []
+                    addresses = []
+                    released = release_scanned(data, released, values[0])
+                    stage.update(messages=count, bytes=values[0] - resume)
+            conn.executemany(insert, batch)
+            conn.executemany(insert_address, addresses)
+            count += len(batch)
+            stage.update(messages=count, bytes=len(data) - resume)
+        conn.execute('DELETE FROM source')
+        conn.execute('INSERT INTO source VALUES (1, ?, ?, ?, ?)', (
+            stat.st_size, stat.st_mtime_ns,
+            region_digest(data, 0, min(stat.st_size, INDEX_DIGEST_BYTES)),
+            region_digest(data, stat.st_size - INDEX_DIGEST_BYTES, stat.st_size)))
+        conn.commit()
+        stage.finish()
+        print(f"Indexed {count} messages")
+    finally:
+        if data is not None:
+            data.close()
+    return conn
+
+def query_index(conn, search_pattern, field='address'):
+    """
+    Returns the (offset, length) of every indexed message whose field matches search_pattern, in file order.
+    A pattern that is a bare address (for address fields) or a bare Message-ID is looked up
+    exactly through the table indexes; anything else is searched as a regex in every row.
+    """
+    text = search_pattern.pattern
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', errors='replace')
+    if field in ('address', 'from', 'to', 'cc') and ADDRESS_RULE.match(text):
+        fields = tuple(ADDRESS_COLUMNS) if field == 'address' else (field,)
+        return conn.execute(
+            'SELECT DISTINCT m.offset, m.length FROM addresses a JOIN messages m ON m.offset = a.offset '
+            f'WHERE a.address = ? AND a.field IN ({", ".join("?" * len(fields))}) ORDER BY m.offset',
+            (text.lower(),) + fields).fetchall()
+    if field == 'message-id' and MESSAGE_ID_LITERAL.match(text):
+        message_id = text.strip('<>')
+        return conn.execute('SELECT offset, length FROM messages WHERE message_id IN (?, ?) ORDER BY offset',
+                            (message_id, f'<{message_id}>')).fetchall()
+    conn.create_function('pattern_matches', 1, lambda value: value is not None and search_pattern.search(value) is not None)
+    where = ' OR '.join(f'pattern_matches({column})' for column in INDEX_FIELDS[field])
+    return conn.execute(f'SELECT offset, length FROM messages WHERE {where} ORDER BY offset').fetchall()
+
+def extract_indexed(input_path, output_path, search_pattern, field='address'):
+    """
+    Copies messages whose indexed header field matches search_pattern, seeking
+    straight to them through the sidecar index instead of scanning the mbox.
+    """
+    conn = update_index(input_path)
+    try:
+        spans = query_index(conn, search_pattern, field)
+    finally:
+        conn.close()
+    data = open_mbox_map(input_path)
+    with open(output_path, 'ab') as output, instrumentation.stage('extract_indexed', input=input_path) as stage:
+        if data is not None:
+            try:
+                for offset, length in spans:
+                    write_message(output, data, offset, offset + length)
+            finally:
+                data.close()
+        stage.add(messages=len(spans), bytes=sum(length for offset, length in spans))
+    print(f"Found {len(spans)} matching messages in the index")
+    return len(spans)
+
+# A routing rule that is a bare address is matched by address lookup instead of regex search
+# ASCII only, like ADDRESS_TOKEN; other addresses are routed as regex rules
+ADDRESS_RULE = re.compile(r'^[\w.+-]+@[\w-]+(\.[\w-]+)+$', re.ASCII)
+ADDRESS_TOKEN = re.compile(rb'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+
+def load_rules(rules_path):
+    """
+    Reads a routing rules file: one '<pattern or address><TAB><output mbox>' per line.
+    Blank lines and lines starting with '#' are ignored.
+    """
+    rules = []
+    with open(rules_path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split('\t') if '\t' in line else line.rsplit(None, 1)
+            if len(parts) != 2:
+                raise ValueError(f"{rules_path}:{line_number}: expected '<pattern><TAB><output mbox>'")
+            rules.append((parts[0].strip(), parts[1].strip()))
+    return rules
+
+class MessageRouter:
+    """
+    Evaluates many routing rules against a message in one pass.
+    Address rules are looked up in a dict from every address token found in the message;
+    the remaining regex rules share one combined pattern that rules out most messages
+    before the individual patterns are tried.
+    """
+    def __init__(self, rules):
+        self.outputs = []
+        self.address_targets = {}
+        self.pattern_targets = []
+        output_ids = {}
+        for rule, output in rules:
+            target = output_ids.setdefault(output, len(output_ids))
+            if target == len(self.outputs):
+                self.outputs.append(output)
+            if ADDRESS_RULE.match(rule):
+                self.address_targets.setdefault(rule.lower().encode('ascii'), set()).add(target)
+            else:
+                self.pattern_targets.append((re.compile(rule.encode('utf-8'), re.IGNORECASE), target))
+        self.combined = None
+        if self.pattern_targets:
+            self.combined = re.compile(b'|'.join(b'(?:' + p.pattern + b')' for p, _ in self.pattern_targets), re.IGNORECASE)
+
+    def route(self, data, start, end):
+        """
+        Returns the set of output indexes whose rules match data[start:end].
+        """
+        targets = set()
+        if self.address_targets:
+            for token in set(ADDRESS_TOKEN.findall(data, start, end)):
+                matched = self.address_targets.get(token.lower())
+                if matched:
+                    targets |= matched
+        if self.combined is not None and self.combined.search(data, start, end):
+            for rule_pattern, target in self.pattern_targets:
+                if target not in targets and rule_pattern.search(data, start, end):
+                    targets.add(target)
+        return targets
+
+    def iter_routes(self, data, headers_only=False, start=0, end=None):
+        """
+        Yields (start, end, targets) for every message beginning in data[start:end].
+        """
+        released = start - start % mmap.PAGESIZE
+        for msg_start, msg_end in iter_message_spans(data, start, end):
+            limit = find_header_end(data, msg_start, msg_end) if headers_only else msg_end
+            yield msg_start, msg_end, self.route(data, msg_start, limit)
+            released = release_scanned(data, released, msg_start)
+
+class MboxWriterPool:
+    """
+    Buffers appends to many output mbox files, keeping at most max_open handles open at a time.
+    """
+    def __init__(self, max_open=64, buffer_size=256 * 1024):
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.buffers = {}
+        self.handles = collections.OrderedDict()
+
+    def write(self, path, chunk):
+        buffer = self.buffers.setdefault(path, bytearray())
+        buffer += chunk
+        if len(buffer) >= self.buffer_size:
+            self.flush_path(path)
+
+    def write_message(self, path, data, start, end):
+        self.write(path, data[start:end])
+        if data[end - 1:end] != b'\n':
+            self.write(path, b'\n')
+
+    def flush_path(self, path):
+        buffer = self.buffers.get(path)
+        if not buffer:
+            return
+        handle = self.handles.pop(path, None)
+        if handle is None:
+            if len(self.handles) >= self.max_open:
+                _, oldest = self.handles.popitem(last=False)
+                oldest.close()
+            handle = open(path, 'ab')
+        # Re-inserting keeps the handles in least recently used order
+        self.handles[path] = handle
+        handle.write(buffer)
+        buffer.clear()
+
+    def close(self):
+        for path in list(self.buffers):
+            self.flush_path(path)
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+def route_shard(input_path, start, end, router, headers_only):
+    """
+    Process pool worker: routes one shard and returns its message count and the routed spans.
+    """
+    data = open_mbox_map(input_path)
+    total = 0
+    routed = []
+    try:
+        for msg_start, msg_end, targets in router.iter_routes(data, headers_only, start, end):
+            total += 1
+            if targets:
+                routed.append((msg_start, msg_end, sorted(targets)))
+    finally:
+        data.close()
+    return total, routed
+
+def route_emails(input_path, rules, headers_only=False, workers=1, max_open=64):
+    """
+    Splits one mbox into many in a single pass: every message is appended, byte for byte,
+    to the output of every rule it matches. rules is a list of (pattern or address, output path).
+    """
+    router = MessageRouter(rules)
+    print(f"Routing {input_path} to {len(router.outputs)} outputs")
+    counts = [0] * len(router.outputs)
+    total = 0
+    pool = MboxWriterPool(max_open=max_open)
+    data = open_mbox_map(input_path)
+    stage = instrumentation.stage('route', total_bytes=len(data) if data is not None else 0, input=input_path)
+    try:
+        if data is not None:
+            if workers > 1:
+                ranges = shard_ranges(data, workers * 4)
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(route_shard, input_path, start, end, router, headers_only)
+                               for start, end in ranges]
+                    for future, (shard_start, shard_end) in zip(futures, ranges):
+                        shard_total, routed = future.result()
+                        total += shard_total
+                        for start, end, targets in routed:
+                            for target in targets:
+                                pool.write_message(router.outputs[target], data, start, end)
+                                counts[target] += 1
+                        stage.add(messages=shard_total, bytes=shard_end - shard_start)
+            else:
+                for start, end, targets in router.iter_routes(data, headers_only):
+                    total += 1
+                    for target in targets:
+                        pool.write_message(router.outputs[target], data, start, end)
+                        counts[target] += 1
+                    if not total % PROGRESS_MESSAGES:
+                        stage.update(messages=total, bytes=end)
+                stage.update(messages=total, bytes=len(data))
+    finally:
+        pool.close()
+        if data is not None:
+            data.close()
+        stage.add(routed=sum(counts))
+        stage.finish()
+    print(f"Routed {total} messages")
+    for output, count in zip(router.outputs, counts):
+        print(f"{output}: {count} messages")
+    return dict(zip(router.outputs, counts))
+
+def route_stream(f, rules, headers_only=False, max_open=64):
+    """
+    Like route_emails, for an mbox read sequentially from a file object.
+    """
+    router = MessageRouter(rules)
+    counts = [0] * len(router.outputs)
+    total = 0
+    size = 0
+    pool = MboxWriterPool(max_open=max_open)
+    stage = instrumentation.stage('route')
+    try:
+        for message in iter_stream_messages(f):
+            total += 1
+            size += len(message)
+            limit = find_header_end(message, 0, len(message)) if headers_only else len(message)
+            for target in router.route(message, 0, limit):
+                pool.write_message(router.outputs[target], message, 0, len(message))
+                counts[target] += 1
+            if not total % PROGRESS_MESSAGES:
+                stage.update(messages=total, bytes=size)
+    finally:
+        pool.close()
+        stage.update(messages=total, bytes=size)
+        stage.add(routed=sum(counts))
+        stage.finish()
+    print(f"Routed {total} messages")
+    for output, count in zip(router.outputs, counts):
+        print(f"{output}: {count} messages")
+    return dict(zip(router.outputs, counts))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Copy messages matching a pattern from one mbox file to another.")
+    parser.add_argument('--input', default=input_mbox_path, help="mbox file to search")
+    parser.add_argument('--output', default=output_mbox_path, help="mbox file that matching messages are appended to")
+    parser.add_argument('--pattern', help="regular expression to search for (case-insensitive, defaults to the configured pattern)")
+    parser.add_argument('--headers-only', action='store_true', help="only search message headers")
+    parser.add_argument('--workers', type=int, default=1, help="number of processes scanning shards of the input in parallel")
+    parser.add_argument('--index-field', choices=sorted(INDEX_FIELDS),
+                        help="match this header field through the sidecar index (built or updated as needed) instead of scanning")
+    parser.add_argument('--rules', help="routing rules file ('<pattern or address><TAB><output mbox>' per line); "
+                                          "splits the input into every matching output in one pass")
+    parser.add_argument('--max-open-files', type=int, default=64, help="output files kept open at once when routing")
+    parser.add_argument('--zip', nargs='+', metavar='ZIP',
+                        help="read the Takeout/Mail mbox files straight out of these Takeout zips instead of --input")
+    parser.add_argument('--legacy', action='store_true', help="parse every message with the mailbox module instead of scanning raw bytes")
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
 
-# Run the function with the configured parameters
-extract_emails(input_mbox_path, output_mbox_path, pattern)
+if __name__ == '__main__':
+    args = parse_args()
+    instrumentation.configure_from_args('mbox_extract', args)
+    search_pattern = re.compile(args.pattern, re.IGNORECASE) if args.pattern else pattern
+    # Run the function with the configured parameters
+    if args.zip:
+        import takeout_mail_source
+        with takeout_mail_source.open_mail_stream(args.zip) as stream:
+            if args.rules:
+                route_stream(stream, load_rules(args.rules), headers_only=args.headers_only, max_open=args.max_open_files)
+            else:
+                scan_stream(stream, args.output, search_pattern, headers_only=args.headers_only)
+    elif args.legacy:
+        extract_emails(args.input, args.output, search_pattern)
+    elif args.rules:
+        route_emails(args.input, load_rules(args.rules), headers_only=args.headers_only,
+                     workers=args.workers, max_open=args.max_open_files)
+    elif args.index_field:
+        extract_indexed(args.input, args.output, search_pattern, args.index_field)
+    else:
+        scan_emails(args.input, args.output, search_pattern, headers_only=args.headers_only, workers=args.workers)
@@ -0,0 +1,225 @@
+'''
+This software is Copyright (c) 2024 Theodore Jones Information Technology Consulting
+(a DBA of Blueprint Cyber Solutions LLC)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to elsewhere, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# Converts a user's Takeout mbox files, as unrolled by takeout_unroll.py, straight into a
+# Maildir++ tree on the destination server's filesystem. Gmail labels become folders the
+# same way imap_upload.py maps them, and each mbox is split into shards converted in parallel.
+
+import argparse
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import itertools
+import os
+import socket
+import sys
+import time
+
+import imap_upload
+import mbox_extract
+
+# Maildir info flags, which must appear in ASCII order
+IMAP_FLAGS = {'\\Draft': 'D', '\\Flagged': 'F', '\\Answered': 'R', '\\Seen': 'S'}
+X_STATUS_FLAGS = {'A': 'R', 'F': 'F', 'T': 'D', 'D': 'T'}
+HEADER_NAMES = ('x-gmail-labels', 'date', 'status', 'x-status')
+BATCH_SIZE = 256
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    SYNCFS = _libc.syncfs
+except (OSError, AttributeError, TypeError):
+    SYNCFS = None
+
+def message_folder_flags(headers, default_folder=imap_upload.DEFAULT_FOLDER, skip_labels=()):
+    """
+    Returns (folders, maildir flags) of a message. Gmail messages are placed by their
+    X-Gmail-Labels; other mbox messages go to INBOX with flags from Status and X-Status.
+    """
+    labels = headers.get('x-gmail-labels')
+    if labels is None:
+        folders = ['INBOX']
+        flags = {'S'} if 'R' in headers.get('status', '') else set()
+    else:
+        # '.' separates Maildir++ folders, so it cannot appear inside a label's own name
+        labels = [label.replace('.', '_') for label in imap_upload.split_labels(labels)]
+        folders, imap_flags = imap_upload.label_folders(labels, '.', default_folder, skip_labels)
+        flags = {IMAP_FLAGS[flag] for flag in imap_flags}
+    flags.update(X_STATUS_FLAGS[char] for char in headers.get('x-status', '') if char in X_STATUS_FLAGS)
+    return folders, ''.join(sorted(flags))
+
+class MaildirWriter:
+    """
+    Delivers messages into a Maildir++ tree. Messages are written to tmp/ and, once a
+    batch of batch_size is complete, synced together, renamed into cur/ and made durable
+    with one fsync per folder directory. sync is 'syncfs' (one call for the whole batch),
+    'fdatasync' (each file of the batch) or 'none'.
+    """
+    def __init__(self, root, batch_size=BATCH_SIZE, sync='syncfs'):
+        self.root = root
+        self.batch_size = batch_size
+        self.sync = 'fdatasync' if sync == 'syncfs' and SYNCFS is None else sync
+        self.hostname = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+        self.unique = f"P{os.getpid()}R{os.urandom(4).hex()}"
+        self.counter = itertools.count()
+        self.folders = {}
+        self.pending = []
+        self.messages = 0
+        self.bytes = 0
+
+    def folder_path(self, folder):
+        path = self.folders.get(folder)
+        if path is None:
+            path = self.root if folder == 'INBOX' else os.path.join(self.root, '.' + imap_upload.encode_mailbox(folder))
+            for sub in ('cur', 'new', 'tmp'):
+                os.makedirs(os.path.join(path, sub), exist_ok=True)
+            if path != self.root:
+                open(os.path.join(path, 'maildirfolder'), 'a').close()
+            self.folders[folder] = path
+        return path
+
+    def add(self, folder, body, flags, received=None):
+        path = self.folder_path(folder)
+        received = received or time.time()
+        name = (f"{int(received)}.M{int(received % 1 * 1000000)}{self.unique}Q{next(self.counter)}."
+                f"{self.hostname},S={len(body)}")
+        temp_path = os.path.join(path, 'tmp', name)
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            with memoryview(body) as view:
+                written = 0
+                while written < len(view):
+                    written += os.write(fd, view[written:])
+            # Servers take the received date of a Maildir message from its mtime
+            os.utime(fd, (received, received))
+        except BaseException:
+            os.close(fd)
+            os.unlink(temp_path)
+            raise
+        self.pending.append((fd, temp_path, os.path.join(path, 'cur', f"{name}:2,{flags}")))
+        self.messages += 1
+        self.bytes += len(body)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.sync == 'syncfs':
+            if SYNCFS(self.pending[0][0]) != 0:
+                raise OSError(ctypes.get_errno(), "syncfs failed")
+        elif self.sync == 'fdatasync':
+            for fd, temp_path, final_path in self.pending:
+                os.fdatasync(fd)
+        folders = set()
+        for fd, temp_path, final_path in self.pending:
+            os.close(fd)
+            os.rename(temp_path, final_path)
+            folders.add(os.path.dirname(final_path))
+        self.pending = []
+        if self.sync != 'none':
+            for folder in folders:
+                dir_fd = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+
+def convert_range(path, start, end, maildir, batch_size=BATCH_SIZE, sync='syncfs',
+                  default_folder=imap_upload.DEFAULT_FOLDER, skip_labels=()):
+    """
+    Delivers the messages that begin in path[start:end] into maildir.
+    Returns (messages, bytes, skipped, {folder: messages}).
+    """
+    writer = MaildirWriter(maildir, batch_size, sync)
+    skipped = 0
+    counts = {}
+    try:
+        for from_line, headers, body in imap_upload.iter_mbox_messages(path, start, end, crlf=False,
+                                                                       header_names=HEADER_NAMES):
+            folders, flags = message_folder_flags(headers, default_folder, skip_labels)
+            if not folders:
+                skipped += 1
+                continue
+            received = imap_upload.message_datetime(from_line, headers.get('date'))
+            for folder in folders:
+                writer.add(folder, body, flags, received.timestamp() if received else None)
+                counts[folder] = counts.get(folder, 0) + 1
+    finally:
+        writer.flush()
+    return writer.messages, writer.bytes, skipped, counts
+
+def convert_mailbox(source, maildir, workers=1, batch_size=BATCH_SIZE, sync='syncfs',
+                    default_folder=imap_upload.DEFAULT_FOLDER, skip_labels=()):
+    """
+    Converts every mbox file of source (see imap_upload.find_mbox_files) into maildir,
+    splitting each file into shards delivered by `workers` processes.
+    Returns (messages, bytes, skipped, {folder: messages}).
+    """
+    options = dict(batch_size=batch_size, sync=sync, default_folder=default_folder,
+                   skip_labels={label.lower() for label in skip_labels})
+    os.makedirs(maildir, exist_ok=True)
+    totals = [0, 0, 0]
+    counts = {}
+    started = time.monotonic()
+
+    def collect(result):
+        for i in range(3):
+            totals[i] += result[i]
+        for folder, count in result[3].items():
+            counts[folder] = counts.get(folder, 0) + count
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else contextlib.nullcontext() as executor:
+        for path in imap_upload.find_mbox_files(source):
+            print(f"Converting {path}")
+            if executor is None:
+                collect(convert_range(path, 0, None, maildir, **options))
+                continue
+            data = mbox_extract.open_mbox_map(path)
+            if data is None:
+                continue
+            try:
+                # A few shards per worker keeps every core busy until the end of the file
+                ranges = mbox_extract.shard_ranges(data, workers * 4)
+            finally:
+                data.close()
+            futures = [executor.submit(convert_range, path, start, end, maildir, **options) for start, end in ranges]
+            for future in futures:
+                collect(future.result())
+
+    elapsed = time.monotonic() - started
+    print(f"Delivered {totals[0]} messages ({totals[1] / 1048576:.1f} MB) into {len(counts)} folders of {maildir} "
+          f"in {elapsed:.1f}s ({totals[0] / max(elapsed, 0.001):.0f}/s); {totals[2]} skipped")
+    return totals[0], totals[1], totals[2], counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert Takeout mbox files into a Maildir++ tree, one folder per Gmail label.")
+    parser.add_argument('source', help="mbox file, or a user folder as unrolled by takeout_unroll.py")
+    parser.add_argument('maildir', help="destination Maildir (created if missing)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="processes delivering messages")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="messages synced and renamed together")
+    parser.add_argument('--sync', choices=('syncfs', 'fdatasync', 'none'), default='syncfs',
+                        help="how each batch is made durable (syncfs falls back to fdatasync where unavailable)")
+    parser.add_argument('--default-folder', default=imap_upload.DEFAULT_FOLDER, help="folder for messages with no folder label")
+    parser.add_argument('--skip-label', action='append', default=[], help="do not convert messages with this label (repeatable)")
+    args = parser.parse_args()
+
+    if not imap_upload.find_mbox_files(args.source):
+        print(f"Error: no mbox files found in {args.source}")
+        sys.exit(1)
+    convert_mailbox(args.source, args.maildir, workers=args.workers, batch_size=args.batch_size, sync=args.sync,
+                    default_folder=args.default_folder, skip_labels=args.skip_label)
@@ -0,0 +1,216 @@
+'''
+This software is Copyright (c) 2024 Theodore Jones Information Technology Consulting
+(a DBA of Blueprint Cyber Solutions LLC)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to elsewhere, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# Generates a synthetic Google Takeout corpus for testing and benchmarking the migration
+# tools. The same seed and options always produce byte-identical files (paths in corpus.json
+# are relative to the root):
+#   <root>/takeout/   takeout-YYYYMMDDTHHMMSSZ-NNN.zip parts per user, with archive_browser.html,
+#                     a Drive tree and the Mail mbox
+#   <root>/loose/     loose mbox files, as handed to mbox_extract.py
+#   <root>/contacts/  one .vcf tree per user
+#   <root>/corpus.json  the options and what was generated
+
+import argparse
+import base64
+import datetime
+import json
+import os
+import random
+import zipfile
+
+DOMAIN = 'example.com'
+ZIP_DATE = (2024, 1, 1, 0, 0, 0)
+MAIL_MEMBER = 'Takeout/Mail/All mail Including Spam and Trash.mbox'
+WORDS = ('migration', 'invoice', 'meeting', 'project', 'schedule', 'report', 'budget', 'review', 'draft',
+         'customer', 'server', 'mailbox', 'contract', 'update', 'weekly', 'quarter', 'travel', 'team',
+         'the', 'and', 'for', 'with', 'please', 'attached', 'thanks', 'regards', 'today', 'tomorrow')
+LABELS = ('Inbox', 'Sent', 'Inbox,Starred', 'Archived,Category Updates', 'Inbox,Unread', 'Projects/Alpha',
+          'Projects/Beta,Important', 'Trash', 'Spam', 'Drafts', 'Opened,Category Promotions')
+FIRST_NAMES = ('Alex', 'Blake', 'Casey', 'Devon', 'Emery', 'Finley', 'Harper', 'Jordan', 'Kai', 'Morgan',
+               'Quinn', 'Riley', 'Rowan', 'Sage', 'Taylor')
+LAST_NAMES = ('Lee', 'Garcia', 'Novak', 'Okafor', 'Silva', 'Tanaka', 'Weber', 'Nguyen', 'Smith', 'Kowalski')
+
+def user_address(index):
+    return f"user{index:03d}@{DOMAIN}"
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+def message_bytes(rng, owner, number, size, when):
+    """
+    Returns one mbox message of roughly size bytes, starting with its 'From ' line.
+    About one in ten carries a base64 attachment.
+    """
+    correspondent = f"{rng.choice(FIRST_NAMES).lower()}.{rng.choice(LAST_NAMES).lower()}@partner{rng.randint(1, 9)}.org"
+    sent = rng.random() < 0.3
+    sender, recipient = (owner, correspondent) if sent else (correspondent, owner)
+    labels = 'Sent' if sent else rng.choice(LABELS)
+    date = when.strftime('%a, %d %b %Y %H:%M:%S +0000')
+    headers = [
+        f"From {rng.getrandbits(63)}@xxx {when.strftime('%a %b %d %H:%M:%S +0000 %Y')}",
+        f"X-GM-THRID: {rng.getrandbits(63)}",
+        f"X-Gmail-Labels: {labels}",
+        f"Message-ID: <{number}.{rng.getrandbits(32):08x}@synthetic.{DOMAIN}>",
+        f"Date: {date}",
+        f"From: {sender}",
+        f"To: {recipient}",
+        f"Subject: {sentence(rng, rng.randint(3, 8))[:-1]}",
+        "MIME-Version: 1.0",
+    ]
+    lines = []
+    length = 0
+    while length < size * 0.6:
+        line = sentence(rng, rng.randint(6, 14))
+        # Lines starting with 'From ' are quoted in mbox files
+        lines.append('>' + line if line.startswith('From ') else line)
+        length += len(line) + 1
+    text = '\n'.join(lines)
+    if rng.random() < 0.1:
+        boundary = f"b{rng.getrandbits(48):012x}"
+        attachment = base64.encodebytes(rng.randbytes(max(64, size // 3))).decode('ascii')
+        headers.append(f'Content-Type: multipart/mixed; boundary="{boundary}"')
+        body = (f"--{boundary}\nContent-Type: text/plain; charset=utf-8\n\n{text}\n"
+                f"--{boundary}\nContent-Type: application/octet-stream; name=\"file{number}.bin\"\n"
+                f"Content-Transfer-Encoding: base64\n\n{attachment}--{boundary}--\n")
+    else:
+        headers.append('Content-Type: text/plain; charset=utf-8')
+        body = text + '\n'
+    return ('\n'.join(headers) + '\n\n' + body + '\n').encode('utf-8')
+
+def mbox_bytes(rng, owner, messages, size, start=datetime.datetime(2015, 1, 1)):
+    chunks = []
+    when = start
+    for number in range(messages):
+        when += datetime.timedelta(seconds=rng.randint(60, 86400))
+        chunks.append(message_bytes(rng, owner, number, rng.randint(size // 2, size * 3 // 2), when))
+    return b''.join(chunks)
+
+def vcard_text(rng, number, categories):
+    first = rng.choice(FIRST_NAMES)
+    last = rng.choice(LAST_NAMES)
+    lines = ['BEGIN:VCARD', 'VERSION:3.0', f'FN:{first} {last} {number}', f'N:{last};{first};;;',
+             f'EMAIL;TYPE=INTERNET:{first.lower()}.{last.lower()}{number}@contacts.example.org']
+    if rng.random() < 0.7:
+        lines.append(f'TEL;TYPE=CELL:+1 555 {rng.randint(0, 9999):04d}')
+    if rng.random() < 0.4:
+        lines.append(f'ORG:{rng.choice(LAST_NAMES)} Consulting;{rng.choice(WORDS).capitalize()}')
+        lines.append(f'TITLE:{rng.choice(WORDS).capitalize()} Lead')
+    if rng.random() < 0.3:
+        lines.append(f'ADR;TYPE=HOME:;;{rng.randint(1, 999)} Main St;Springfield;CA;{rng.randint(90000, 96199)};USA')
+    if rng.random() < 0.2:
+        lines.append(f'BDAY:{rng.randint(1950, 2005)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}')
+    if rng.random() < 0.2:
+        lines.append('NOTE:' + sentence(rng, rng.randint(5, 30)))
+    if categories and rng.random() < 0.6:
+        lines.append('CATEGORIES:' + ','.join(sorted(set(rng.sample(categories, rng.randint(1, min(3, len(categories))))))))
+    lines.append('END:VCARD')
+    return '\r\n'.join(lines) + '\r\n'
+
+def write_zip_member(archive, name, data):
+    info = zipfile.ZipInfo(name, date_time=ZIP_DATE)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    archive.writestr(info, data, compresslevel=1)
+
+def generate_takeout(root, rng, user, owner, parts, messages, message_size, drive_files, drive_file_size):
+    """
+    Writes one user's Takeout zips: Drive files spread over the parts, archive_browser.html
+    in the first part and the Mail mbox in the last. Returns the zip paths.
+    """
+    stamp = (datetime.datetime(2024, 1, 1) + datetime.timedelta(hours=user)).strftime('%Y%m%dT%H%M%SZ')
+    paths = [os.path.join(root, f"takeout-{stamp}-{part:03d}.zip") for part in range(1, parts + 1)]
+    archives = [zipfile.ZipFile(path, 'w') for path in paths]
+    try:
+        write_zip_member(archives[0], 'Takeout/archive_browser.html',
+                         f'<html><body><h1 class="header_title">Archive for {owner}</h1></body></html>')
+        for number in range(drive_files):
+            folder = rng.choice(('Documents', 'Documents/Reports', 'Photos', 'Shared', 'Projects/Alpha'))
+            data = ' '.join(sentence(rng, 12) for _ in range(max(1, drive_file_size // 80))).encode()[:drive_file_size]
+            write_zip_member(archives[number % parts], f'Takeout/Drive/{folder}/file{number:05d}.txt', data)
+        write_zip_member(archives[-1], MAIL_MEMBER, mbox_bytes(rng, owner, messages, message_size))
+    finally:
+        for archive in archives:
+            archive.close()
+    return paths
+
+def generate_corpus(root, seed=1, users=3, parts=2, messages=2000, message_size=2048, drive_files=40,
+                    drive_file_size=16384, loose_mboxes=1, loose_messages=5000, cards=1000, categories=8,
+                    vcf_files=2):
+    """
+    Generates the corpus under root and returns its description, also written to corpus.json.
+    """
+    rng = random.Random(seed)
+    takeout = os.path.join(root, 'takeout')
+    loose = os.path.join(root, 'loose')
+    contacts = os.path.join(root, 'contacts')
+    for folder in (takeout, loose, contacts):
+        os.makedirs(folder, exist_ok=True)
+    category_names = [f"{rng.choice(WORDS).capitalize()} {number}" for number in range(categories)]
+
+    description = {'seed': seed, 'users': [], 'loose_mboxes': [], 'options': {
+        'users': users, 'parts': parts, 'messages': messages, 'message_size': message_size,
+        'drive_files': drive_files, 'drive_file_size': drive_file_size, 'loose_mboxes': loose_mboxes,
+        'loose_messages': loose_messages, 'cards': cards, 'categories': categories, 'vcf_files': vcf_files}}
+    for user in range(users):
+        owner = user_address(user)
+        print(f"Generating Takeout for {owner}")
+        zips = generate_takeout(takeout, rng, user, owner, parts, messages, message_size, drive_files, drive_file_size)
+        contacts_folder = os.path.join(contacts, owner)
+        os.makedirs(os.path.join(contacts_folder, 'Other'), exist_ok=True)
+        card = 0
+        for number in range(vcf_files):
+            count = cards // vcf_files + (1 if number < cards % vcf_files else 0)
+            folder = contacts_folder if number == 0 else os.path.join(contacts_folder, 'Other')
+            with open(os.path.join(folder, f"contacts{number + 1}.vcf"), 'w', newline='') as f:
+                for _ in range(count):
+                    f.write(vcard_text(rng, card, category_names))
+                    card += 1
+        description['users'].append({'email': owner, 'zips': [os.path.basename(path) for path in zips],
+                                     'zip_bytes': sum(os.path.getsize(path) for path in zips),
+                                     'messages': messages, 'contacts_folder': os.path.relpath(contacts_folder, root),
+                                     'cards': cards})
+    for number in range(loose_mboxes):
+        path = os.path.join(loose, f"loose{number + 1}.mbox")
+        print(f"Generating {path}")
+        with open(path, 'wb') as f:
+            f.write(mbox_bytes(rng, user_address(number % max(users, 1)), loose_messages, message_size))
+        description['loose_mboxes'].append({'path': os.path.relpath(path, root), 'messages': loose_messages, 'bytes': os.path.getsize(path)})
+    with open(os.path.join(root, 'corpus.json'), 'w') as f:
+        json.dump(description, f, indent=1)
+    return description
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic Google Takeout corpus with a fixed seed.")
+    parser.add_argument('root', help="folder to generate the corpus in")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--users', type=int, default=3, help="users with Takeout archives and contacts")
+    parser.add_argument('--parts', type=int, default=2, help="zip parts per user")
+    parser.add_argument('--messages', type=int, default=2000, help="Mail messages per user")
+    parser.add_argument('--message-size', type=int, default=2048, help="average message size in bytes")
+    parser.add_argument('--drive-files', type=int, default=40, help="Drive files per user")
+    parser.add_argument('--drive-file-size', type=int, default=16384, help="Drive file size in bytes")
+    parser.add_argument('--loose-mboxes', type=int, default=1, help="loose mbox files")
+    parser.add_argument('--loose-messages', type=int, default=5000, help="messages per loose mbox")
+    parser.add_argument('--cards', type=int, default=1000, help="vCards per user")
+    parser.add_argument('--categories', type=int, default=8, help="distinct contact categories")
+    parser.add_argument('--vcf-files', type=int, default=2, help=".vcf files per user")
+    args = parser.parse_args()
+
+    generate_corpus(args.root, seed=args.seed, users=args.users, parts=args.parts, messages=args.messages,
+                    message_size=args.message_size, drive_files=args.drive_files,
+                    drive_file_size=args.drive_file_size, loose_mboxes=args.loose_mboxes,
+                    loose_messages=args.loose_messages, cards=args.cards, categories=args.categories,
+                    vcf_files=args.vcf_files)
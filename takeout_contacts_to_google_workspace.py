@@ -19,19 +19,67 @@ import os
 import sys
 import time
 import re
+import random
+import queue
+import threading
+import argparse
+import collections
+import concurrent.futures
+import csv
+import datetime
+import hashlib
+import io
+import itertools
+import json
+import locale
 import vobject
+import httplib2
+import google_auth_httplib2
+from google.auth.credentials import AnonymousCredentials
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.errors import HttpError
+
+import instrumentation
+
+SCOPES = ['https://www.googleapis.com/auth/contacts']
+BATCH_SIZE = 200
+SYNC_PERSON_FIELDS = 'names,emailAddresses,phoneNumbers'
+READ_MASK = 'names,emailAddresses,phoneNumbers,organizations,addresses,biographies,memberships,birthdays,urls,userDefined'
+SOURCES = ['READ_SOURCE_TYPE_CONTACT']
+
+# A CATEGORIES property of an unfolded vCard line, with optional group prefix and parameters
+CATEGORIES_LINE = re.compile(r'^(?:[\w-]+\.)?CATEGORIES(?:;[^:\r\n]*)?:(.*?)\r?$', re.IGNORECASE | re.MULTILINE)
+FOLDED_LINE = re.compile(r'\r?\n[ \t]')
+# Literal "\n" followed by "Key: value" in a contact's note
+CUSTOM_FIELD = re.compile(r'\\n(.*?): (.*)')
+# Properties the streaming parser keeps; everything the People API mapping uses
+VCARD_PROPERTIES = {'FN', 'N', 'EMAIL', 'TEL', 'ORG', 'TITLE', 'NOTE', 'BDAY', 'URL', 'ADR', 'CATEGORIES'}
+VCF_CHUNK_BYTES = 4 * 1024 * 1024
+# vCard ranges queued per parse process
+PARSE_WINDOW = 2
+
+def fetch_contact_groups(service):
+    """
+    Returns {name: resourceName} of all the user's contact groups, following every page.
+    """
+    groups = {}
+    page_token = None
+    while True:
+        results = service.contactGroups().list(pageSize=1000, pageToken=page_token).execute()
+        for group in results.get('contactGroups', []):
+            groups.setdefault(group['name'], group['resourceName'])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return groups
 
 def get_or_create_contact_group(service, group_name, group_cache):
     if group_name in group_cache:
         return group_cache[group_name]
 
-    results = service.contactGroups().list().execute()
-    for group in results.get('contactGroups', []):
-        if group['name'] == group_name:
-            group_cache[group_name] = group['resourceName']
-            return group['resourceName']
+    group_cache.update(fetch_contact_groups(service))
+    if group_name in group_cache:
+        return group_cache[group_name]
 
     # If the group doesn't exist, create it
     new_group = {'contactGroup': {'name': group_name}}
@@ -39,152 +87,951 @@ def get_or_create_contact_group(service, group_name, group_cache):
     group_cache[group_name] = created_group['resourceName']
     return created_group['resourceName']
 
-def main(json_path, user_email, contacts_folder, batch_delay=5):
-    creds = service_account.Credentials.from_service_account_file(json_path, scopes=['https://www.googleapis.com/auth/contacts'])
-    delegated_creds = creds.with_subject(user_email)
-    service = build('people', 'v1', credentials=delegated_creds)
+def delegated_credentials(json_path, user_email):
+    creds = service_account.Credentials.from_service_account_file(json_path, scopes=SCOPES)
+    return creds.with_subject(user_email)
 
-    imported_contacts = set()
-    group_cache = {}
-    max_retries = 3  # Maximum number of retries for API requests
-
-    contacts_to_create = []
-    read_mask = 'names,emailAddresses,phoneNumbers,organizations,addresses,biographies,memberships,birthdays,urls,userDefined'
-    sources = ['READ_SOURCE_TYPE_CONTACT']
+def build_people_service(credentials, api_endpoint=None):
+    """
+    Builds a People API client. api_endpoint points it somewhere other than Google,
+    such as a local fake_people_api server.
+    """
+    client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+    return build('people', 'v1', credentials=credentials, client_options=client_options)
 
+def iter_vcards(contacts_folder):
     for root, dirs, files in os.walk(contacts_folder):
         for file in files:
             if file.endswith('.vcf'):
                 with open(os.path.join(root, file), 'r') as f:
                     vcf_data = f.read()
-                    contacts = vobject.readComponents(vcf_data)
-
-                    for contact in contacts:
-                        try:
-                            name = contact.fn.value if hasattr(contact, 'fn') else ''
-                            email = [{'value': e.value} for e in contact.contents['email']] if 'email' in contact.contents else []
-
-                            if (name, tuple(e['value'] for e in email)) in imported_contacts:
-                                continue
-
-                            imported_contacts.add((name, tuple(e['value'] for e in email)))
-
-                            given_name = contact.n.value.given if hasattr(contact, 'n') else ''
-                            family_name = contact.n.value.family if hasattr(contact, 'n') else ''
-                            phone = [{'value': p.value} for p in contact.contents['tel']] if 'tel' in contact.contents else []
-                            organization = contact.org.value[0] if hasattr(contact, 'org') else ''
-                            title = contact.title.value if hasattr(contact, 'title') else ''
-                            note = contact.note.value if hasattr(contact, 'note') else ''
-                            birthday = contact.bday.value if hasattr(contact, 'bday') else ''
-                            url = [{'value': u.value} for u in contact.contents['url']] if 'url' in contact.contents else []
-
-                            address = {}
-                            if hasattr(contact, 'adr'):
-                                address['streetAddress'] = contact.adr.value.street
-                                address['city'] = contact.adr.value.city
-                                address['region'] = contact.adr.value.region
-                                address['postalCode'] = contact.adr.value.code
-                                address['country'] = contact.adr.value.country
-
-                            memberships = []
-                            if hasattr(contact, 'categories'):
-                                for category in contact.categories.value:
-                                    group_resource_name = get_or_create_contact_group(service, category, group_cache)
-                                    memberships.append({'contactGroupMembership': {'contactGroupResourceName': group_resource_name}})
-
-                            user_defined = []
-                            if note:
-                                custom_field_pattern = re.compile(r'\\n(.*?): (.*)')
-                                custom_fields = custom_field_pattern.findall(note)
-                                for field in custom_fields:
-                                    key = field[0].strip()
-                                    value = field[1].strip()
-                                    user_defined.append({'key': key, 'value': value})
-
-                            birthday_parts = [birthday[0:4], birthday[4:6], birthday[6:8]]
-                            formatted_birthday = '-'.join(filter(None, birthday_parts))
-
-                            contact_to_create = {
-                                'names': [{'givenName': given_name, 'familyName': family_name}],
-                                'emailAddresses': email,
-                                'phoneNumbers': phone,
-                                'organizations': [{
-                                    'name': organization,
-                                    'title': title
-                                }],
-                                'addresses': [address] if address else [],
-                                'biographies': [{'value': note}] if note else [],
-                                'birthdays': [{'date': {'year': int(birthday_parts[0]), 'month': int(birthday_parts[1]), 'day': int(birthday_parts[2])}}] if birthday else [],
-                                'urls': url,
-                                'userDefined': user_defined,
-                                'memberships': memberships
-                            }
-
-                            contacts_to_create.append({'contactPerson': contact_to_create})
-
-                            if len(contacts_to_create) == 200:
-                                retries = 0
-                                while retries < max_retries:
-                                    try:
-                                        batch_response = service.people().batchCreateContacts(
-                                            body={
-                                                'contacts': contacts_to_create,
-                                                'readMask': read_mask,
-                                                'sources': sources
-                                            }
-                                        ).execute()
-                                        print(f"Batch created {len(contacts_to_create)} contacts")
-                                        contacts_to_create = []
-                                        break
-                                    except Exception as e:
-                                        print(f"Error creating batch of contacts")
-                                        print(str(e))
-                                        retries += 1
-                                        if retries < max_retries:
-                                            print(f"Retrying in {batch_delay} seconds...")
-                                            time.sleep(batch_delay)
-                                        else:
-                                            print("Max retries reached. Skipping batch.")
-
-                                # Delay between batches
-                                time.sleep(batch_delay)
-
-                        except Exception as e:
-                            print(f"Error processing contact: {contact}")
-                            print(str(e))
+                yield from vobject.readComponents(vcf_data)
 
-    # Create any remaining contacts
-    if contacts_to_create:
-        retries = 0
-        while retries < max_retries:
-            try:
-                batch_response = service.people().batchCreateContacts(
-                    body={
-                        'contacts': contacts_to_create,
-                        'readMask': read_mask,
-                        'sources': sources
-                    }
-                ).execute()
-                print(f"Batch created {len(contacts_to_create)} contacts")
-                contacts_to_create = []
+def read_categories(vcf_data):
+    """
+    Returns the set of CATEGORIES values in a .vcf file's text, without a full vCard parse.
+    """
+    categories = set()
+    for match in CATEGORIES_LINE.finditer(FOLDED_LINE.sub('', vcf_data)):
+        categories.update(category_names(text_values(match.group(1))))
+    return categories
+
+def category_names(values):
+    # 'Work, Family' names the groups 'Work' and 'Family', whichever parser read it
+    return [name for name in (value.strip() for value in values) if name]
+
+def resolve_contact_groups(service, contacts_folder):
+    """
+    Fetches all existing contact groups once, then creates the groups for every category
+    used across the .vcf files, so group lookups during the upload are cache hits.
+    Returns the {name: resourceName} cache.
+    """
+    categories = set()
+    for root, dirs, files in os.walk(contacts_folder):
+        for file in files:
+            if file.endswith('.vcf'):
+                with open(os.path.join(root, file), 'r') as f:
+                    categories |= read_categories(f.read())
+    group_cache = fetch_contact_groups(service)
+    missing = sorted(categories - set(group_cache))
+    for group_name in missing:
+        try:
+            created_group = service.contactGroups().create(body={'contactGroup': {'name': group_name}}).execute()
+            group_cache[group_name] = created_group['resourceName']
+        except HttpError as e:
+            if e.resp.status != 409:
+                raise
+            # Created by someone else since the listing
+            group_cache.update(fetch_contact_groups(service))
+    print(f"Resolved {len(categories)} contact groups ({len(missing)} created)")
+    return group_cache
+
+def contact_key(contact):
+    # Contacts with the same name and email addresses are only imported once
+    name = contact.fn.value if hasattr(contact, 'fn') else ''
+    email = tuple(e.value for e in contact.contents['email']) if 'email' in contact.contents else ()
+    return (name, email)
+
+def normalize_name(person):
+    names = person.get('names') or [{}]
+    name = ' '.join(part for part in (names[0].get('givenName'), names[0].get('familyName')) if part)
+    return ' '.join((name or names[0].get('displayName') or '').casefold().split())
+
+def normalize_phone(value):
+    # Compare the national number only, so +1 (555) 010-0000 matches 555.010.0000
+    return re.sub(r'\D', '', value or '')[-10:]
+
+def identity_keys(person):
+    """
+    Returns hashed keys identifying a People API person: the normalized name paired with
+    each email address and phone number, or the name alone when it has neither.
+    """
+    name = normalize_name(person)
+    values = ['e:' + e['value'].strip().casefold() for e in person.get('emailAddresses', []) if e.get('value')]
+    values += ['p:' + phone for phone in map(normalize_phone, (p.get('value') for p in person.get('phoneNumbers', []))) if phone]
+    if not values and not name:
+        return set()
+    return {hashlib.blake2b(f'{name}|{value}'.encode(), digest_size=12).hexdigest() for value in values or ['']}
+
+class ContactIndex:
+    """
+    Hashed identity keys of contacts that already exist in the target account, from one pass
+    over people.connections plus a local state file of contacts this tool has uploaded.
+    The state file gets one key per line, appended after each successful batch.
+    """
+    def __init__(self, state_path=None):
+        self.keys = set()
+        self.lock = threading.Lock()
+        self.state = None
+        if state_path:
+            if os.path.exists(state_path):
+                with open(state_path) as f:
+                    self.keys.update(line.strip() for line in f if line.strip())
+            self.state = open(state_path, 'a')
+
+    def load_remote(self, service):
+        """
+        Adds every existing connection of the account; returns how many were read.
+        """
+        people = 0
+        page_token = None
+        while True:
+            response = service.people().connections().list(
+                resourceName='people/me', personFields=SYNC_PERSON_FIELDS, pageSize=1000, pageToken=page_token).execute()
+            for person in response.get('connections', []):
+                self.keys.update(identity_keys(person))
+                people += 1
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return people
+
+    def claim(self, person):
+        """
+        Returns False if the person is already known; otherwise remembers it for this run.
+        """
+        keys = identity_keys(person)
+        with self.lock:
+            if keys & self.keys:
+                return False
+            self.keys.update(keys)
+            return True
+
+    def record(self, batch):
+        if self.state is None:
+            return
+        with self.lock:
+            for contact in batch:
+                for key in identity_keys(contact['contactPerson']):
+                    self.state.write(key + '\n')
+            self.state.flush()
+            os.fsync(self.state.fileno())
+
+    def close(self):
+        if self.state is not None:
+            self.state.close()
+
+def vcard_fields(contact):
+    """
+    Returns the values the People API mapping uses from a vobject vCard.
+    """
+    address = None
+    if hasattr(contact, 'adr'):
+        adr = contact.adr.value
+        address = {'street': adr.street, 'city': adr.city, 'region': adr.region, 'code': adr.code, 'country': adr.country}
+    return {
+        'fn': contact.fn.value if hasattr(contact, 'fn') else '',
+        'given': contact.n.value.given if hasattr(contact, 'n') else '',
+        'family': contact.n.value.family if hasattr(contact, 'n') else '',
+        'emails': [e.value for e in contact.contents.get('email', [])],
+        'phones': [p.value for p in contact.contents.get('tel', [])],
+        'organization': contact.org.value[0] if hasattr(contact, 'org') else '',
+        'title': contact.title.value if hasattr(contact, 'title') else '',
+        'note': contact.note.value if hasattr(contact, 'note') else '',
+        'birthday': contact.bday.value if hasattr(contact, 'bday') else '',
+        'urls': [u.value for u in contact.contents.get('url', [])],
+        'address': address,
+        'categories': category_names(contact.categories.value) if hasattr(contact, 'categories') else []
+    }
+
+def contact_person(fields, group_lookup):
+    """
+    Maps vCard fields to a People API contactPerson; group_lookup returns the
+    resourceName of the contact group for a category.
+    """
+    note = fields['note']
+    birthday = fields['birthday']
+
+    address = {}
+    if fields['address'] is not None:
+        address['streetAddress'] = fields['address']['street']
+        address['city'] = fields['address']['city']
+        address['region'] = fields['address']['region']
+        address['postalCode'] = fields['address']['code']
+        address['country'] = fields['address']['country']
+
+    memberships = []
+    for category in fields['categories']:
+        memberships.append({'contactGroupMembership': {'contactGroupResourceName': group_lookup(category)}})
+
+    user_defined = []
+    if note:
+        for field in CUSTOM_FIELD.findall(note):
+            user_defined.append({'key': field[0].strip(), 'value': field[1].strip()})
+
+    birthday_parts = [birthday[0:4], birthday[4:6], birthday[6:8]]
+
+    return {
+        'names': [{'givenName': fields['given'], 'familyName': fields['family']}],
+        'emailAddresses': [{'value': e} for e in fields['emails']],
+        'phoneNumbers': [{'value': p} for p in fields['phones']],
+        'organizations': [{
+            'name': fields['organization'],
+            'title': fields['title']
+        }],
+        'addresses': [address] if address else [],
+        'biographies': [{'value': note}] if note else [],
+        'birthdays': [{'date': {'year': int(birthday_parts[0]), 'month': int(birthday_parts[1]), 'day': int(birthday_parts[2])}}] if birthday else [],
+        'urls': [{'value': u} for u in fields['urls']],
+        'userDefined': user_defined,
+        'memberships': memberships
+    }
+
+def build_contact(contact, service, group_cache):
+    """
+    Maps a vCard to a People API contactPerson, creating contact groups for its categories.
+    """
+    return contact_person(vcard_fields(contact), lambda name: get_or_create_contact_group(service, name, group_cache))
+
+def text_values(value, separator=',', escapable='\\;,Nn"'):
+    """
+    Splits a vCard value on unescaped separators and resolves escapes, the way vobject does:
+    unknown escapes are kept and an empty trailing value is dropped.
+    """
+    if '\\' not in value:
+        values = value.split(separator)
+    else:
+        values = []
+        current = []
+        chars = iter(value)
+        for char in chars:
+            if char == '\\':
+                # vobject turns a dangling backslash into '\\eof'; match it so both parsers agree
+                escaped = next(chars, 'eof')
+                if escaped in escapable:
+                    current.append('\n' if escaped in 'nN' else escaped)
+                else:
+                    current.append('\\' + escaped)
+            elif char == separator:
+                values.append(''.join(current))
+                current = []
+            else:
+                current.append(char)
+        values.append(''.join(current))
+    if len(values) > 1 and not values[-1]:
+        values.pop()
+    return values
+
+def split_fields(value):
+    # Structured values (N, ADR, ORG): components split on ';', each a string or a list of strings
+    fields = []
+    for component in text_values(value, ';', ';'):
+        values = text_values(component)
+        fields.append(values[0] if len(values) == 1 else values)
+    return fields
+
+def unfold_lines(lines):
+    logical = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and logical is not None:
+            logical += line[1:]
+            continue
+        if logical:
+            yield logical
+        logical = line
+    if logical:
+        yield logical
+
+def split_property(line):
+    """
+    Returns (NAME, parameters, value) of an unfolded content line, or None when it has no value.
+    """
+    colon = line.find(':')
+    if colon < 0:
+        return None
+    if '"' in line[:colon]:
+        # A quoted parameter value may contain ':'
+        quoted = False
+        for colon, char in enumerate(line):
+            if char == '"':
+                quoted = not quoted
+            elif char == ':' and not quoted:
                 break
+        else:
+            return None
+    name, _, params = line[:colon].partition(';')
+    return name.rpartition('.')[2].upper(), params, line[colon + 1:]
+
+def iter_vcard_records(lines):
+    """
+    Streams vCards out of text lines. Yields ({NAME: [raw value, ...]}, None) for each card,
+    or (None, card text) for one that needs the full vobject parse: encoded values or
+    nested components.
+    """
+    card = None
+    for line in unfold_lines(lines):
+        prop = split_property(line.lstrip('\ufeff'))
+        if prop is None:
+            continue
+        name, params, value = prop
+        if card is None:
+            if name == 'BEGIN' and value.strip().upper() == 'VCARD':
+                card, source, depth, full_parse = {}, [line], 1, False
+            continue
+        source.append(line)
+        if name == 'BEGIN':
+            depth += 1
+            full_parse = True
+        elif name == 'END':
+            depth -= 1
+            if depth == 0:
+                yield (None, '\r\n'.join(source) + '\r\n') if full_parse else (card, None)
+                card = None
+        elif name in VCARD_PROPERTIES:
+            if 'ENCODING' in params.upper() or 'QUOTED-PRINTABLE' in params.upper() or 'BASE64' in params.upper():
+                full_parse = True
+            card.setdefault(name, []).append(value)
+
+def record_fields(card):
+    """
+    Returns the same fields as vcard_fields from a record of iter_vcard_records.
+    """
+    def text(name):
+        return text_values(card[name][0])[0] if name in card else ''
+
+    name = split_fields(card['N'][0]) if 'N' in card else []
+    address = None
+    if 'ADR' in card:
+        adr = split_fields(card['ADR'][0]) + [''] * 7
+        address = {'street': adr[2], 'city': adr[3], 'region': adr[4], 'code': adr[5], 'country': adr[6]}
+    return {
+        'fn': text('FN'),
+        'given': name[1] if len(name) > 1 else '',
+        'family': name[0] if name else '',
+        'emails': [text_values(v)[0] for v in card.get('EMAIL', [])],
+        'phones': [text_values(v)[0] for v in card.get('TEL', [])],
+        'organization': split_fields(card['ORG'][0])[0] if 'ORG' in card else '',
+        'title': text('TITLE'),
+        'note': text('NOTE'),
+        'birthday': text('BDAY'),
+        'urls': [text_values(v)[0] for v in card.get('URL', [])],
+        'address': address,
+        'categories': category_names(text_values(card['CATEGORIES'][0])) if 'CATEGORIES' in card else []
+    }
+
+def iter_vcf_tasks(contacts_folder, chunk_bytes=VCF_CHUNK_BYTES):
+    """
+    Yields (path, start, end) byte ranges covering every .vcf under contacts_folder,
+    splitting large files at BEGIN:VCARD lines so one export can be parsed in parallel.
+    """
+    for root, dirs, files in os.walk(contacts_folder):
+        for file in files:
+            if not file.endswith('.vcf'):
+                continue
+            path = os.path.join(root, file)
+            size = os.path.getsize(path)
+            start = 0
+            with open(path, 'rb') as f:
+                while size - start > chunk_bytes:
+                    boundary = find_card_start(f, start + chunk_bytes)
+                    if boundary is None:
+                        break
+                    yield path, start, boundary
+                    start = boundary
+            yield path, start, size
+
+def find_card_start(f, offset, block_size=65536):
+    marker = b'\nBEGIN:VCARD'
+    f.seek(offset)
+    while True:
+        block = f.read(block_size + len(marker))
+        found = block.find(marker)
+        if found >= 0:
+            return offset + found + 1
+        if len(block) <= len(marker):
+            return None
+        offset += block_size
+        f.seek(offset)
+
+def parse_vcf_range(task, group_cache=None):
+    """
+    Parses the vCards in one (path, start, end) range. Returns a list of (key, person, fields, error):
+    person is ready to send when every category is in group_cache, otherwise fields are returned
+    for the caller to finish.
+    """
+    path, start, end = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    results = []
+    lines = io.StringIO(data.decode(locale.getpreferredencoding(False)), newline=None)
+    for card, text in iter_vcard_records(lines):
+        try:
+            fields = record_fields(card) if card is not None else vcard_fields(vobject.readOne(text))
+            key = (fields['fn'], tuple(fields['emails']))
+            if group_cache is not None and all(name in group_cache for name in fields['categories']):
+                results.append((key, contact_person(fields, group_cache.__getitem__), None, None))
+            else:
+                results.append((key, None, fields, None))
+        except Exception as e:
+            results.append((None, None, None, f"{path}: {e}"))
+    return results
+
+# Set in each parse process by the pool initializer, so the group cache is sent once per process
+worker_group_cache = None
+
+def init_parse_worker(group_cache):
+    global worker_group_cache
+    worker_group_cache = group_cache
+
+def parse_vcf_task(task):
+    return parse_vcf_range(task, worker_group_cache)
+
+def iter_parsed_vcards(contacts_folder, group_cache=None, workers=1):
+    """
+    Yields the results of parse_vcf_range for every .vcf under contacts_folder in file order,
+    spread across `workers` processes. At most PARSE_WINDOW ranges per process are queued
+    at a time, so parsed cards do not pile up ahead of a slow consumer.
+    """
+    tasks = iter_vcf_tasks(contacts_folder)
+    if workers <= 1:
+        for task in tasks:
+            yield from parse_vcf_range(task, group_cache)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_parse_worker,
+                                                initargs=(group_cache,)) as pool:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.submit(parse_vcf_task, task))
+            if len(pending) >= workers * PARSE_WINDOW:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def iter_contact_people(contacts_folder, service, group_cache, parse_workers=0):
+    """
+    Yields (key, contactPerson) for every vCard under contacts_folder, using vobject
+    or, with parse_workers, the streaming parser in that many processes.
+    """
+    group_lookup = lambda name: get_or_create_contact_group(service, name, group_cache)
+    if not parse_workers:
+        for contact in iter_vcards(contacts_folder):
+            try:
+                yield contact_key(contact), build_contact(contact, service, group_cache)
             except Exception as e:
-                print(f"Error creating batch of contacts")
+                print(f"Error processing contact: {contact}")
                 print(str(e))
-                retries += 1
-                if retries < max_retries:
-                    print(f"Retrying in {batch_delay} seconds...")
-                    time.sleep(batch_delay)
+        return
+    for key, person, fields, error in iter_parsed_vcards(contacts_folder, dict(group_cache), parse_workers):
+        try:
+            if error:
+                raise ValueError(error)
+            yield key, person if person is not None else contact_person(fields, group_lookup)
+        except Exception as e:
+            print(f"Error processing contact: {key}")
+            print(str(e))
+
+def compare_parsers(contacts_folder, workers=1, show=5):
+    """
+    Parses contacts_folder with vobject and with the streaming parser and reports every
+    card whose fields differ. Returns the number of differences.
+    """
+    def vobject_fields():
+        for contact in iter_vcards(contacts_folder):
+            try:
+                yield vcard_fields(contact)
+            except Exception as e:
+                yield {'error': str(e)}
+
+    def streamed_fields():
+        for key, person, fields, error in iter_parsed_vcards(contacts_folder, None, workers):
+            yield fields if error is None else {'error': error}
+
+    cards = differences = 0
+    for expected, actual in itertools.zip_longest(vobject_fields(), streamed_fields()):
+        cards += 1
+        if expected != actual:
+            differences += 1
+            if differences <= show:
+                print(f"Card {cards} differs:\n  vobject:   {expected}\n  streaming: {actual}")
+    print(f"Compared {cards} cards, {differences} differ")
+    return differences
+
+def create_contacts_batch(service, contacts_to_create, batch_delay, max_retries=3):
+    retries = 0
+    while retries < max_retries:
+        try:
+            service.people().batchCreateContacts(
+                body={
+                    'contacts': contacts_to_create,
+                    'readMask': READ_MASK,
+                    'sources': SOURCES
+                }
+            ).execute()
+            print(f"Batch created {len(contacts_to_create)} contacts")
+            return True
+        except Exception as e:
+            print(f"Error creating batch of contacts")
+            print(str(e))
+            retries += 1
+            if retries < max_retries:
+                print(f"Retrying in {batch_delay} seconds...")
+                time.sleep(batch_delay)
+            else:
+                print("Max retries reached. Skipping batch.")
+    return False
+
+def iter_contact_batches(contacts_folder, service, group_cache, imported_contacts, index=None, parse_workers=0):
+    """
+    Parses every .vcf under contacts_folder and yields lists of up to BATCH_SIZE
+    contacts ready for batchCreateContacts, skipping duplicates and, with a
+    ContactIndex, contacts the account already has.
+    """
+    contacts_to_create = []
+    for key, person in iter_contact_people(contacts_folder, service, group_cache, parse_workers):
+        if key in imported_contacts:
+            continue
+        imported_contacts.add(key)
+        if index is not None and not index.claim(person):
+            continue
+        contacts_to_create.append({'contactPerson': person})
+        if len(contacts_to_create) == BATCH_SIZE:
+            yield contacts_to_create
+            contacts_to_create = []
+    # Create any remaining contacts
+    if contacts_to_create:
+        yield contacts_to_create
+
+def main(json_path, user_email, contacts_folder, batch_delay=5, parse_workers=0):
+    service = build_people_service(delegated_credentials(json_path, user_email))
+
+    imported_contacts = set()
+    group_cache = resolve_contact_groups(service, contacts_folder)
+
+    with instrumentation.stage('import_contacts', user=user_email) as stage:
+        for batch in iter_contact_batches(contacts_folder, service, group_cache, imported_contacts,
+                                          parse_workers=parse_workers):
+            create_contacts_batch(service, batch, batch_delay)
+            stage.add(sent=len(batch))
+            if len(batch) == BATCH_SIZE:
+                # Delay between batches
+                time.sleep(batch_delay)
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by the upload workers. The rate grows a little after every
+    successful call and is halved on 429/5xx responses; a throttled call also pauses
+    all workers for the server's Retry-After, or an exponential backoff with jitter.
+    """
+    def __init__(self, rate=1.0, min_rate=0.05, max_rate=10.0, increase=0.1, burst=1.0,
+                 base_backoff=1.0, max_backoff=64.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.burst = burst
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
                 else:
-                    print("Max retries reached. Skipping batch.")
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self, retry_after=None, attempt=0):
+        """
+        Records a throttled call and returns how long the workers pause before the retry.
+        """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after is not None:
+                delay = retry_after
+            else:
+                delay = min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + delay)
+            self.tokens = 0
+            self.updated = max(self.updated, self.paused_until)
+            return delay
+
+class UploadStats:
+    """
+    Upload counters shared by the workers, mirrored into an instrumentation stage if given;
+    created contacts count as the stage's messages.
+    """
+    def __init__(self, stage=None):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.stage = stage
+
+    def add(self, name, count=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + count
+        if self.stage is None:
+            return
+        if name == 'created':
+            self.stage.add(messages=count)
+        elif name == 'failed':
+            self.stage.error(f"{count} contacts failed", count)
+        else:
+            self.stage.add(**{name: count})
+
+    def get(self, name):
+        return self.counts.get(name, 0)
+
+def is_retryable(error):
+    if isinstance(error, HttpError):
+        return error.resp.status == 429 or error.resp.status >= 500
+    # Dropped connections and timeouts
+    return isinstance(error, OSError)
+
+def retry_after_seconds(error):
+    if isinstance(error, HttpError):
+        value = error.resp.get('retry-after')
+        if value and value.strip().isdigit():
+            return float(value)
+    return None
+
+def send_batch(service, batch, limiter, stats, max_retries=6):
+    for attempt in range(max_retries):
+        limiter.acquire()
+        try:
+            service.people().batchCreateContacts(
+                body={
+                    'contacts': batch,
+                    'readMask': READ_MASK,
+                    'sources': SOURCES
+                }
+            ).execute()
+        except Exception as e:
+            if not is_retryable(e) or attempt == max_retries - 1:
+                print(f"Error creating batch of {len(batch)} contacts, skipping it: {e}")
+                stats.add('failed', len(batch))
+                return False
+            delay = limiter.throttled(retry_after_seconds(e), attempt)
+            stats.add('throttled')
+            print(f"Throttled ({e.resp.status if isinstance(e, HttpError) else e}), retrying in {delay:.1f} seconds")
+            continue
+        limiter.success()
+        stats.add('created', len(batch))
+        print(f"Batch created {len(batch)} contacts")
+        return True
+    return False
+
+def upload_worker(service, batches, limiter, stats, index=None):
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        if send_batch(service, batch, limiter, stats) and index is not None:
+            index.record(batch)
+
+def main_pipelined(json_path, user_email, contacts_folder, workers=4, rate=1.0, max_rate=10.0,
+                   api_endpoint=None, credentials=None, sync_state=None, parse_workers=0):
+    """
+    Imports contacts with parsing and uploading overlapped: this thread parses vCards into
+    batches while `workers` threads, each with its own client, send them as fast as the
+    shared AdaptiveRateLimiter allows. Returns the UploadStats.
+
+    With sync_state, contacts the account already has or that an earlier run recorded in
+    that state file are skipped, so reruns only upload what is missing.
+    """
+    credentials = credentials or delegated_credentials(json_path, user_email)
+    limiter = AdaptiveRateLimiter(rate=rate, max_rate=max_rate)
+    stage = instrumentation.stage('import_contacts', user=user_email)
+    stats = UploadStats(stage)
+    started = time.monotonic()
+    service = build_people_service(credentials, api_endpoint)
+    index = None
+    if sync_state:
+        index = ContactIndex(sync_state)
+        existing = index.load_remote(service)
+        print(f"Indexed {existing} existing contacts of {user_email}")
+    batches = queue.Queue(maxsize=workers * 2)
+    threads = [threading.Thread(target=upload_worker,
+                                args=(build_people_service(credentials, api_endpoint), batches, limiter, stats, index))
+               for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        group_cache = resolve_contact_groups(service, contacts_folder)
+        for batch in iter_contact_batches(contacts_folder, service, group_cache, set(), index, parse_workers):
+            stage.add(parsed=len(batch))
+            batches.put(batch)
+    finally:
+        for _ in threads:
+            batches.put(None)
+        for thread in threads:
+            thread.join()
+        if index is not None:
+            index.close()
+    stage.finish()
+    elapsed = time.monotonic() - started
+    print(f"Created {stats.get('created')} contacts for {user_email} in {elapsed:.1f}s "
+          f"({stats.get('failed')} failed, {stats.get('throttled')} throttled calls)")
+    return stats
+
+def load_people_discovery():
+    """
+    Returns the parsed People API discovery document, from the copy bundled with
+    google-api-python-client when there is one.
+    """
+    try:
+        from googleapiclient import discovery_cache
+        document = discovery_cache.get_static_doc('people', 'v1')
+    except ImportError:
+        document = None
+    if document is None:
+        document = build('people', 'v1', credentials=AnonymousCredentials())._rootDesc
+    return json.loads(document) if isinstance(document, str) else document
+
+class CredentialCache:
+    """
+    Delegated credentials per user, derived from one service account key and refreshed
+    refresh_margin seconds before they expire, so requests never stop for a token fetch.
+    With anonymous (local fake API only) no tokens are fetched at all.
+    """
+    def __init__(self, json_path=None, refresh_margin=300, anonymous=False):
+        self.base = None if anonymous else service_account.Credentials.from_service_account_file(json_path, scopes=SCOPES)
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)
+        self.lock = threading.Lock()
+        self.users = {}
+
+    def get(self, user_email):
+        with self.lock:
+            if user_email not in self.users:
+                credentials = AnonymousCredentials() if self.base is None else self.base.with_subject(user_email)
+                self.users[user_email] = (credentials, threading.Lock())
+            credentials, lock = self.users[user_email]
+        if self.base is None:
+            return credentials
+        with lock:
+            now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            if not credentials.valid or (credentials.expiry and credentials.expiry - now < self.refresh_margin):
+                credentials.refresh(google_auth_httplib2.Request(httplib2.Http()))
+        return credentials
+
+class TenantImporter:
+    """
+    Imports contacts for many delegated users in one process. Up to max_users users are
+    parsed at a time, at most per_tenant of them from the same domain. Their batches go to
+    one shared pool of upload threads; each thread keeps its own HTTP connection for all
+    the users it serves, and every client is built from one parsed discovery document.
+    """
+    def __init__(self, json_path, max_users=8, per_tenant=4, upload_workers=16, per_user_inflight=4,
+                 rate=1.0, max_rate=10.0, api_endpoint=None, anonymous=False, sync_dir=None, parse_workers=0):
+        self.credentials = CredentialCache(json_path, anonymous=anonymous)
+        self.discovery = load_people_discovery()
+        self.client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+        self.max_users = max_users
+        self.per_tenant = per_tenant
+        self.upload_workers = upload_workers
+        self.per_user_inflight = per_user_inflight
+        self.rate = rate
+        self.max_rate = max_rate
+        self.sync_dir = sync_dir
+        self.parse_workers = parse_workers
+        if sync_dir:
+            os.makedirs(sync_dir, exist_ok=True)
+        self.local = threading.local()
+
+    def service_for(self, user_email):
+        """
+        Returns this thread's People API client for a user, reusing the thread's connection.
+        """
+        if not hasattr(self.local, 'http'):
+            self.local.http = httplib2.Http(timeout=120)
+            self.local.services = {}
+        services = self.local.services
+        if user_email not in services:
+            if len(services) >= 8:
+                services.clear()
+            authorized_http = google_auth_httplib2.AuthorizedHttp(self.credentials.get(user_email), http=self.local.http)
+            services[user_email] = build_from_document(self.discovery, http=authorized_http,
+                                                       client_options=self.client_options)
+        return services[user_email]
+
+    def send(self, user_email, batch, limiter, stats, index=None):
+        self.credentials.get(user_email)
+        if send_batch(self.service_for(user_email), batch, limiter, stats) and index is not None:
+            index.record(batch)
+
+    def import_user(self, user_email, contacts_folder, uploads):
+        started = time.monotonic()
+        stage = instrumentation.stage('import_contacts', user=user_email)
+        stats = UploadStats(stage)
+        result = {'user': user_email, 'folder': contacts_folder, 'error': ''}
+        index = None
+        try:
+            if not os.path.isdir(contacts_folder):
+                raise FileNotFoundError(f"Contacts folder not found: {contacts_folder}")
+            limiter = AdaptiveRateLimiter(rate=self.rate, max_rate=self.max_rate)
+            inflight = threading.BoundedSemaphore(self.per_user_inflight)
+            service = self.service_for(user_email)
+            if self.sync_dir:
+                index = ContactIndex(os.path.join(self.sync_dir, f'{user_email}.sync'))
+                index.load_remote(service)
+            group_cache = resolve_contact_groups(service, contacts_folder)
+            futures = []
+            for batch in iter_contact_batches(contacts_folder, service, group_cache, set(), index, self.parse_workers):
+                stage.add(parsed=len(batch))
+                # Only a few batches per user wait for an upload thread at a time
+                inflight.acquire()
+                future = uploads.submit(self.send, user_email, batch, limiter, stats, index)
+                future.add_done_callback(lambda _: inflight.release())
+                futures.append(future)
+            concurrent.futures.wait(futures)
+        except Exception as e:
+            print(f"Error importing contacts for {user_email}: {e}")
+            result['error'] = str(e)
+            stage.error(str(e))
+        finally:
+            if index is not None:
+                index.close()
+            stage.finish('failed' if result['error'] else 'completed')
+        result.update(created=stats.get('created'), failed=stats.get('failed'), throttled=stats.get('throttled'),
+                      seconds=round(time.monotonic() - started, 1))
+        return result
+
+    def run(self, jobs):
+        """
+        Imports every (user_email, contacts_folder) job and returns one result dict per user.
+        """
+        pending = list(jobs)
+        running = {}
+        tenant_running = {}
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.upload_workers) as uploads, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.max_users) as users:
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= self.max_users:
+                        break
+                    tenant = job[0].rpartition('@')[2].lower()
+                    if tenant_running.get(tenant, 0) >= self.per_tenant:
+                        continue
+                    pending.remove(job)
+                    tenant_running[tenant] = tenant_running.get(tenant, 0) + 1
+                    running[users.submit(self.import_user, job[0], job[1], uploads)] = tenant
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    tenant_running[running.pop(future)] -= 1
+                    results.append(future.result())
+        return results
+
+def read_jobs(csv_path):
+    """
+    Reads (user_email, contacts_folder) pairs from a CSV file; a header row and lines starting with '#' are skipped.
+    """
+    jobs = []
+    with open(csv_path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0].startswith('#') or row[0].strip().lower() in ('user', 'user_email', 'email'):
+                continue
+            jobs.append((row[0].strip(), row[1].strip()))
+    return jobs
+
+def print_summary(results, summary_path=None):
+    print("---")
+    print(f"{'User':40} {'Created':>8} {'Failed':>7} {'Throttled':>9} {'Seconds':>8}  Error")
+    for result in sorted(results, key=lambda r: r['user']):
+        print(f"{result['user']:40} {result['created']:>8} {result['failed']:>7} {result['throttled']:>9} "
+              f"{result['seconds']:>8}  {result['error']}")
+    print(f"{len(results)} users, {sum(r['created'] for r in results)} contacts created, "
+          f"{sum(r['failed'] for r in results)} failed, {sum(1 for r in results if r['error'])} users with errors")
+    if summary_path:
+        with open(summary_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['user', 'folder', 'created', 'failed', 'throttled', 'seconds', 'error'])
+            writer.writeheader()
+            writer.writerows(results)
+
+def main_batch(json_path, csv_path, summary_path=None, **options):
+    importer = TenantImporter(json_path, **options)
+    results = importer.run(read_jobs(csv_path))
+    print_summary(results, summary_path)
+    return results
 
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
-        print("Usage: python takeout_contacts_to_google_workspace.py <path_to_json> <user_email> <path_to_contacts_folder>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Import Google Takeout contacts (.vcf) into a Workspace user's contacts.")
+    parser.add_argument('json_path', nargs='?', help="service account key file (not needed with --compare-parsers)")
+    parser.add_argument('user_email', nargs='?', help="user whose contacts are imported")
+    parser.add_argument('contacts_folder', nargs='?', help="folder searched for .vcf files")
+    parser.add_argument('--batch-delay', type=float, default=5, help="seconds between batches in the sequential mode")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="parse and upload concurrently with an adaptive rate limit instead of fixed delays")
+    parser.add_argument('--workers', type=int, default=4, help="concurrent upload workers (per user in batch mode) in the pipelined mode")
+    parser.add_argument('--rate', type=float, default=1.0, help="initial batches per second in the pipelined mode")
+    parser.add_argument('--max-rate', type=float, default=10.0, help="highest batches per second in the pipelined mode")
+    parser.add_argument('--api-endpoint', help="send API calls here instead of Google, e.g. a local fake_people_api")
+    parser.add_argument('--anonymous', action='store_true', help="send no credentials (only for a local fake API)")
+    parser.add_argument('--batch', metavar='CSV', help="import many users from a CSV of user_email,contacts_folder rows")
+    parser.add_argument('--max-users', type=int, default=8, help="users imported at the same time in batch mode")
+    parser.add_argument('--per-tenant', type=int, default=4, help="users of the same domain imported at the same time in batch mode")
+    parser.add_argument('--summary', help="also write the batch summary to this CSV file")
+    parser.add_argument('--sync', metavar='STATE',
+                        help="skip contacts the account already has and record uploads in this state file "
+                             "(a directory of per-user files in batch mode); implies --pipeline")
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help="parse .vcf files with the streaming parser in this many processes instead of vobject")
+    parser.add_argument('--compare-parsers', action='store_true',
+                        help="only check that the streaming parser reads contacts_folder the same as vobject; "
+                             "the folder may be the only argument")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args('contacts', args)
+
+    if args.compare_parsers:
+        # No credentials are used, so a lone positional argument is the folder
+        contacts_folder = args.contacts_folder or (args.json_path if not args.user_email else None)
+        if not contacts_folder:
+            parser.error("contacts_folder is required with --compare-parsers")
+        sys.exit(1 if compare_parsers(contacts_folder, max(args.parse_workers, 1)) else 0)
+    if not args.json_path and not (args.anonymous and (args.batch or args.pipeline or args.sync)):
+        parser.error("json_path is required")
 
-    json_path = sys.argv[1]
-    user_email = sys.argv[2]
-    contacts_folder = sys.argv[3]
+    if args.batch:
+        main_batch(args.json_path, args.batch, summary_path=args.summary, max_users=args.max_users,
+                   per_tenant=args.per_tenant, upload_workers=args.workers * args.max_users, rate=args.rate,
+                   max_rate=args.max_rate, api_endpoint=args.api_endpoint, anonymous=args.anonymous,
+                   sync_dir=args.sync, parse_workers=args.parse_workers)
+        sys.exit(0)
+    if not args.user_email or not args.contacts_folder:
+        parser.error("user_email and contacts_folder are required unless --batch is given")
 
-    main(json_path, user_email, contacts_folder)
+    if args.pipeline or args.sync:
+        credentials = AnonymousCredentials() if args.anonymous else None
+        main_pipelined(args.json_path, args.user_email, args.contacts_folder, workers=args.workers, rate=args.rate,
+                       max_rate=args.max_rate, api_endpoint=args.api_endpoint, credentials=credentials,
+                       sync_state=args.sync, parse_workers=args.parse_workers)
+    else:
+        main(args.json_path, args.user_email, args.contacts_folder, batch_delay=args.batch_delay,
+             parse_workers=args.parse_workers)
@@ -0,0 +1,119 @@
+'''
+This software is Copyright (c) 2024 Theodore Jones Information Technology Consulting 
+(a DBA of Blueprint Cyber Solutions LLC)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to elsewhere, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# Reads the Mail mbox files of Takeout archives straight out of the zips, without extracting them.
+
+import io
+import os
+import re
+import zipfile
+
+MAIL_MEMBER = re.compile(r'^Takeout/Mail/([^/]+\.mbox)$')
+PART_NUMBER = re.compile(r'-(\d+)\.zip$')
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+def part_order(zip_path):
+    match = PART_NUMBER.search(os.path.basename(zip_path))
+    return (int(match.group(1)) if match else 0, os.path.basename(zip_path))
+
+def find_mail_members(zip_paths):
+    """
+    Returns {mbox name: [(zip_path, member name), ...]} for the Takeout/Mail/*.mbox
+    members of a set of Takeout parts. A mailbox split across several parts lists its
+    pieces in part order.
+    """
+    mailboxes = {}
+    for zip_path in sorted(zip_paths, key=part_order):
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            for name in zip_ref.namelist():
+                match = MAIL_MEMBER.match(name)
+                if match:
+                    mailboxes.setdefault(match.group(1), []).append((zip_path, name))
+    return mailboxes
+
+class ZipMailStream(io.RawIOBase):
+    """
+    Sequential, read-only file object that presents zip members as one continuous mbox.
+    pieces is a list of (mailbox name, zip_path, member name). Consecutive pieces of the
+    same mailbox are joined as they are; a newline is added between different mailboxes
+    when needed so the next one's first 'From ' line starts a new message.
+    Only one member is open and being decompressed at a time.
+    """
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+        self.zip_ref = None
+        self.member = None
+        self.mailbox = None
+        self.last_byte = b'\n'
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def open_next(self):
+        self.close_member()
+        if not self.pieces:
+            return False
+        mailbox, zip_path, name = self.pieces.pop(0)
+        if self.mailbox is not None and mailbox != self.mailbox and self.last_byte != b'\n':
+            self.pending = b'\n'
+        self.mailbox = mailbox
+        self.zip_ref = zipfile.ZipFile(zip_path)
+        self.member = self.zip_ref.open(name)
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if self.pending:
+                size = min(len(buffer), len(self.pending))
+                buffer[:size] = self.pending[:size]
+                self.pending = self.pending[size:]
+                self.last_byte = bytes(buffer[size - 1:size])
+                return size
+            if self.member is None and not self.open_next():
+                return 0
+            size = self.member.readinto(buffer)
+            if size:
+                self.last_byte = bytes(buffer[size - 1:size])
+                return size
+            if not self.open_next():
+                return 0
+
+    def close_member(self):
+        if self.member is not None:
+            self.member.close()
+            self.member = None
+        if self.zip_ref is not None:
+            self.zip_ref.close()
+            self.zip_ref = None
+
+    def close(self):
+        self.close_member()
+        super().close()
+
+def open_mail_stream(zip_paths, mailboxes=None, members=None):
+    """
+    Opens the Mail mbox files found in a set of Takeout zips (or just the named
+    mailboxes) as one buffered, continuous message stream. members, if given, is
+    the find_mail_members result for zip_paths, so the zips are not listed again.
+    """
+    if members is None:
+        members = find_mail_members(zip_paths)
+    pieces = []
+    for mailbox in sorted(members) if mailboxes is None else mailboxes:
+        pieces.extend((mailbox, zip_path, name) for zip_path, name in members.get(mailbox, []))
+    return io.BufferedReader(ZipMailStream(pieces), buffer_size=STREAM_BUFFER_SIZE)
@@ -20,12 +20,38 @@ import re
 import zipfile
 import shutil
 import sys
-import mailbox
 import logging
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import tempfile
+import threading
+import time
+
+import instrumentation
+import mbox_extract
+import takeout_mail_source
 
 # Configure logging
 logging.basicConfig(filename='unroll.log', level=logging.ERROR)
 
+COPY_BUFFER_SIZE = 1024 * 1024
+# ioctl request that clones a file's extents on copy-on-write filesystems (btrfs, XFS, ZFS 2.2+)
+FICLONE = 0x40049409
+print_lock = threading.Lock()
+rename_lock = threading.Lock()
+# Ownership detection reads loose mbox files backwards in blocks of this size
+OWNER_BLOCK_SIZE = 1024 * 1024
+MAX_HEADER_BYTES = 256 * 1024
+JOURNAL_NAME = 'unroll_journal.jsonl'
+# The optional fast hash covers the size plus this many bytes from each end of an archive
+FAST_HASH_BYTES = 1024 * 1024
+MERGED_MBOX_NAME = 'merged.mbox'
+ARCHIVE_OWNER = re.compile(r'<h1 class="header_title">Archive for (.+?)</h1>')
+
 def extract_user_id(filename):
     match = re.search(r'^takeout-\d{8}T\d{6}Z', filename)
     if match:
@@ -38,7 +64,677 @@ def extract_email(to_field):
         return match.group()
     return None
 
-def process_archives(folder_path):
+def tail_message_offsets(f, size, count):
+    """
+    Reads an mbox backwards from the end in blocks and returns the offsets of its
+    last `count` messages, without touching the rest of the file.
+    """
+    separator = mbox_extract.FROM_SEPARATOR
+    offsets = []
+    end = size
+    carry = b''
+    while end > 0 and len(offsets) < count:
+        start = max(0, end - OWNER_BLOCK_SIZE)
+        f.seek(start)
+        # Keep the head of the previous block so separators straddling the boundary are found
+        block = f.read(end - start) + carry
+        pos = len(block)
+        while len(offsets) < count:
+            idx = block.rfind(separator, 0, pos)
+            if idx < 0:
+                break
+            offsets.append(start + idx + 1)
+            pos = idx
+        carry = block[:len(separator) - 1]
+        end = start
+    if end == 0 and len(offsets) < count:
+        f.seek(0)
+        if f.read(5) == b'From ':
+            offsets.append(0)
+    offsets.reverse()
+    return offsets
+
+def read_message_headers(f, offset):
+    f.seek(offset)
+    data = b''
+    while len(data) < MAX_HEADER_BYTES:
+        chunk = f.read(64 * 1024)
+        if not chunk:
+            break
+        data += chunk
+        header_end = mbox_extract.find_header_end(data, 0, len(data))
+        if header_end < len(data):
+            return data[:header_end]
+    return data
+
+def count_recipients(header_blocks):
+    email_counts = {}
+    for headers in header_blocks:
+        to_field = mbox_extract.parse_raw_headers(headers, ('to',)).get('to')
+        if to_field:
+            to_email = extract_email(to_field)
+            if to_email:
+                email_counts[to_email] = email_counts.get(to_email, 0) + 1
+    return email_counts
+
+def pick_owner(email_counts, min_confidence=0.0):
+    """
+    Returns (owner, confidence) for the most common recipient. owner is None when the
+    sample is empty, the top address ties with another, or (if min_confidence is set)
+    it holds less than min_confidence of the sample.
+    """
+    if not email_counts:
+        return None, 0.0
+    ranked = sorted(email_counts.items(), key=lambda item: item[1], reverse=True)
+    confidence = ranked[0][1] / sum(email_counts.values())
+    if confidence < min_confidence or (len(ranked) > 1 and ranked[1][1] == ranked[0][1]):
+        return None, confidence
+    return ranked[0][0], confidence
+
+@instrumentation.timed('detect_owner')
+def detect_mbox_owner(source, sample_size=500, min_confidence=0.0):
+    """
+    Guesses which user an mbox belongs to from the To headers of its last
+    sample_size messages. For a file path only those messages' headers are read, so
+    the cost does not depend on the size of the file; a stream (such as mail read
+    out of Takeout zips) is read through once. Returns (owner, confidence, email_counts).
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            offsets = tail_message_offsets(f, size, sample_size)
+            email_counts = count_recipients(read_message_headers(f, offset) for offset in offsets)
+    else:
+        recent = collections.deque(maxlen=sample_size)
+        for message in mbox_extract.iter_stream_messages(source):
+            recent.append(message[:mbox_extract.find_header_end(message, 0, len(message))])
+        email_counts = count_recipients(recent)
+    owner, confidence = pick_owner(email_counts, min_confidence)
+    return owner, confidence, email_counts
+
+def describe_counts(email_counts, limit=3):
+    total = sum(email_counts.values())
+    ranked = sorted(email_counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return ', '.join(f"{email} ({count * 100 // total}%)" for email, count in ranked)
+
+def same_archive(recorded, current):
+    # The hash is only compared when both runs computed one
+    if recorded['size'] != current['size'] or recorded['mtime_ns'] != current['mtime_ns']:
+        return False
+    return recorded.get('hash') is None or current.get('hash') is None or recorded['hash'] == current['hash']
+
+class UnrollJournal:
+    """
+    Append-only JSON-lines record of the completed steps of an unroll, kept in the
+    target folder so a rerun can skip finished work. Archives are keyed on size,
+    mtime and optionally a fast hash, so changed or new Takeout parts are redone.
+    User steps are cleared whenever one of the user's archives is extracted again.
+    """
+    def __init__(self, path, fast_hash=False):
+        self.path = path
+        self.fast_hash = fast_hash
+        self.lock = threading.Lock()
+        self.archives = {}
+        self.users = {}
+        self.fingerprints = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        self.replay(json.loads(line))
+                    except ValueError:
+                        # A crash can leave the last line half written
+                        continue
+        self.file = open(path, 'a')
+
+    def replay(self, entry):
+        if 'archive' in entry:
+            archive = self.archives.get(entry['archive'])
+            if archive is None or not same_archive(archive['fingerprint'], entry['fingerprint']):
+                archive = self.archives[entry['archive']] = {'fingerprint': entry['fingerprint'], 'steps': set()}
+            archive['steps'].add(entry['step'])
+        elif 'user' in entry:
+            user = self.users.setdefault(entry['user'], {'steps': set(), 'folder': None, 'organized': False})
+            if entry['step'] == 'pending':
+                user['steps'].clear()
+            else:
+                user['steps'].add(entry['step'])
+            if entry['step'] == 'drive_organized':
+                user['organized'] = True
+            if entry.get('folder'):
+                user['folder'] = entry['folder']
+
+    def append(self, entry):
+        entry['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with self.lock:
+            self.replay(entry)
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def fingerprint(self, path):
+        if path not in self.fingerprints:
+            stat = os.stat(path)
+            fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            if self.fast_hash:
+                digest = hashlib.blake2b(str(stat.st_size).encode('ascii'), digest_size=16)
+                with open(path, 'rb') as f:
+                    digest.update(f.read(FAST_HASH_BYTES))
+                    if stat.st_size > FAST_HASH_BYTES:
+                        f.seek(max(FAST_HASH_BYTES, stat.st_size - FAST_HASH_BYTES))
+                        digest.update(f.read(FAST_HASH_BYTES))
+                fingerprint['hash'] = digest.hexdigest()
+            self.fingerprints[path] = fingerprint
+        return self.fingerprints[path]
+
+    def archive_done(self, file, fingerprint, step):
+        archive = self.archives.get(file)
+        return archive is not None and same_archive(archive['fingerprint'], fingerprint) and step in archive['steps']
+
+    def record_archive(self, file, fingerprint, step):
+        self.append({'archive': file, 'fingerprint': fingerprint, 'step': step})
+
+    def user_done(self, user_id, step):
+        return step in self.users.get(user_id, {'steps': ()})['steps']
+
+    def record_user(self, user_id, step, folder=None):
+        entry = {'user': user_id, 'step': step}
+        if folder:
+            entry['folder'] = folder
+        self.append(entry)
+
+    def user_folder(self, user_id):
+        return self.users.get(user_id, {}).get('folder')
+
+    def user_organized(self, user_id):
+        return self.users.get(user_id, {}).get('organized', False)
+
+    def close(self):
+        self.file.close()
+
+def resolve_user_folder(folder_path, user_id, journal=None):
+    """
+    Returns where a user's files live: the folder a previous run renamed it to, if any.
+    """
+    if journal is not None:
+        folder = journal.user_folder(user_id)
+        if folder and os.path.isdir(os.path.join(folder_path, folder)):
+            return os.path.join(folder_path, folder)
+    return os.path.join(folder_path, user_id)
+
+def extract_direct(user_id, direct, journal=None):
+    """
+    Whether a user's archives go straight to their final layout. Archives arriving
+    after the user folder was organized by an earlier run always do, since
+    reorganizing the whole folder would move already placed Drive content again.
+    """
+    return direct or (journal is not None and journal.user_organized(user_id))
+
+def archive_finished(folder_path, file, journal, *steps):
+    if journal is None:
+        return False
+    fingerprint = journal.fingerprint(os.path.join(folder_path, file))
+    return all(journal.archive_done(file, fingerprint, step) for step in steps or ('extracted', 'retained'))
+
+def user_finished(user_id, journal, direct=False):
+    steps = ['renamed', 'mbox_moved'] if direct else ['drive_organized', 'renamed', 'mbox_moved']
+    return journal is not None and all(journal.user_done(user_id, step) for step in steps)
+
+def merge_move(src, dest):
+    """
+    Moves src to dest; a directory whose destination already exists is merged into it.
+    """
+    if os.path.isdir(src) and os.path.isdir(dest):
+        for item in os.listdir(src):
+            merge_move(os.path.join(src, item), os.path.join(dest, item))
+        os.rmdir(src)
+    else:
+        shutil.move(src, dest)
+
+class DigestSet:
+    """
+    Compact set of 64-bit message digests: an open-addressing hash table of fixed-width
+    slots, 11 to 22 bytes per message instead of the ~100 a Python set of bytes needs.
+    With spill_dir the table lives in a memory-mapped temporary file, so the kernel
+    can page it out and resident memory stays bounded.
+    """
+    def __init__(self, capacity=1 << 20, spill_dir=None):
+        self.spill_dir = spill_dir
+        self.count = 0
+        self.storage, self.slots = self.allocate(capacity)
+
+    def allocate(self, capacity):
+        if self.spill_dir is None:
+            storage = bytearray(capacity * 8)
+        else:
+            with tempfile.TemporaryFile(dir=self.spill_dir) as f:
+                f.truncate(capacity * 8)
+                storage = mmap.mmap(f.fileno(), capacity * 8)
+        return storage, memoryview(storage).cast('Q')
+
+    def add(self, digest):
+        """
+        Adds a digest (int) and returns False if it was already present.
+        """
+        digest = digest or 1  # 0 marks an empty slot
+        mask = len(self.slots) - 1
+        index = digest & mask
+        while True:
+            slot = self.slots[index]
+            if slot == 0:
+                break
+            if slot == digest:
+                return False
+            index = (index + 1) & mask
+        self.slots[index] = digest
+        self.count += 1
+        if self.count * 4 > len(self.slots) * 3:
+            self.grow()
+        return True
+
+    def grow(self):
+        old_storage, old_slots = self.storage, self.slots
+        self.storage, self.slots = self.allocate(len(old_slots) * 2)
+        mask = len(self.slots) - 1
+        for digest in old_slots:
+            if digest:
+                index = digest & mask
+                while self.slots[index]:
+                    index = (index + 1) & mask
+                self.slots[index] = digest
+        old_slots.release()
+        if isinstance(old_storage, mmap.mmap):
+            old_storage.close()
+
+    def close(self):
+        self.slots.release()
+        if isinstance(self.storage, mmap.mmap):
+            self.storage.close()
+
+def message_digest(data, start, end):
+    """
+    Returns a 64-bit dedupe key for a message: its Message-ID, or when it has none,
+    its content without the 'From ' line, which differs between exports, and without
+    trailing line breaks, which differ for the last message of a file.
+    """
+    header_end = mbox_extract.find_header_end(data, start, end)
+    message_id = mbox_extract.parse_raw_headers(data[start:header_end], ('message-id',)).get('message-id')
+    if message_id:
+        key = hashlib.blake2b(b'id:' + message_id.encode('utf-8'), digest_size=8)
+    else:
+        body_start = data.find(b'\n', start, end) + 1 or end
+        while end > body_start and data[end - 1] in b'\r\n':
+            end -= 1
+        key = hashlib.blake2b(b'raw:', digest_size=8)
+        with memoryview(data) as view:
+            key.update(view[body_start:end])
+    return int.from_bytes(key.digest(), 'little')
+
+def unused_path(folder, name):
+    """
+    Returns folder/name, or folder/<stem>.<n><ext> for the first n that does not exist yet.
+    """
+    path = os.path.join(folder, name)
+    stem, ext = os.path.splitext(name)
+    n = 1
+    while os.path.exists(path):
+        path = os.path.join(folder, f"{stem}.{n}{ext}")
+        n += 1
+    return path
+
+def merge_user_mboxes(user_folder, spill_dir=None):
+    """
+    Streams all of a user's mbox files into mbox/merged.mbox, dropping messages whose
+    Message-ID (or content, without one) was already seen. The originals are moved to
+    mbox_premerge/ so only the merged file is left for restore; a name already kept
+    there by an earlier merge gets a numbered suffix instead of being overwritten.
+    """
+    mbox_folder = os.path.join(user_folder, 'mbox')
+    sources = sorted(f for f in os.listdir(mbox_folder) if f.endswith('.mbox'))
+    if len(sources) < 2:
+        return
+    print(f"Merging {len(sources)} Mbox files for {os.path.basename(user_folder)}")
+    partial_path = os.path.join(mbox_folder, MERGED_MBOX_NAME + '.partial')
+    seen = DigestSet(spill_dir=spill_dir)
+    kept = 0
+    duplicates = 0
+    read_bytes = 0
+    try:
+        with open(partial_path, 'wb', buffering=COPY_BUFFER_SIZE) as output, \
+                instrumentation.stage('merge_mbox', user=os.path.basename(user_folder)) as stage:
+            for source in sources:
+                data = mbox_extract.open_mbox_map(os.path.join(mbox_folder, source))
+                if data is None:
+                    continue
+                try:
+                    released = 0
+                    for start, end in mbox_extract.iter_message_spans(data):
+                        if seen.add(message_digest(data, start, end)):
+                            mbox_extract.write_message(output, data, start, end)
+                            kept += 1
+                        else:
+                            duplicates += 1
+                        released = mbox_extract.release_scanned(data, released, start)
+                    read_bytes += len(data)
+                    stage.update(messages=kept + duplicates, bytes=read_bytes)
+                finally:
+                    data.close()
+            stage.add(duplicates=duplicates)
+    finally:
+        seen.close()
+
+    premerge_folder = os.path.join(user_folder, 'mbox_premerge')
+    os.makedirs(premerge_folder, exist_ok=True)
+    for source in sources:
+        os.replace(os.path.join(mbox_folder, source), unused_path(premerge_folder, source))
+    os.replace(partial_path, os.path.join(mbox_folder, MERGED_MBOX_NAME))
+    print(f"Merged {kept} messages, dropped {duplicates} duplicates; originals moved to {premerge_folder}")
+
+def member_path(filename):
+    # Same sanitizing as zipfile.extract: drop drive letters, absolute paths and '..' components
+    arcname = filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    return os.path.sep.join(x for x in arcname.split(os.path.sep) if x not in ('', os.path.curdir, os.path.pardir))
+
+def final_member_path(arcname, is_dir):
+    """
+    Maps a Takeout member to where the unrolled user folder ends up keeping it:
+    Drive content in the Takeout root, Mail/*.mbox in mbox/ and every other
+    service under 'Other Google Services'.
+    """
+    parts = arcname.split(os.path.sep)
+    if parts[0] != 'Takeout' or len(parts) < 2 or (len(parts) == 2 and not is_dir):
+        return arcname
+    service = parts[1]
+    if service in ('Drive', 'drive'):
+        return os.path.join('Takeout', *parts[2:])
+    if service == 'Mail' and len(parts) == 3 and parts[2].endswith('.mbox') and not is_dir:
+        return os.path.join('mbox', parts[2])
+    return os.path.join('Takeout', 'Other Google Services', *parts[1:])
+
+def extract_archive(zip_path, dest_folder, place=None):
+    """
+    Extracts every member of a zip into dest_folder. Unlike zipfile.extractall this is
+    safe while other archives extract into the same folder. place, if given, maps each
+    member's relative path (and whether it is a directory) to the path it is written to.
+    Returns (members, bytes).
+    """
+    members = 0
+    total_bytes = 0
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            arcname = member_path(member.filename)
+            if not arcname:
+                continue
+            if place:
+                arcname = place(arcname, member.is_dir())
+            target = os.path.join(dest_folder, arcname)
+            if member.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with zip_ref.open(member) as source, open(target, 'wb') as dest:
+                shutil.copyfileobj(source, dest, COPY_BUFFER_SIZE)
+            members += 1
+            total_bytes += member.file_size
+    return members, total_bytes
+
+def reflink(src, dest):
+    import fcntl
+    with open(src, 'rb') as source, open(dest, 'wb') as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+def retain_archive(zip_path, dest_folder, mode='copy'):
+    """
+    Keeps a Takeout zip in dest_folder. 'move' renames it there and 'link' hardlinks
+    or reflinks it, so neither rewrites the data; both fall back to a full copy when
+    the filesystem cannot do it. Returns how the archive was kept.
+    """
+    dest = os.path.join(dest_folder, os.path.basename(zip_path))
+    if os.path.exists(dest) and os.path.samefile(zip_path, dest):
+        return 'already retained'
+    if mode == 'move':
+        try:
+            os.rename(zip_path, dest)
+            return 'renamed'
+        except OSError:
+            pass
+    elif mode == 'link':
+        try:
+            os.link(zip_path, dest)
+            return 'hardlinked'
+        except OSError:
+            pass
+        try:
+            reflink(zip_path, dest)
+            shutil.copystat(zip_path, dest)
+            return 'reflinked'
+        except (OSError, ImportError):
+            if os.path.exists(dest):
+                os.remove(dest)
+    shutil.copy2(zip_path, dest)
+    return 'copied'
+
+def report(message):
+    # One write per line so output from concurrent workers does not interleave
+    with print_lock:
+        print(message, flush=True)
+
+def process_archive(folder_path, user_folder, file, retain='copy', direct=False, journal=None, user_id=None):
+    """
+    Extracts one Takeout zip into the user folder and keeps the zip under zips/.
+    With direct, members are written straight to their final place in the user folder.
+    Steps the journal already records for this exact archive are skipped.
+    An archive that fails to extract is left where it is; returns the error, or None.
+    """
+    zip_path = os.path.join(folder_path, file)
+    fingerprint = journal.fingerprint(zip_path) if journal is not None else None
+    if journal is not None and journal.archive_done(file, fingerprint, 'extracted'):
+        report(f"Skipping extraction of {file}, already extracted")
+    else:
+        if journal is not None:
+            journal.record_user(user_id, 'pending')
+        report(f"Extracting archive: {file}")
+        started = time.monotonic()
+        with instrumentation.stage('extract_archive', user=user_id, archive=file) as stage:
+            try:
+                members, total_bytes = extract_archive(zip_path, user_folder, place=final_member_path if direct else None)
+                stage.add(bytes=total_bytes, files=members)
+                report(f"Extracted archive: {file} ({members} files, {total_bytes} bytes in {time.monotonic() - started:.1f}s)")
+                if journal is not None:
+                    journal.record_archive(file, fingerprint, 'extracted')
+            except Exception as e:
+                stage.error(str(e))
+                logging.error(f"Error extracting archive {file}: {str(e)}")
+                report(f"Failed to extract archive: {file}, leaving it in place")
+                return str(e)
+
+    if journal is not None and journal.archive_done(file, fingerprint, 'retained'):
+        return None
+    report(f"Copying archive to zips folder: {file}")
+    zip_dest_folder = os.path.join(user_folder, 'zips')
+    os.makedirs(zip_dest_folder, exist_ok=True)
+    with instrumentation.stage('retain_archive', user=user_id, archive=file) as stage:
+        try:
+            archive_bytes = os.path.getsize(zip_path)
+            method = retain_archive(zip_path, zip_dest_folder, retain)
+            stage.add(bytes=archive_bytes, **{method.replace(' ', '_'): 1})
+            if method != 'copied':
+                report(f"Archive {file} {method} into zips folder")
+            if journal is not None:
+                journal.record_archive(file, fingerprint, 'retained')
+        except Exception as e:
+            stage.error(str(e))
+            logging.error(f"Error copying archive {file} to zips folder: {str(e)}")
+    return None
+
+@instrumentation.timed('finish_user')
+def finish_user(folder_path, user_id, direct=False, journal=None):
+    """
+    Runs once all of a user's archives are extracted: organizes Drive contents,
+    renames the user folder to the account's email address and moves the Mbox files.
+    Archives extracted with direct are already organized and only need the rename.
+    """
+    user_folder = resolve_user_folder(folder_path, user_id, journal)
+
+    # Organize drive contents after all zip files are extracted
+    if not direct and not (journal is not None and journal.user_done(user_id, 'drive_organized')):
+        organize_drive_contents(os.path.join(user_folder, 'Takeout'))
+        if journal is not None:
+            journal.record_user(user_id, 'drive_organized')
+    
+    # Parse archive_browser.html to get user email address
+    archive_browser_path = os.path.join(user_folder, 'Takeout', 'archive_browser.html')
+    email = None
+    if os.path.exists(archive_browser_path):
+        with open(archive_browser_path, 'r') as file:
+            content = file.read()
+            match = ARCHIVE_OWNER.search(content)
+            if match:
+                email = match.group(1)
+                new_user_folder = os.path.join(folder_path, email)
+                with rename_lock:
+                    if user_folder != new_user_folder and not os.path.exists(new_user_folder):
+                        try:
+                            shutil.move(user_folder, new_user_folder)
+                            user_folder = new_user_folder
+                        except Exception as e:
+                            logging.error(f"Error renaming user folder {user_folder} to {email}: {str(e)}")
+    if journal is not None:
+        journal.record_user(user_id, 'renamed', os.path.basename(user_folder))
+    
+    # Move Mbox files from Takeout/Mail to mbox folder
+    mail_folder = os.path.join(user_folder, 'Takeout', 'Mail')
+    if os.path.exists(mail_folder):
+        for item in os.listdir(mail_folder):
+            if item.endswith('.mbox'):
+                mbox_folder = os.path.join(user_folder, 'mbox')
+                os.makedirs(mbox_folder, exist_ok=True)
+                try:
+                    shutil.move(os.path.join(mail_folder, item), os.path.join(mbox_folder, item))
+                except Exception as e:
+                    logging.error(f"Error moving Mbox file {item} to mbox folder: {str(e)}")
+    if journal is not None:
+        journal.record_user(user_id, 'mbox_moved')
+    
+    report(f"Finished processing files for user: {user_id}" + (f" ({email})" if email else ""))
+
+def archive_owner_from_zips(zip_paths):
+    """
+    Reads the account address from archive_browser.html inside the zips, without extracting them.
+    """
+    for zip_path in zip_paths:
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            try:
+                content = zip_ref.read('Takeout/archive_browser.html').decode('utf-8', errors='replace')
+            except KeyError:
+                continue
+        match = ARCHIVE_OWNER.search(content)
+        if match:
+            return match.group(1)
+    return None
+
+def unroll_mail_only(folder_path, user_id, files, owner_sample=500, owner_min_confidence=0.0, journal=None):
+    """
+    Writes a user's Mail mbox files straight from the Takeout zips into <email>/mbox/,
+    without extracting anything else. Mailboxes split across parts are joined.
+    Without archive_browser.html the owner is detected from the mail stream itself.
+    Mailboxes the journal records as streamed from these exact archives are skipped.
+    """
+    zip_paths = [os.path.join(folder_path, file) for file in files]
+    fingerprints = {zip_path: journal.fingerprint(zip_path) for zip_path in zip_paths} if journal is not None else {}
+    members = takeout_mail_source.find_mail_members(zip_paths)
+    email = journal.user_folder(user_id) if journal is not None else None
+    if not email:
+        email = archive_owner_from_zips(zip_paths)
+    if not email:
+        with takeout_mail_source.open_mail_stream(zip_paths, members=members) as stream:
+            email, confidence, email_counts = detect_mbox_owner(stream, owner_sample, owner_min_confidence)
+        if not email and email_counts:
+            report(f"Ambiguous owner for {user_id}: {describe_counts(email_counts)}")
+    if journal is not None:
+        journal.record_user(user_id, 'mail_owner', email or user_id)
+    mbox_folder = os.path.join(folder_path, email or user_id, 'mbox')
+    os.makedirs(mbox_folder, exist_ok=True)
+    failed = False
+    for mailbox, pieces in members.items():
+        step = f"streamed {mailbox}"
+        if journal is not None and all(journal.archive_done(os.path.basename(zip_path), fingerprints[zip_path], step)
+                                       for zip_path, _ in pieces):
+            report(f"Skipping {mailbox} of {user_id}, already streamed")
+            continue
+        target = os.path.join(mbox_folder, mailbox)
+        if journal is not None and journal.user_done(user_id, f"wrote {user_id}-{mailbox}"):
+            target = os.path.join(mbox_folder, f"{user_id}-{mailbox}")
+        elif os.path.exists(target) and not (journal is not None and journal.user_done(user_id, f"wrote {mailbox}")):
+            # Another export of the same account already wrote this mailbox
+            target = os.path.join(mbox_folder, f"{user_id}-{mailbox}")
+        with instrumentation.stage('stream_mail', user=user_id, mailbox=mailbox) as stage:
+            try:
+                with takeout_mail_source.open_mail_stream(zip_paths, [mailbox], members) as stream, open(target, 'wb') as output:
+                    shutil.copyfileobj(stream, output, COPY_BUFFER_SIZE)
+                    stage.add(bytes=output.tell())
+                if journal is not None:
+                    journal.record_user(user_id, f"wrote {os.path.basename(target)}")
+                    for zip_path, _ in pieces:
+                        journal.record_archive(os.path.basename(zip_path), fingerprints[zip_path], step)
+            except Exception as e:
+                failed = True
+                stage.error(str(e))
+                logging.error(f"Error streaming Mbox file {mailbox} of {user_id}: {str(e)}")
+    if journal is not None and not failed:
+        for zip_path in zip_paths:
+            journal.record_archive(os.path.basename(zip_path), fingerprints[zip_path], 'mail_streamed')
+    report(f"Finished streaming mail for user: {user_id}" + (f" ({email})" if email else ""))
+
+def process_users_concurrently(folder_path, user_files, workers, retain='copy', direct=False, journal=None, progress=None):
+    """
+    Extracts all archives, of different users and of the same user alike, on a bounded
+    thread pool. Each user is finished as soon as the last of its archives is done.
+    progress(file), if given, is called as each archive is done.
+    Returns {file: error} for the archives that failed to extract.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        remaining = {}
+        finishing = []
+        failed = {}
+        for user_id, files in user_files.items():
+            user_folder = resolve_user_folder(folder_path, user_id, journal)
+            os.makedirs(user_folder, exist_ok=True)
+            remaining[user_id] = len(files)
+            user_direct = extract_direct(user_id, direct, journal)
+            if not files:
+                finishing.append(executor.submit(finish_user, folder_path, user_id, user_direct, journal))
+            for file in files:
+                pending[executor.submit(process_archive, folder_path, user_folder, file, retain, user_direct, journal, user_id)] = (user_id, file)
+
+        for future in concurrent.futures.as_completed(pending):
+            user_id, file = pending[future]
+            try:
+                error = future.result()
+            except Exception as e:
+                logging.error(f"Error processing archive for user {user_id}: {str(e)}")
+                error = str(e)
+            if error:
+                failed[file] = error
+            if progress:
+                progress(file)
+            remaining[user_id] -= 1
+            if remaining[user_id] == 0:
+                finishing.append(executor.submit(finish_user, folder_path, user_id, extract_direct(user_id, direct, journal), journal))
+
+        for future in finishing:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Error finishing user folder: {str(e)}")
+    return failed
+
+def process_archives(folder_path, workers=1, retain='copy', direct=False, owner_sample=500, owner_min_confidence=0.0,
+                     journal=None, merge=False, merge_spill_dir=None, mail_only=False):
     print(f"Processing archives in: {folder_path}")
     
     user_files = {}
@@ -55,92 +751,92 @@ def process_archives(folder_path):
         print(user_id)
     print("---")
     
-    for user_id, files in user_files.items():
-        print(f"Processing files for user: {user_id}")
-        user_folder = os.path.join(folder_path, user_id)
-        os.makedirs(user_folder, exist_ok=True)
-        
-        # Extract all zip files for the user
-        for file in files:
-            zip_path = os.path.join(folder_path, file)
-            print(f"Extracting archive: {file}")
-            try:
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(user_folder)
-            except Exception as e:
-                logging.error(f"Error extracting archive {file}: {str(e)}")
+    if journal is not None and mail_only:
+        # A mailbox can span parts, so all of a user's parts are read again when any of them changed
+        for user_id in list(user_files):
+            if all(archive_finished(folder_path, file, journal, 'mail_streamed') for file in user_files[user_id]):
+                print(f"Skipping user {user_id}, mail already streamed")
+                del user_files[user_id]
+    elif journal is not None:
+        # Only archives that are new or changed since the journaled run need work
+        for user_id in list(user_files):
+            user_files[user_id] = [file for file in user_files[user_id] if not archive_finished(folder_path, file, journal)]
+            if not user_files[user_id] and user_finished(user_id, journal, extract_direct(user_id, direct, journal)):
+                print(f"Skipping user {user_id}, already unrolled")
+                del user_files[user_id]
+    
+    # Sizes are taken up front since archives may be moved away as they are retained
+    archive_sizes = {file: os.path.getsize(os.path.join(folder_path, file)) for files in user_files.values() for file in files}
+    unroll_stage = instrumentation.stage('unroll', total_bytes=sum(archive_sizes.values()), folder=folder_path)
+    
+    def archive_done(file):
+        unroll_stage.add(bytes=archive_sizes[file], archives=1)
+    
+    failed_archives = {}
+    
+    if mail_only:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(unroll_mail_only, folder_path, user_id, files, owner_sample, owner_min_confidence, journal)
+                       for user_id, files in user_files.items()]
+            for future, files in zip(futures, user_files.values()):
+                try:
+                    future.result()
+                except Exception as e:
+                    unroll_stage.error(str(e))
+                    logging.error(f"Error streaming mail: {str(e)}")
+                for file in files:
+                    archive_done(file)
+    elif workers > 1:
+        print(f"Extracting with {workers} workers")
+        failed_archives = process_users_concurrently(folder_path, user_files, workers, retain, direct, journal, archive_done)
+    else:
+        for user_id, files in user_files.items():
+            print(f"Processing files for user: {user_id}")
+            user_folder = resolve_user_folder(folder_path, user_id, journal)
+            os.makedirs(user_folder, exist_ok=True)
+            user_direct = extract_direct(user_id, direct, journal)
             
-            print(f"Copying archive to zips folder: {file}")
-            zip_dest_folder = os.path.join(user_folder, 'zips')
-            os.makedirs(zip_dest_folder, exist_ok=True)
-            try:
-                shutil.copy2(zip_path, zip_dest_folder)
-            except Exception as e:
-                logging.error(f"Error copying archive {file} to zips folder: {str(e)}")
-        
-        # Organize drive contents after all zip files are extracted
-        organize_drive_contents(os.path.join(user_folder, 'Takeout'))
-        
-        # Parse archive_browser.html to get user email address
-        archive_browser_path = os.path.join(user_folder, 'Takeout', 'archive_browser.html')
-        email = None
-        if os.path.exists(archive_browser_path):
-            with open(archive_browser_path, 'r') as file:
-                content = file.read()
-                match = re.search(r'<h1 class="header_title">Archive for (.+?)</h1>', content)
-                if match:
-                    email = match.group(1)
-                    new_user_folder = os.path.join(folder_path, email)
-                    if not os.path.exists(new_user_folder):
-                        try:
-                            shutil.move(user_folder, new_user_folder)
-                            user_folder = new_user_folder
-                        except Exception as e:
-                            logging.error(f"Error renaming user folder {user_folder} to {email}: {str(e)}")
-        
-        # Move Mbox files from Takeout/Mail to mbox folder
-        mail_folder = os.path.join(user_folder, 'Takeout', 'Mail')
-        if os.path.exists(mail_folder):
-            for item in os.listdir(mail_folder):
-                if item.endswith('.mbox'):
-                    mbox_folder = os.path.join(user_folder, 'mbox')
-                    os.makedirs(mbox_folder, exist_ok=True)
-                    try:
-                        shutil.move(os.path.join(mail_folder, item), mbox_folder)
-                    except Exception as e:
-                        logging.error(f"Error moving Mbox file {item} to mbox folder: {str(e)}")
-        
-        print(f"Finished processing files for user: {user_id}")
-        print("---")
+            # Extract all zip files for the user
+            for file in files:
+                error = process_archive(folder_path, user_folder, file, retain, user_direct, journal, user_id)
+                if error:
+                    failed_archives[file] = error
+                archive_done(file)
+            
+            finish_user(folder_path, user_id, user_direct, journal)
+            print("---")
     
+    unroll_stage.finish()
     print("Finished extracting all zip files.")
     print("---")
     
     # Process separate Mbox files
+    skipped_mbox = []
     for file in os.listdir(folder_path):
         if file.endswith('.mbox'):
             mbox_path = os.path.join(folder_path, file)
-            mbox = mailbox.mbox(mbox_path)
-            email_counts = {}
-            num_messages = len(mbox)
-            start_index = max(0, num_messages - 500)
-            for i in range(start_index, num_messages):
-                msg = mbox[i]
-                to_field = msg['To']
-                if to_field:
-                    to_email = extract_email(to_field)
-                    if to_email:
-                        email_counts[to_email] = email_counts.get(to_email, 0) + 1
-            if email_counts:
-                most_common_email = max(email_counts, key=email_counts.get)
-                user_folder = os.path.join(folder_path, most_common_email)
+            if journal is not None and journal.archive_done(file, journal.fingerprint(mbox_path), 'copied_to_owner'):
+                continue
+            owner, confidence, email_counts = detect_mbox_owner(mbox_path, owner_sample, owner_min_confidence)
+            if owner:
+                user_folder = os.path.join(folder_path, owner)
                 if os.path.exists(user_folder):
                     mbox_dest_folder = os.path.join(user_folder, 'mbox')
                     os.makedirs(mbox_dest_folder, exist_ok=True)
                     try:
                         shutil.copy2(mbox_path, mbox_dest_folder)
+                        if journal is not None:
+                            journal.record_archive(file, journal.fingerprint(mbox_path), 'copied_to_owner')
                     except Exception as e:
                         logging.error(f"Error copying Mbox file {file} to {mbox_dest_folder}: {str(e)}")
+                        skipped_mbox.append(f"{file}: copy to {owner} failed: {str(e)}")
+                else:
+                    skipped_mbox.append(f"{file}: owner {owner} has no user folder")
+            elif email_counts:
+                print(f"Ambiguous owner for {file}: {describe_counts(email_counts)}")
+                skipped_mbox.append(f"{file}: ambiguous owner ({confidence:.0%}): {describe_counts(email_counts)}")
+            else:
+                skipped_mbox.append(f"{file}: no recipients found in the sampled messages")
     
     print("Finished processing separate Mbox files.")
     print("---")
@@ -170,6 +866,24 @@ def process_archives(folder_path):
     print("Users with multiple Mbox files:")
     for user in users_with_multiple_mbox:
         print(user)
+    
+    if failed_archives:
+        print("Archives that failed to extract (left in place):")
+        for file, error in sorted(failed_archives.items()):
+            print(f"{file}: {error}")
+    
+    if skipped_mbox:
+        print("Mbox files not copied to an owner:")
+        for line in skipped_mbox:
+            print(line)
+    
+    if merge and users_with_multiple_mbox:
+        print("---")
+        for user in users_with_multiple_mbox:
+            try:
+                merge_user_mboxes(os.path.join(folder_path, user), merge_spill_dir)
+            except Exception as e:
+                logging.error(f"Error merging Mbox files of {user}: {str(e)}")
 
 def organize_drive_contents(takeout_folder):
     drive_folder = None
@@ -189,7 +903,7 @@ def organize_drive_contents(takeout_folder):
             if item_path not in [drive_folder, other_services_folder] and os.path.isdir(item_path):
                 target_path = os.path.join(other_services_folder, item)
                 try:
-                    shutil.move(item_path, target_path)
+                    merge_move(item_path, target_path)
                     print(f"Moved {item} to Other Google Services")
                 except Exception as e:
                     logging.error(f"Error moving {item} to Other Google Services: {str(e)}")
@@ -197,7 +911,7 @@ def organize_drive_contents(takeout_folder):
         # Move Drive contents to Takeout
         for item in os.listdir(drive_folder):
             try:
-                shutil.move(os.path.join(drive_folder, item), takeout_folder)
+                merge_move(os.path.join(drive_folder, item), os.path.join(takeout_folder, item))
                 print(f"Moved {item} from Drive to Takeout")
             except Exception as e:
                 logging.error(f"Error moving {item} from Drive to Takeout: {str(e)}")
@@ -212,13 +926,45 @@ def organize_drive_contents(takeout_folder):
         print("Drive folder not found. Skipping organization of Drive contents.")
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Usage: python takeout_unroll.py <folder_path>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Unroll Google Takeout archives into one folder per user.")
+    parser.add_argument('folder_path', help="folder containing the takeout-*.zip archives")
+    parser.add_argument('--workers', type=int, default=1, help="number of archives extracted at the same time")
+    parser.add_argument('--retain', choices=['copy', 'link', 'move'], default='copy',
+                        help="how zips are kept under zips/: copy, hardlink/reflink, or rename (both fall back to copy)")
+    parser.add_argument('--direct', action='store_true',
+                        help="extract members straight to their final layout instead of moving them afterwards")
+    parser.add_argument('--owner-sample', type=int, default=500,
+                        help="number of trailing messages whose To headers decide who owns a loose mbox")
+    parser.add_argument('--owner-min-confidence', type=float, default=0.0,
+                        help="share of sampled recipients the owner must have, less is reported as ambiguous "
+                             "(default: only a tie or an empty sample is)")
+    parser.add_argument('--journal', action='store_true',
+                        help=f"record finished steps in {JOURNAL_NAME} in the folder and skip them on the next run")
+    parser.add_argument('--journal-hash', action='store_true',
+                        help="also key journaled archives on a hash of their first and last megabyte")
+    parser.add_argument('--merge', action='store_true',
+                        help="merge users' multiple Mbox files into one, dropping duplicate messages")
+    parser.add_argument('--merge-spill-dir',
+                        help="keep the merge dedupe table in a memory-mapped file in this folder instead of in RAM")
+    parser.add_argument('--mail-only', action='store_true',
+                        help="only write each user's Mail mbox files, streamed straight out of the zips")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args('unroll', args)
     
-    folder_path = sys.argv[1]
+    folder_path = args.folder_path
     if not os.path.isdir(folder_path):
         print(f"Error: {folder_path} is not a valid directory.")
         sys.exit(1)
     
-    process_archives(folder_path)
+    journal = None
+    if args.journal or args.journal_hash:
+        journal = UnrollJournal(os.path.join(folder_path, JOURNAL_NAME), fast_hash=args.journal_hash)
+    try:
+        process_archives(folder_path, workers=args.workers, retain=args.retain, direct=args.direct,
+                         owner_sample=args.owner_sample, owner_min_confidence=args.owner_min_confidence,
+                         journal=journal, merge=args.merge, merge_spill_dir=args.merge_spill_dir,
+                         mail_only=args.mail_only)
+    finally:
+        if journal is not None:
+            journal.close()
@@ -0,0 +1,141 @@
+import os
+import random
+
+import pytest
+
+from google.auth.credentials import AnonymousCredentials
+
+import fake_people_api
+import synthetic_takeout
+import takeout_contacts_to_google_workspace as contacts
+
+# Folded lines, quoted-printable, grouped properties and escaped commas
+TRICKY_CONTACTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tricky_contacts')
+
+def write_contacts(folder, count, categories=('Family', 'Work')):
+    rng = random.Random(7)
+    with open(folder / 'contacts.vcf', 'w', newline='') as f:
+        for number in range(count):
+            f.write(synthetic_takeout.vcard_text(rng, number, list(categories)))
+
+def test_pipelined_import_honors_retry_after(tmp_path, monkeypatch):
+    folder = tmp_path / 'contacts'
+    folder.mkdir()
+    write_contacts(folder, 5 * contacts.BATCH_SIZE + 17)
+    server = fake_people_api.start_server(throttle_every=3, retry_after=1)
+    delays = []
+    throttled = contacts.AdaptiveRateLimiter.throttled
+
+    def record_throttled(self, retry_after=None, attempt=0):
+        delays.append(retry_after)
+        return throttled(self, retry_after, attempt)
+
+    monkeypatch.setattr(contacts.AdaptiveRateLimiter, 'throttled', record_throttled)
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}/"
+    options = dict(workers=3, rate=50.0, max_rate=100.0, api_endpoint=endpoint,
+                   credentials=AnonymousCredentials())
+    try:
+        stats = contacts.main_pipelined(None, 'user@example.com', str(folder), **options)
+        assert stats.get('created') == 5 * contacts.BATCH_SIZE + 17
+        assert stats.get('failed') == 0
+        assert len(server.people) == 5 * contacts.BATCH_SIZE + 17
+        # Every third batch create was answered 429 and retried after the server's Retry-After
+        calls = server.requests['people.batchCreateContacts']
+        assert calls == 6 + stats.get('throttled')
+        assert stats.get('throttled') == calls // 3
+        assert delays and all(delay == 1.0 for delay in delays)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_sync_skips_contacts_the_account_or_state_file_has(tmp_path):
+    folder = tmp_path / 'contacts'
+    folder.mkdir()
+    write_contacts(folder, 250)
+    state = str(tmp_path / 'sync.state')
+    people = [contacts.contact_person(fields, lambda name: 'contactGroups/g1')
+              for _, _, fields, _ in contacts.iter_parsed_vcards(str(folder))]
+    server = fake_people_api.start_server()
+    # The account already has the first 100, as if an earlier run failed part way
+    server.people.extend(dict(person, resourceName=f'people/old{number}') for number, person in enumerate(people[:100]))
+    options = dict(workers=2, rate=50.0, max_rate=100.0, api_endpoint=f"http://127.0.0.1:{server.server_address[1]}/",
+                   credentials=AnonymousCredentials(), sync_state=state)
+    try:
+        stats = contacts.main_pipelined(None, 'user@example.com', str(folder), **options)
+        assert stats.get('created') == 150
+        assert len(server.people) == 250
+        assert server.requests['people.connections.list'] == 1
+        assert server.requests['people.batchCreateContacts'] == 1
+
+        again = contacts.main_pipelined(None, 'user@example.com', str(folder), **options)
+        assert again.get('created') == 0
+        assert server.requests['people.batchCreateContacts'] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # The state file alone is enough to skip what this tool uploaded
+    empty = fake_people_api.start_server()
+    options['api_endpoint'] = f"http://127.0.0.1:{empty.server_address[1]}/"
+    try:
+        stats = contacts.main_pipelined(None, 'user@example.com', str(folder), **options)
+    finally:
+        empty.shutdown()
+        empty.server_close()
+    assert stats.get('created') == 100
+    assert len(empty.people) == 100
+
+def test_tenant_import_reports_missing_folder(tmp_path):
+    folder = tmp_path / 'contacts'
+    folder.mkdir()
+    write_contacts(folder, 30)
+    server = fake_people_api.start_server()
+    try:
+        importer = contacts.TenantImporter(None, upload_workers=2, rate=50.0, max_rate=100.0, anonymous=True,
+                                           api_endpoint=f"http://127.0.0.1:{server.server_address[1]}/")
+        results = importer.run([('found@example.com', str(folder)), ('missing@example.com', str(tmp_path / 'typo'))])
+    finally:
+        server.shutdown()
+        server.server_close()
+    by_user = {result['user']: result for result in results}
+    assert by_user['found@example.com']['created'] == 30 and not by_user['found@example.com']['error']
+    assert by_user['missing@example.com']['created'] == 0
+    assert 'not found' in by_user['missing@example.com']['error']
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_streaming_parser_matches_vobject(workers):
+    assert contacts.compare_parsers(TRICKY_CONTACTS, workers) == 0
+
+def test_parse_workers_get_group_cache(tmp_path):
+    # More files than the pool's window of queued ranges
+    for number in range(10):
+        (tmp_path / str(number)).mkdir()
+        write_contacts(tmp_path / str(number), 60)
+    group_cache = {'Family': 'contactGroups/g1', 'Work': 'contactGroups/g2'}
+    serial = list(contacts.iter_parsed_vcards(str(tmp_path), group_cache, 1))
+    parallel = list(contacts.iter_parsed_vcards(str(tmp_path), group_cache, 2))
+    assert parallel == serial
+    assert len(serial) == 600
+    assert all(person is not None and error is None for _, person, _, error in serial)
+
+@pytest.mark.parametrize('parse_workers', [0, 2])
+def test_spaced_categories_resolve_in_one_listing(tmp_path, parse_workers):
+    (tmp_path / 'contacts.vcf').write_text(''.join(
+        f"BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Person {number}\r\nN:{number};Person;;;\r\n"
+        f"EMAIL;TYPE=INTERNET:person{number}@example.org\r\nCATEGORIES:Work, Family\r\nEND:VCARD\r\n"
+        for number in range(5)), newline='')
+    server = fake_people_api.start_server()
+    try:
+        stats = contacts.main_pipelined(None, 'user@example.com', str(tmp_path), workers=1, rate=50.0,
+                                        api_endpoint=f"http://127.0.0.1:{server.server_address[1]}/",
+                                        credentials=AnonymousCredentials(), parse_workers=parse_workers)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert stats.get('created') == 5
+    assert server.requests['contactGroups.list'] == 1
+    assert server.requests['contactGroups.create'] == 2
+    assert sorted(group['name'] for group in server.groups.values()) == ['Family', 'Work']
+    groups = {group['resourceName'] for group in server.groups.values()}
+    assert all({membership['contactGroupMembership']['contactGroupResourceName']
+                for membership in person['memberships']} == groups for person in server.people)
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import fake_imap_server
+import imap_upload
+import mbox_to_maildir
+
+MESSAGES = [
+    ('Inbox,Unread', 'Unread in the inbox'),
+    ('Inbox,Starred', 'Starred in the inbox'),
+    ('Sent', 'Sent mail'),
+    ('"Work/Projects",Important', 'Nested label'),
+    ('', 'No labels at all'),
+]
+
+def write_mbox(path, copies=6):
+    with open(path, 'wb') as f:
+        for copy in range(copies):
+            for number, (labels, subject) in enumerate(MESSAGES):
+                f.write(f"From 1234@xxx Mon Jan 01 00:00:{number:02d} +0000 2024\n"
+                        f"X-Gmail-Labels: {labels}\nSubject: {subject} {copy}\n\n"
+                        f"First line\n>From the quoted line\n>>From the twice quoted line\n\n".encode())
+
+@pytest.mark.parametrize('literal_plus', [True, False])
+@pytest.mark.parametrize('multiappend', [True, False])
+def test_upload_with_each_append_strategy(tmp_path, literal_plus, multiappend):
+    source = str(tmp_path / 'mail.mbox')
+    write_mbox(source)
+    server = fake_imap_server.start_server(literal_plus=literal_plus, multiappend=multiappend)
+    try:
+        stats = imap_upload.upload_mailbox(source, '127.0.0.1', 'user@example.com', 'secret',
+                                           port=server.server_address[1], connections=2, batch_messages=4)
+        mailboxes = {name: server.messages('user@example.com', name) for name in ('INBOX', 'Sent', 'Work/Projects', 'Archive')}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert stats.get('failed') == 0
+    assert {name: len(messages) for name, messages in mailboxes.items()} == {
+        'INBOX': 12, 'Sent': 6, 'Work/Projects': 6, 'Archive': 6}
+    inbox_flags = sorted(flags for flags, _, _ in mailboxes['INBOX'])
+    assert inbox_flags == [()] * 6 + [('\\Seen', '\\Flagged')] * 6
+    assert all(flags == ('\\Seen',) for name in ('Sent', 'Work/Projects', 'Archive') for flags, _, _ in mailboxes[name])
+    assert all(date and date.startswith('01-Jan-2024') for messages in mailboxes.values() for _, date, _ in messages)
+    # mboxrd quoting is undone, one level per line
+    for messages in mailboxes.values():
+        for _, _, body in messages:
+            assert body.endswith(b'First line\r\nFrom the quoted line\r\n>From the twice quoted line\r\n')
+    if multiappend:
+        assert server.commands['APPEND'] < 30
+
+def test_maildir_bodies_are_unquoted(tmp_path):
+    source = str(tmp_path / 'mail.mbox')
+    write_mbox(source, copies=1)
+    mbox_to_maildir.convert_mailbox(source, str(tmp_path / 'Maildir'), sync='none')
+    cur = tmp_path / 'Maildir' / 'cur'
+    bodies = [(cur / name).read_bytes() for name in os.listdir(cur)]
+    assert len(bodies) == 2
+    assert all(body.endswith(b'First line\nFrom the quoted line\n>From the twice quoted line\n') for body in bodies)
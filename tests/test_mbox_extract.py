@@ -0,0 +1,93 @@
+import re
+
+import mbox_extract
+
+def fixed_size_message(number, recipient, size=200):
+    """
+    Returns a message of exactly size bytes, so shard boundaries of an mbox made of them
+    fall right on 'From ' separator lines.
+    """
+    head = (f"From sender{number}@example.org Mon Jan 01 00:00:00 2024\n"
+            f"From: sender{number}@example.org\nTo: {recipient}\nSubject: message {number}\n\n"
+            f">From the quoted body line\nbody From not a separator\n")
+    return (head + 'x' * (size - len(head) - 2) + '\n\n').encode()
+
+def write_mbox(path, count=48):
+    recipients = ['alice@example.com', 'bob@example.com', 'carol@example.net']
+    data = b''.join(fixed_size_message(number, recipients[number % 3]) for number in range(count))
+    path.write_bytes(data)
+    return data
+
+def test_shard_ranges_start_on_separators(tmp_path):
+    path = tmp_path / 'in.mbox'
+    data = write_mbox(path)
+    for shards in range(2, 13):
+        ranges = mbox_extract.shard_ranges(data, shards)
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+        for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+            assert end == next_start
+            assert data[next_start:next_start + 5] == b'From '
+
+def test_parallel_scan_matches_serial(tmp_path):
+    path = tmp_path / 'in.mbox'
+    write_mbox(path)
+    pattern = re.compile(r'alice@example\.com|carol', re.IGNORECASE)
+    mbox_extract.scan_emails(str(path), str(tmp_path / 'serial.mbox'), pattern, workers=1)
+    serial = (tmp_path / 'serial.mbox').read_bytes()
+    assert serial.count(b'From sender') == 32
+    for workers in (2, 3, 4):
+        output = tmp_path / f'parallel{workers}.mbox'
+        mbox_extract.scan_emails(str(path), str(output), pattern, workers=workers)
+        assert output.read_bytes() == serial
+
+def test_parallel_route_matches_serial(tmp_path):
+    path = tmp_path / 'in.mbox'
+    write_mbox(path)
+
+    def rules(prefix):
+        return [('alice@example.com', str(tmp_path / f'{prefix}-alice.mbox')),
+                ('example\\.(com|net)', str(tmp_path / f'{prefix}-all.mbox')),
+                ('carol@example.net', str(tmp_path / f'{prefix}-carol.mbox'))]
+
+    serial = mbox_extract.route_emails(str(path), rules('serial'), workers=1)
+    assert list(serial.values()) == [16, 48, 16]
+    for workers in (2, 3):
+        counts = mbox_extract.route_emails(str(path), rules(f'parallel{workers}'), workers=workers)
+        assert list(counts.values()) == list(serial.values())
+        for name in ('alice', 'all', 'carol'):
+            assert ((tmp_path / f'parallel{workers}-{name}.mbox').read_bytes() ==
+                    (tmp_path / f'serial-{name}.mbox').read_bytes())
+
+def test_route_non_ascii_address_rule(tmp_path):
+    path = tmp_path / 'in.mbox'
+    path.write_bytes(b''.join(
+        f"From x Mon Jan 01 00:00:00 2024\nTo: {recipient}\n\nbody\n\n".encode()
+        for recipient in ('jos\u00e9@example.com', 'jose@example.com', 'Jos\u00e9@example.com')))
+    counts = mbox_extract.route_emails(str(path), [('jos\u00e9@example.com', str(tmp_path / 'jose.mbox')),
+                                                   ('jose@example.com', str(tmp_path / 'ascii.mbox'))])
+    # The non-ASCII address is routed as a regex rule instead of aborting the run
+    assert list(counts.values()) == [2, 1]
+    assert 'jose@example.com' not in (tmp_path / 'jose.mbox').read_text()
+
+def test_index_exact_lookups_use_indexes(tmp_path):
+    path = tmp_path / 'in.mbox'
+    path.write_bytes(b''.join(
+        f"From x Mon Jan 01 00:00:00 2024\nMessage-ID: <id{n}@example.org>\nFrom: Sender <S{n % 2}@Example.org>\n"
+        f"To: malice@example.com, {'alice@example.com' if n % 3 == 0 else 'bob@example.com'}\n\nbody\n\n".encode()
+        for n in range(12)))
+    conn = mbox_extract.update_index(str(path))
+    try:
+        everything = conn.execute('SELECT offset, length FROM messages ORDER BY offset').fetchall()
+        alice = mbox_extract.query_index(conn, re.compile('alice@example.com', re.IGNORECASE))
+        assert alice == [everything[n] for n in range(0, 12, 3)]
+        assert mbox_extract.query_index(conn, re.compile('s1@example.org', re.IGNORECASE), 'from') == everything[1::2]
+        assert mbox_extract.query_index(conn, re.compile('s1@example.org', re.IGNORECASE), 'to') == []
+        assert mbox_extract.query_index(conn, re.compile('<id5@example.org>'), 'message-id') == [everything[5]]
+        assert mbox_extract.query_index(conn, re.compile('id5@example.org'), 'message-id') == [everything[5]]
+        # Real regex patterns still search every row
+        assert mbox_extract.query_index(conn, re.compile(r'id1\d@', re.IGNORECASE), 'message-id') == everything[10:]
+        plan = ' '.join(str(row) for row in conn.execute(
+            'EXPLAIN QUERY PLAN SELECT offset FROM messages WHERE message_id IN (?, ?)', ('a', 'b')))
+        assert 'messages_message_id' in plan
+    finally:
+        conn.close()
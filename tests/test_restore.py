@@ -0,0 +1,141 @@
+import json
+import os
+import sys
+
+import instrumentation
+import upload_all_mboxes_with_service_account as restore
+
+# Stands in for gyb: records when it starts and ends, burns some CPU, and fails the
+# first time it is run on a folder holding a fail_once marker
+STUB_GYB = '''#!{python}
+import os
+import sys
+import time
+
+email, folder = sys.argv[4], sys.argv[7]
+with open(os.environ['STUB_GYB_RECORD'], 'a') as f:
+    f.write(f"start {{email}} {{folder}}\\n")
+stop = time.process_time() + 0.2
+while time.process_time() < stop:
+    pass
+failing = os.path.exists(os.path.join(folder, 'fail_once'))
+if failing:
+    os.remove(os.path.join(folder, 'fail_once'))
+with open(os.environ['STUB_GYB_RECORD'], 'a') as f:
+    f.write(f"end {{email}} {{folder}}\\n")
+sys.exit(3 if failing else 0)
+'''
+
+def make_stub(tmp_path, monkeypatch):
+    gyb = tmp_path / 'gyb'
+    gyb.write_text(STUB_GYB.format(python=sys.executable))
+    gyb.chmod(0o755)
+    record = tmp_path / 'record.txt'
+    monkeypatch.setenv('STUB_GYB_RECORD', str(record))
+    return str(gyb), record
+
+def make_user(base, name, size, fail_once=False):
+    mbox_folder = base / name / 'mbox'
+    mbox_folder.mkdir(parents=True)
+    (mbox_folder / 'mail.mbox').write_bytes(b'x' * size)
+    if fail_once:
+        (mbox_folder / 'fail_once').write_text('')
+    return str(mbox_folder)
+
+def read_record(record):
+    return [line.split() for line in record.read_text().splitlines()]
+
+def test_restores_retry_largest_first(tmp_path, monkeypatch):
+    gyb, record = make_stub(tmp_path, monkeypatch)
+    events = tmp_path / 'events.jsonl'
+    monkeypatch.setattr(instrumentation, '_metrics', instrumentation.Metrics('test', str(events)))
+    base = tmp_path / 'users'
+    small = make_user(base, 'small@old.example', 100)
+    large = make_user(base, 'large@old.example', 3000, fail_once=True)
+    medium = make_user(base, 'medium@old.example', 2000)
+
+    jobs = restore.find_restore_jobs(str(base), 'new.example')
+    assert [job['mbox_folder'] for job in jobs] == [large, medium, small]
+    restore.run_restores(jobs, gyb=gyb, concurrency=1, retries=2, retry_delay=0, log_dir=str(tmp_path / 'logs'),
+                         poll_interval=0.02)
+    instrumentation._metrics.close()
+
+    # The failed restore goes to the back of the queue and succeeds on its second attempt
+    starts = [folder for kind, _, folder in read_record(record) if kind == 'start']
+    assert starts == [large, medium, small, large]
+    by_folder = {job['mbox_folder']: job for job in jobs}
+    assert by_folder[large]['attempts'] == 2
+    assert by_folder[medium]['attempts'] == by_folder[small]['attempts'] == 1
+    assert all(job['status'] == 'done' and job['returncode'] == 0 for job in jobs)
+    with open(by_folder[large]['log']) as log:
+        assert '=== attempt 1 exited with 3' in log.read()
+
+    # Each attempt's CPU time comes from wait4 on the gyb process, not from this process
+    ends = [json.loads(line) for line in events.read_text().splitlines()]
+    ends = [event for event in ends if event['event'] == 'stage_end' and event['stage'] == 'gyb_restore']
+    assert sorted(event['status'] for event in ends) == ['completed'] * 3 + ['failed']
+    assert all(event['cpu_seconds'] >= 0.2 for event in ends)
+
+def test_restore_fails_once_retries_are_used_up(tmp_path, monkeypatch):
+    gyb, record = make_stub(tmp_path, monkeypatch)
+    base = tmp_path / 'users'
+    make_user(base, 'user@old.example', 100, fail_once=True)
+    jobs = restore.run_restores(restore.find_restore_jobs(str(base), 'new.example'), gyb=gyb, retries=0,
+                                retry_delay=0, log_dir=str(tmp_path / 'logs'), poll_interval=0.02)
+    assert [(job['status'], job['returncode'], job['attempts']) for job in jobs] == [('failed', 3, 1)]
+
+def test_restores_per_user_limit(tmp_path, monkeypatch):
+    gyb, record = make_stub(tmp_path, monkeypatch)
+    base = tmp_path / 'users'
+    jobs = [{'user': 'a', 'dest_email': 'a@new.example', 'log_name': f'a-{number}', 'size': 100,
+             'mbox_folder': make_user(base, f'a{number}', 100)} for number in range(3)]
+    jobs.append({'user': 'b', 'dest_email': 'b@new.example', 'size': 100, 'mbox_folder': make_user(base, 'b', 100)})
+    restore.run_restores(jobs, gyb=gyb, concurrency=3, retry_delay=0, log_dir=str(tmp_path / 'logs'),
+                         poll_interval=0.02, per_user=1)
+    assert all(job['status'] == 'done' for job in jobs)
+
+    active = {}
+    most_at_once = 0
+    for kind, email, _ in read_record(record):
+        active[email] = active.get(email, 0) + (1 if kind == 'start' else -1)
+        assert active[email] <= 1
+        most_at_once = max(most_at_once, sum(active.values()))
+    # The other user's restore still ran alongside
+    assert most_at_once == 2
+
+def test_chunks_are_deleted_once_restored(tmp_path, monkeypatch):
+    gyb, record = make_stub(tmp_path, monkeypatch)
+    base = tmp_path / 'users'
+    mbox_folder = base / 'user@old.example' / 'mbox'
+    mbox_folder.mkdir(parents=True)
+    (mbox_folder / 'mail.mbox').write_bytes(b''.join(
+        f"From x Mon Jan 01 00:00:00 2024\nSubject: {number}\n\nbody\n\n".encode() for number in range(10)))
+    chunk_root = str(base / 'gyb_chunks')
+    jobs = restore.find_chunk_jobs(str(base), 'new.example', chunk_root, max_messages=4)
+    assert [job['chunk']['messages'] for job in jobs] == [4, 4, 2]
+    assert all(job['dest_email'] == 'user@new.example' for job in jobs)
+
+    restore.run_restores(jobs, gyb=gyb, retry_delay=0, log_dir=str(tmp_path / 'logs'), poll_interval=0.02,
+                         on_done=restore.mark_chunk_done)
+    assert all(job['status'] == 'done' and not os.path.exists(job['mbox_folder']) for job in jobs)
+    # The manifest still records the deleted chunks as restored, and the chunk folder
+    # inside the base folder is not taken for a user
+    assert restore.find_chunk_jobs(str(base), 'new.example', chunk_root, max_messages=4) == []
+
+def test_changed_sources_replace_old_chunks(tmp_path):
+    mbox_folder = tmp_path / 'user@old.example' / 'mbox'
+    mbox_folder.mkdir(parents=True)
+    messages = b''.join(f"From x Mon Jan 01 00:00:00 2024\nSubject: {number}\n\nbody\n\n".encode() for number in range(10))
+    (mbox_folder / 'a.mbox').write_bytes(messages)
+    chunk_root = str(tmp_path / 'chunks')
+    manifest_path, manifest = restore.chunk_user_mbox('user', str(mbox_folder), chunk_root, max_messages=4)
+    restore.mark_chunk_done({'manifest': (manifest_path, manifest), 'chunk': manifest['chunks'][0]})
+
+    (mbox_folder / 'a.mbox').rename(mbox_folder / 'merged.mbox')
+    manifest_path, manifest = restore.chunk_user_mbox('user', str(mbox_folder), chunk_root, max_messages=4)
+    assert [chunk['done'] for chunk in manifest['chunks']] == [False] * 3
+    # Every chunk folder holds only its slice of the current file
+    for chunk in manifest['chunks']:
+        assert os.listdir(chunk['folder']) == ['merged.mbox']
+    assert sorted(name for name in os.listdir(os.path.join(chunk_root, 'user')) if name.startswith('chunk-')) == \
+        [chunk['name'] for chunk in manifest['chunks']]
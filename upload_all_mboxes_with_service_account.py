@@ -18,8 +18,19 @@ limitations under the License.
 # script is a work in progress and may have bugs
 
 import os
+import sys
+import json
+import mmap
+import argparse
+import shutil
 import subprocess
 import time
+import instrumentation
+import mbox_extract
+
+PROGRESS_INTERVAL = 30
+MANIFEST_NAME = 'manifest.json'
+CHUNK_COPY_SIZE = 8 * 1024 * 1024
 
 def create_tmux_session(session_name, command):
     """
@@ -51,11 +62,358 @@ def process_user_folders(base_folder, dest_domain):
         else:
             print(f"Skipping {folder_path}, does not contain 'mbox' directory.")
 
+def folder_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+def find_restore_jobs(base_folder, dest_domain, exclude=()):
+    """
+    Returns one job per user folder with an mbox directory, largest mbox first so the
+    longest restores start early instead of finishing last. Folders in exclude (such as
+    chunk or log folders kept inside base_folder) are skipped.
+    """
+    excluded = {os.path.realpath(path) for path in exclude}
+    jobs = []
+    for folder in sorted(os.listdir(base_folder)):
+        folder_path = os.path.join(base_folder, folder)
+        if os.path.realpath(folder_path) in excluded:
+            continue
+        if os.path.isdir(folder_path) and 'mbox' in os.listdir(folder_path):
+            email_prefix = folder.split('@')[0]
+            mbox_folder = os.path.join(folder_path, 'mbox')
+            jobs.append({'user': email_prefix, 'dest_email': f"{email_prefix}@{dest_domain}",
+                         'mbox_folder': mbox_folder, 'size': folder_size(mbox_folder)})
+        else:
+            print(f"Skipping {folder_path}, does not contain 'mbox' directory.")
+    jobs.sort(key=lambda job: job['size'], reverse=True)
+    return jobs
+
+def gyb_command(gyb, dest_email, mbox_folder):
+    return [gyb, '--action', 'restore-mbox', '--email', dest_email, '--service-account', '--local-folder', mbox_folder]
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+
+def report_progress(jobs, running, started):
+    done = [job for job in jobs if job.get('status') == 'done']
+    failed = [job for job in jobs if job.get('status') == 'failed']
+    restored = sum(job['size'] for job in done)
+    total = sum(job['size'] for job in jobs)
+    print(f"[{time.strftime('%H:%M:%S')}] {len(done)}/{len(jobs)} jobs restored, {len(running)} running, "
+          f"{len(failed)} failed; {format_size(restored)} of {format_size(total)} "
+          f"after {time.monotonic() - started:.0f}s")
+
+def mbox_sources(mbox_folder):
+    """
+    Returns [path, size, mtime_ns] of every file under an mbox folder, in a stable order.
+    """
+    sources = []
+    for root, dirs, files in os.walk(mbox_folder):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            stat = os.stat(path)
+            sources.append([path, stat.st_size, stat.st_mtime_ns])
+    return sources
+
+def save_manifest(manifest_path, manifest):
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, manifest_path)
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def chunk_ranges(data, max_bytes=None, max_messages=None):
+    """
+    Yields (start, end, messages) ranges of an mapped mbox, cut at message boundaries
+    so each holds at most max_messages messages and, unless one message is larger,
+    at most max_bytes bytes.
+    """
+    chunk_start = None
+    chunk_end = 0
+    messages = 0
+    for start, end in mbox_extract.iter_message_spans(data):
+        if chunk_start is not None and ((max_messages and messages >= max_messages) or
+                                        (max_bytes and end - chunk_start > max_bytes)):
+            yield chunk_start, chunk_end, messages
+            chunk_start = None
+        if chunk_start is None:
+            chunk_start = start
+            messages = 0
+        chunk_end = end
+        messages += 1
+    if chunk_start is not None:
+        yield chunk_start, chunk_end, messages
+
+def copy_range(data, start, end, path):
+    temp_path = path + '.tmp'
+    released = start - start % mmap.PAGESIZE
+    with open(temp_path, 'wb') as output:
+        for position in range(start, end, CHUNK_COPY_SIZE):
+            output.write(data[position:min(end, position + CHUNK_COPY_SIZE)])
+            released = mbox_extract.release_scanned(data, released, position)
+    os.replace(temp_path, path)
+
+def chunk_user_mbox(user, mbox_folder, chunk_root, max_bytes=None, max_messages=None):
+    """
+    Splits every file in a user's mbox folder into chunk folders under chunk_root/<user>,
+    each holding one slice of one file under its original name, and records them in
+    chunk_root/<user>/manifest.json. An existing manifest for the same files and limits is
+    reused, keeping which chunks are already restored; otherwise the old chunks are
+    deleted and the files split again. Chunks are full copies of their
+    slices, so until they are restored (and deleted) they take as much disk as the mbox
+    folder itself. Returns (manifest_path, manifest).
+    """
+    user_root = os.path.join(chunk_root, user)
+    manifest_path = os.path.join(user_root, MANIFEST_NAME)
+    sources = mbox_sources(mbox_folder)
+    manifest = load_manifest(manifest_path)
+    if (manifest and manifest['sources'] == sources and manifest['max_bytes'] == max_bytes and
+            manifest['max_messages'] == max_messages and
+            all(chunk['done'] or os.path.isdir(chunk['folder']) for chunk in manifest['chunks'])):
+        return manifest_path, manifest
+
+    # Chunks of an earlier manifest would be restored alongside the new ones
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    if os.path.isdir(user_root):
+        for name in os.listdir(user_root):
+            if name.startswith('chunk-'):
+                shutil.rmtree(os.path.join(user_root, name))
+    os.makedirs(user_root, exist_ok=True)
+    manifest = {'user': user, 'sources': sources, 'max_bytes': max_bytes, 'max_messages': max_messages, 'chunks': []}
+    stage = instrumentation.stage('chunk_mbox', total_bytes=sum(source[1] for source in sources), user=user)
+    for path, size, mtime_ns in sources:
+        data = mbox_extract.open_mbox_map(path)
+        if data is None:
+            continue
+        try:
+            for start, end, messages in chunk_ranges(data, max_bytes, max_messages):
+                name = f"chunk-{len(manifest['chunks']) + 1:05d}"
+                folder = os.path.join(user_root, name)
+                os.makedirs(folder, exist_ok=True)
+                copy_range(data, start, end, os.path.join(folder, os.path.basename(path)))
+                manifest['chunks'].append({'name': name, 'folder': folder, 'source': path, 'offset': start,
+                                           'bytes': end - start, 'messages': messages, 'done': False})
+                stage.add(messages=messages, bytes=end - start, chunks=1)
+        finally:
+            data.close()
+    save_manifest(manifest_path, manifest)
+    stage.finish()
+    print(f"Split {mbox_folder} into {len(manifest['chunks'])} chunks")
+    return manifest_path, manifest
+
+def find_chunk_jobs(base_folder, dest_domain, chunk_root, max_bytes=None, max_messages=None, exclude=()):
+    """
+    Returns one job per chunk not yet restored, for every user folder with an mbox directory.
+    Users are ordered largest mbox first, their chunks in order.
+    """
+    jobs = []
+    for user_job in find_restore_jobs(base_folder, dest_domain, (chunk_root,) + tuple(exclude)):
+        manifest_path, manifest = chunk_user_mbox(user_job['user'], user_job['mbox_folder'], chunk_root,
+                                                  max_bytes, max_messages)
+        pending = [chunk for chunk in manifest['chunks'] if not chunk['done']]
+        if len(pending) < len(manifest['chunks']):
+            print(f"Resuming {user_job['dest_email']}: {len(manifest['chunks']) - len(pending)} "
+                  f"of {len(manifest['chunks'])} chunks already restored")
+        for chunk in pending:
+            jobs.append({'user': user_job['user'], 'dest_email': user_job['dest_email'], 'mbox_folder': chunk['folder'],
+                         'size': chunk['bytes'], 'log_name': f"{user_job['user']}.{chunk['name']}",
+                         'manifest': (manifest_path, manifest), 'chunk': chunk})
+    return jobs
+
+def mark_chunk_done(job):
+    """
+    Records a chunk as restored and deletes its copy of the mail.
+    """
+    manifest_path, manifest = job['manifest']
+    job['chunk']['done'] = True
+    save_manifest(manifest_path, manifest)
+    shutil.rmtree(job['chunk']['folder'], ignore_errors=True)
+
+def poll_process(process):
+    """
+    Like process.poll(), but also returns the CPU seconds a finished process used
+    (None while it runs or where the platform cannot tell).
+    """
+    if process.returncode is None and hasattr(os, 'wait4'):
+        try:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            return process.poll(), None
+        if pid == 0:
+            return None, None
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return process.returncode, usage.ru_utime + usage.ru_stime
+    return process.poll(), None
+
+def run_restores(jobs, gyb='gyb', concurrency=4, retries=2, retry_delay=60, log_dir='gyb_logs',
+                 poll_interval=0.5, progress_interval=PROGRESS_INTERVAL, per_user=None, on_done=None):
+    """
+    Runs a GYB restore for each job, at most `concurrency` at a time, in the order given,
+    and at most per_user at a time for the same destination user.
+    Output of each job goes to log_dir/<user>.log; a job that exits non-zero is retried
+    up to `retries` times, retry_delay seconds apart. on_done(job) is called for every
+    successful restore. Sets 'status' ('done' or 'failed'), 'returncode', 'attempts' and
+    'seconds' on every job and returns the jobs.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    queue = list(jobs)
+    running = {}
+    started = time.monotonic()
+    last_report = started
+    restore_stage = instrumentation.stage('restore', total_bytes=sum(job['size'] for job in jobs))
+    for job in jobs:
+        job['attempts'] = 0
+        job['ready_at'] = started
+    try:
+        while queue or running:
+            now = time.monotonic()
+            for job in list(queue):
+                if len(running) >= concurrency:
+                    break
+                if job['ready_at'] > now:
+                    continue
+                if per_user and sum(1 for other, _, _ in running.values()
+                                    if other['dest_email'] == job['dest_email']) >= per_user:
+                    continue
+                queue.remove(job)
+                job['attempts'] += 1
+                job['log'] = os.path.join(log_dir, f"{job.get('log_name', job['user'])}.log")
+                log = open(job['log'], 'a')
+                log.write(f"=== attempt {job['attempts']} started {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+                log.flush()
+                command = gyb_command(gyb, job['dest_email'], job['mbox_folder'])
+                try:
+                    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+                except OSError as e:
+                    log.write(f"Could not start {gyb}: {e}\n")
+                    log.close()
+                    job.update(status='failed', returncode=None, seconds=0)
+                    restore_stage.error(f"could not start {gyb} for {job['dest_email']}: {e}")
+                    print(f"Error starting restore for {job['dest_email']}: {e}")
+                    continue
+                job['started'] = now
+                stage = instrumentation.stage('gyb_restore', total_bytes=job['size'], user=job['dest_email'],
+                                              folder=job['mbox_folder'], attempt=job['attempts'])
+                running[process] = (job, log, stage)
+                print(f"Started restore for {job['dest_email']} from {job['mbox_folder']} "
+                      f"({format_size(job['size'])}, attempt {job['attempts']})")
+
+            for process in list(running):
+                returncode, cpu = poll_process(process)
+                if returncode is None:
+                    continue
+                job, log, stage = running.pop(process)
+                log.write(f"=== attempt {job['attempts']} exited with {returncode}\n")
+                log.close()
+                job['returncode'] = returncode
+                job['seconds'] = round(time.monotonic() - job['started'], 1)
+                if returncode == 0:
+                    job['status'] = 'done'
+                    messages = job['chunk']['messages'] if 'chunk' in job else 0
+                    stage.add(messages=messages, bytes=job['size'])
+                    stage.finish(cpu=cpu)
+                    restore_stage.add(messages=messages, bytes=job['size'], jobs=1)
+                    if on_done:
+                        on_done(job)
+                    print(f"Restored {job['dest_email']} from {job['mbox_folder']} in {job['seconds']}s")
+                    continue
+                stage.error(f"gyb exited with {returncode}")
+                stage.finish('failed', cpu=cpu)
+                if job['attempts'] <= retries:
+                    job['ready_at'] = time.monotonic() + retry_delay
+                    queue.append(job)
+                    print(f"Restore for {job['dest_email']} exited with {returncode}, retrying in {retry_delay}s "
+                          f"(see {job['log']})")
+                else:
+                    job['status'] = 'failed'
+                    restore_stage.error(f"restore for {job['dest_email']} failed after {job['attempts']} attempts")
+                    print(f"Restore for {job['dest_email']} failed with {returncode} after {job['attempts']} attempts "
+                          f"(see {job['log']})")
+
+            if queue or running:
+                if time.monotonic() - last_report >= progress_interval:
+                    report_progress(jobs, running, started)
+                    last_report = time.monotonic()
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Interrupted, stopping running restores")
+        for process, (job, log, stage) in running.items():
+            process.terminate()
+            process.wait()
+            log.close()
+            job['status'] = 'interrupted'
+            stage.finish('interrupted')
+        restore_stage.finish('interrupted')
+        raise
+    report_progress(jobs, running, started)
+    restore_stage.finish()
+    return jobs
+
 if __name__ == "__main__":
-    base_folder = input("Enter the path to the folder containing the email archives: ")
+    parser = argparse.ArgumentParser(description="Restore every user's mbox folder into Google Workspace with GYB.")
+    parser.add_argument('base_folder', nargs='?', help="folder containing one folder per user")
+    parser.add_argument('dest_domain', nargs='?', help="destination domain name")
+    parser.add_argument('--concurrency', type=int, default=4, help="restores running at the same time")
+    parser.add_argument('--retries', type=int, default=2, help="times a failed restore is retried")
+    parser.add_argument('--retry-delay', type=float, default=60, help="seconds before a failed restore is retried")
+    parser.add_argument('--gyb', default='gyb', help="gyb executable to run")
+    parser.add_argument('--log-dir', help="folder for per-user logs (default: gyb_logs next to base_folder)")
+    parser.add_argument('--progress-interval', type=float, default=PROGRESS_INTERVAL,
+                        help="seconds between aggregate progress lines")
+    parser.add_argument('--tmux', action='store_true', help="start every restore at once in its own tmux session")
+    parser.add_argument('--chunk-mb', type=float, help="split each user's mbox into chunks of about this many MB; "
+                                                       "the chunks are copies, so this needs free space for another copy "
+                                                       "of the mbox files until each chunk is restored and deleted")
+    parser.add_argument('--chunk-messages', type=int, help="split each user's mbox into chunks of at most this many messages")
+    parser.add_argument('--chunk-dir', help="folder for the chunks and their manifests (default: gyb_chunks next to base_folder)")
+    parser.add_argument('--chunks-per-user', type=int, default=2, help="chunks of the same user restored at the same time")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args('gyb_restore', args)
+
+    base_folder = args.base_folder or input("Enter the path to the folder containing the email archives: ")
     if not os.path.isdir(base_folder):
         print("Error: The specified path does not exist or is not a directory.")
         exit(1)
 
-    dest_domain = input("Enter the destination domain name: ")
-    process_user_folders(base_folder, dest_domain)
+    dest_domain = args.dest_domain or input("Enter the destination domain name: ")
+    # Kept outside base_folder by default so later scans of it do not take them for users
+    parent_folder = os.path.dirname(os.path.abspath(base_folder))
+    log_dir = args.log_dir or os.path.join(parent_folder, 'gyb_logs')
+    chunk_dir = args.chunk_dir or os.path.join(parent_folder, 'gyb_chunks')
+    if args.tmux:
+        process_user_folders(base_folder, dest_domain)
+        sys.exit(0)
+    if args.chunk_mb or args.chunk_messages:
+        max_bytes = int(args.chunk_mb * 1024 * 1024) if args.chunk_mb else None
+        jobs = find_chunk_jobs(base_folder, dest_domain, chunk_dir, max_bytes, args.chunk_messages, (log_dir,))
+        options = {'per_user': args.chunks_per_user, 'on_done': mark_chunk_done}
+    else:
+        jobs = find_restore_jobs(base_folder, dest_domain, (log_dir, chunk_dir))
+        options = {}
+    jobs = run_restores(jobs, gyb=args.gyb, concurrency=args.concurrency, retries=args.retries,
+                        retry_delay=args.retry_delay, log_dir=log_dir,
+                        progress_interval=args.progress_interval, **options)
+    failed = sorted({job['dest_email'] for job in jobs if job.get('status') != 'done'})
+    if failed:
+        print(f"{len(failed)} restores failed: {', '.join(failed)}")
+        sys.exit(1)